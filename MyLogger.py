@@ -22,15 +22,58 @@ class B:
         self.logger.debug('a=%s', a)
 --
 
+hot path trace:
+--
+from MyLogger import get_tracer
+
+_trace = get_tracer()
+TR_STEP = _trace.event('A.step')
+
+    def step(self, pulse):
+        if _trace.on:
+            _trace.rec(TR_STEP, pulse[0], pulse[1])
+--
+環境変数 OTTOPI_TRACE にファイル名を指定すると、トレースを有効にし、
+終了時にそのファイルに保存する。保存したトレースの表示:
+
+  $ python3 TraceView.py trace.bin
+
+asynchronous logging:
+--
+環境変数 OTTOPI_LOG を指定すると(または start_async() を呼ぶと)、
+ログは QueueHandler でキューに入れるだけになり、
+出力(フォーマット, 書き込み)はバックグラウンドのスレッドで行う。
+
+  OTTOPI_LOG=robot.log  ファイルに書き込む (サイズでローテーション)
+  OTTOPI_LOG=-          標準エラー出力に書き込む
+
+キューが混んできたら INFO 以下を捨て、満杯なら全て捨てる(待たない)。
+捨てた数は、後で WARNING として出力する。
+--
+
 """
 __author__ = 'Yoichi Tanibayashi'
 __date__   = '2020/03/31'
 
-from logging import getLogger, StreamHandler, Formatter
+import os
+import time
+import json
+import queue
+import struct
+import atexit
+from logging import getLogger, StreamHandler, Formatter, LogRecord
 from logging import NOTSET, DEBUG, INFO, WARNING, ERROR, CRITICAL
+from logging.handlers import QueueHandler, QueueListener
+from logging.handlers import RotatingFileHandler
+
+TRACE_ENV = 'OTTOPI_TRACE'
+LOG_ENV = 'OTTOPI_LOG'
 
 
 class MyLogger:
+    instances = []       # 全インスタンス (start_async() でハンドラを替える)
+    async_log = None     # AsyncLog (start_async() 後)
+
     def __init__(self, name=''):
         fmt_hdr = '%(asctime)s %(levelname)s '
         fmt_loc = '%(filename)s.%(name)s.%(funcName)s:%(lineno)d> '
@@ -43,9 +86,16 @@ class MyLogger:
 
         self.logger = getLogger(name)
         self.logger.setLevel(INFO)
-        self.logger.addHandler(self.console_handler)
+        self.logger.addHandler(self.get_handler())
         self.logger.propagate = False
 
+        MyLogger.instances.append(self)
+
+    def get_handler(self):
+        if MyLogger.async_log is not None:
+            return MyLogger.async_log.queue_handler
+        return self.console_handler
+
     def get_logger(self, name, debug):
         logger = self.logger.getChild(name)
         if debug in (NOTSET, DEBUG, INFO, WARNING, ERROR, CRITICAL):
@@ -59,8 +109,299 @@ class MyLogger:
         return logger
 
 
+class DropQueueHandler(QueueHandler):
+    """
+    待たない QueueHandler
+
+    キューが high_water 以上なら keep_level 未満のログを、
+    満杯なら全てのログを捨てて、drop_n に数える。
+    drop_n は、多数のスレッドから数えるので、self.lock (RLock) の中で増やす。
+    """
+    def __init__(self, q, high_water, keep_level=WARNING):
+        super().__init__(q)
+        self.high_water = high_water
+        self.keep_level = keep_level
+        self.drop_n = 0
+
+    def emit(self, record):
+        # フォーマット(prepare)する前に判断する
+        if record.levelno < self.keep_level and \
+           self.queue.qsize() >= self.high_water:
+            with self.lock:
+                self.drop_n += 1
+            return
+
+        super().emit(record)
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.lock:
+                self.drop_n += 1
+
+
+class BatchStreamHandler(StreamHandler):
+    """ 1行ごとには flush しない StreamHandler (flush() は listener が呼ぶ) """
+    def emit(self, record):
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+
+
+class BatchFileHandler(RotatingFileHandler):
+    """
+    1行ごとには flush しない RotatingFileHandler
+
+    ローテーションの判断は、書き込んだバイト数(UTF-8)を数えて行う
+    (shouldRollover() の seek() で、まとめ書きが無駄にならないように)。
+    """
+    def __init__(self, path, max_bytes, backup_count):
+        super().__init__(path, maxBytes=max_bytes, backupCount=backup_count,
+                         encoding='utf-8')
+        self.size = os.path.getsize(path) if os.path.exists(path) else 0
+
+    def emit(self, record):
+        try:
+            msg = self.format(record) + self.terminator
+            msg_bytes = len(msg.encode('utf-8'))
+            if self.maxBytes > 0 and \
+               self.size + msg_bytes > self.maxBytes:
+                self.doRollover()
+                self.size = 0
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(msg)
+            self.size += msg_bytes
+        except Exception:
+            self.handleError(record)
+
+
+class BatchQueueListener(QueueListener):
+    """
+    キューが空になるか、batch_n 個たまったら、まとめて flush する
+
+    DropQueueHandler で捨てた数が増えていたら、WARNING を出力する。
+    """
+    def __init__(self, q, queue_handler, handler, batch_n):
+        super().__init__(q, handler)
+        self.queue_handler = queue_handler
+        self.batch_n = batch_n
+        self.pending = 0
+        self.drop_n = 0
+
+    def handle(self, record):
+        super().handle(record)
+        self.pending += 1
+        if self.pending >= self.batch_n or self.queue.empty():
+            self.flush()
+
+    def flush(self):
+        drop_n = self.queue_handler.drop_n
+        if drop_n != self.drop_n:
+            record = LogRecord(__name__, WARNING, __file__, 0,
+                               '%d log records dropped', (drop_n -
+                                                          self.drop_n,),
+                               None, 'flush')
+            self.drop_n = drop_n
+            super().handle(record)
+
+        for h in self.handlers:
+            h.flush()
+        self.pending = 0
+
+    def enqueue_sentinel(self):
+        # キューが満杯でも、listener が取り出すので待てば入る
+        self.queue.put(self._sentinel)
+
+
+class AsyncLog:
+    """
+    非同期ログ出力 (QueueHandler -> BatchQueueListener のスレッド)
+
+    メッセージの文字列化(引数の展開)だけは、ログを出したスレッドで行う
+    (引数のリストなどが、後で変更されることがあるため)。
+    日時などの付加とフォーマット、書き込みは listener のスレッドで行う。
+    """
+    DEF_QUEUE_SIZE   = 4096
+    DEF_HIGH_WATER   = 0.75          # キューサイズに対する割合
+    DEF_MAX_BYTES    = 1024 * 1024
+    DEF_BACKUP_COUNT = 3
+    DEF_BATCH_N      = 64
+
+    def __init__(self, path=None, fmt=None, max_bytes=DEF_MAX_BYTES,
+                 backup_count=DEF_BACKUP_COUNT, queue_size=DEF_QUEUE_SIZE,
+                 batch_n=DEF_BATCH_N):
+        """
+        Parameters
+        ----------
+        path: str
+            None: 標準エラー出力
+        """
+        self.queue = queue.Queue(queue_size)
+        self.queue_handler = DropQueueHandler(
+            self.queue, int(queue_size * self.DEF_HIGH_WATER))
+
+        if path is None:
+            self.handler = BatchStreamHandler()
+        else:
+            self.handler = BatchFileHandler(path, max_bytes, backup_count)
+        self.handler.setLevel(DEBUG)
+        self.handler.setFormatter(fmt)
+
+        self.listener = BatchQueueListener(self.queue, self.queue_handler,
+                                           self.handler, batch_n)
+        self.listener.start()
+
+    def stop(self):
+        """ キューに残っているログを書き込んでから止める """
+        self.listener.stop()
+        self.listener.flush()
+        self.handler.close()
+
+
 myLogger = MyLogger()
 
 
 def get_logger(name, debug):
     return myLogger.get_logger(name, debug)
+
+
+def start_async(path=None, **kwargs):
+    """
+    全ての MyLogger のログ出力を非同期にする (AsyncLog)
+
+    Parameters
+    ----------
+    path: str
+        None: 標準エラー出力
+    kwargs:
+        AsyncLog() のパラメータ
+    """
+    if MyLogger.async_log is not None:
+        return MyLogger.async_log
+
+    MyLogger.async_log = AsyncLog(path, myLogger.handler_fmt, **kwargs)
+    for ml in MyLogger.instances:
+        ml.logger.removeHandler(ml.console_handler)
+        ml.logger.addHandler(MyLogger.async_log.queue_handler)
+
+    atexit.register(stop_async)
+    return MyLogger.async_log
+
+
+def stop_async():
+    """ 同期出力(console_handler)に戻す """
+    async_log = MyLogger.async_log
+    if async_log is None:
+        return
+
+    for ml in MyLogger.instances:
+        ml.logger.removeHandler(async_log.queue_handler)
+        ml.logger.addHandler(ml.console_handler)
+    MyLogger.async_log = None
+
+    async_log.stop()
+
+
+if os.environ.get(LOG_ENV):
+    start_async(None if os.environ[LOG_ENV] == '-' else os.environ[LOG_ENV])
+
+
+class Tracer:
+    """
+    ホットパス用のトレース (バイナリのリングバッファ)
+
+    logger.debug() と違い、文字列にせずに固定長のレコードとして
+    記録するので、サーボの補間ステップごとに呼んでも軽い。
+    呼び出し側で `if tracer.on:` を確認してから rec() を呼べば、
+    無効なときのコストは、属性の参照1回だけ。
+
+    1レコード: 時刻(double), イベントID(uint32), 引数(int32 x 4)
+    複数スレッドから記録した場合、まれにレコードが上書きされることがある。
+    """
+    REC = struct.Struct('<dI4i')
+    MAGIC = b'OttoPiTrace1\n'
+    DEF_SIZE = 16384  # レコード数
+
+    def __init__(self, size=DEF_SIZE, clock=time.monotonic):
+        self.on = False
+        self.clock = clock
+        self.names = []   # イベントID -> イベント名
+        self._ev = {}     # イベント名 -> イベントID
+        self.resize(size)
+
+    def resize(self, size):
+        """ バッファを作り直す (記録は消える) """
+        self.size = size
+        self.buf = bytearray(self.REC.size * size)
+        self.n = 0        # 記録した総数
+
+    def clear(self):
+        self.n = 0
+
+    def event(self, name):
+        """ イベント名を登録して、IDを返す (同じ名前は同じID) """
+        ev = self._ev.get(name)
+        if ev is None:
+            ev = len(self.names)
+            self.names.append(name)
+            self._ev[name] = ev
+        return ev
+
+    def rec(self, ev, a=0, b=0, c=0, d=0):
+        """ 1レコード記録する (古いものから上書き) """
+        i = self.n % self.size
+        self.n += 1
+        self.REC.pack_into(self.buf, i * self.REC.size, self.clock(), ev,
+                           int(a), int(b), int(c), int(d))
+
+    def raw(self):
+        """ 古い順に並べたレコードのバイト列 """
+        if self.n <= self.size:
+            return bytes(self.buf[:self.n * self.REC.size])
+
+        i = (self.n % self.size) * self.REC.size
+        return bytes(self.buf[i:] + self.buf[:i])
+
+    @classmethod
+    def decode(cls, names, raw):
+        """
+        Returns
+        -------
+        records: list of (t, name, a, b, c, d)
+        """
+        return [(t, names[ev], a, b, c, d)
+                for t, ev, a, b, c, d in cls.REC.iter_unpack(raw)]
+
+    def records(self):
+        """ 古い順 [(t, name, a, b, c, d), ..] """
+        return self.decode(self.names, self.raw())
+
+    def save(self, path):
+        """ ヘッダ, イベント名(JSON 1行), レコード """
+        with open(path, 'wb') as f:
+            f.write(self.MAGIC)
+            f.write(json.dumps(self.names).encode('utf-8') + b'\n')
+            f.write(self.raw())
+
+    @classmethod
+    def load(cls, path):
+        """ save() したファイルを読む: records() と同じ形式 """
+        with open(path, 'rb') as f:
+            if f.readline() != cls.MAGIC:
+                raise ValueError('%s: not a trace file' % (path))
+            names = json.loads(f.readline().decode('utf-8'))
+            return cls.decode(names, f.read())
+
+
+myTracer = Tracer()
+
+if os.environ.get(TRACE_ENV):
+    myTracer.on = True
+    atexit.register(myTracer.save, os.environ[TRACE_ENV])
+
+
+def get_tracer():
+    return myTracer
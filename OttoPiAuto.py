@@ -10,8 +10,19 @@ OttoPiCtrlを利用して、ロボットを自動運転する。
 
 send()で、自動運転のON/OFFを制御できる。
 
+判断は状態遷移表(trans_table)で行う。動作の待ち時間はタイマーで管理し、
+sleepしないので、待っている間もコマンドとセンサーの値を処理する。
+状態遷移は、時刻付きで記録する(get_trans_log())。
+
+距離はセンサースレッド(OttoPiSensor)がフィルターをかけた推定値を使う。
+send()を呼んだスレッドも、I2Cにはアクセスしない。
+近づく速度から LOOKAHEAD_SEC 秒後の距離を予測し、早めに避ける。
+センサーの値が来なくなった場合(I2Cエラーなど)は、止まって待つ。
+
 ------------------------------------------------------------
 OttoPiAuto -- ロボットの自動運転 (自動運転スレッド)
+ |
+ +- OttoPiSensor -- 距離センサー読み込み (センサースレッド)
  |
  +- OttoPiCtrl -- コマンド制御 (動作実行スレッド)
      |
@@ -27,9 +38,10 @@ __date__   = '2020'
 import time
 import random
 import queue
+import collections
 import threading
 import pigpio
-import VL53L0X as VL53L0X
+from OttoPiSensor import OttoPiSensor
 from OttoPiCtrl import OttoPiCtrl
 from MyLogger import get_logger
 
@@ -45,6 +57,8 @@ class OttoPiAuto(threading.Thread):
     CMD_END   = 'end'
 
     DEF_RECV_TIMEOUT = 0.2  # sec
+    SENSOR_MAX_AGE = 2      # センサーの計測周期の何倍まで有効か
+    LOOKAHEAD_SEC = 0.3
 
     D_TOUCH       = 40
     D_TOO_NEAR    = 180
@@ -59,11 +73,27 @@ class OttoPiAuto(threading.Thread):
     STAT_NEAR     = 'near'
     STAT_FAR      = 'far'
     STAT_READY    = 'ready'
+    STAT_OFF      = 'off'
+    STAT_NO_DATA  = 'no_data'
+
+    EV_NOT_READY  = 'not_ready'
+    EV_READY_ZONE = 'ready_zone'
+    EV_READY      = 'ready'
+    EV_TOUCH      = 'touch'
+    EV_TOO_NEAR   = 'too_near'
+    EV_NEAR       = 'near'
+    EV_YELLOW     = 'yellow'
+    EV_MID        = 'mid'
+    EV_FAR        = 'far'
+    EV_NO_DATA    = 'no_data'
+    EV_TIMER      = 'timer'  # set_timer() の after() (表にはない)
+
+    TRANS_LOG_SIZE = 1000
 
     TOUCH_COUNT_COMMIT = 3
     READY_COUNT_COMMIT = 2
 
-    def __init__(self, robot_ctrl=None, debug=False):
+    def __init__(self, robot_ctrl=None, sensor=None, debug=False):
         """ init """
         self.dbg = debug
         self._log = get_logger(__class__.__name__, self.dbg)
@@ -83,11 +113,12 @@ class OttoPiAuto(threading.Thread):
             self.robot_ctrl = OttoPiCtrl(None, debug=self.dbg)
             self.robot_ctrl.start()
 
-        self.tof = VL53L0X.VL53L0X()
-        # self.tof.start_ranging(VL53L0X.VL53L0X_BEST_ACCURACY_MODE)
-        self.tof.start_ranging(VL53L0X.VL53L0X_BETTER_ACCURACY_MODE)
-        self.tof_timing = self.tof.get_timing()
-        self._log.info('tof_timing = %.02f ms', self.tof_timing / 1000)
+        self.my_sensor = False
+        self.sensor = sensor
+        if self.sensor is None:
+            self.my_sensor = True
+            self.sensor = OttoPiSensor(debug=self.dbg)
+            self.sensor.start()
         self.d = 0
 
         self.cmdq = queue.Queue()
@@ -103,6 +134,55 @@ class OttoPiAuto(threading.Thread):
         self.ready_count = 0
 
         self.distance = self.D_FAR
+        self.velocity = 0.0
+
+        self.timer = (0, None)
+        self.trans_log = collections.deque(maxlen=self.TRANS_LOG_SIZE)
+
+        # 状態遷移表
+        #   (状態, イベント): (アクション, 次の状態, 待ち時間[sec])
+        #   次の状態が None の場合は、アクションで決める(または変わらない)
+        #   表にない組み合わせは、何もしない
+        self.trans_table = {
+            (self.STAT_OFF, self.EV_READY_ZONE): (self.act_ready, None, 1),
+            (self.STAT_OFF, self.EV_READY):      (self.act_on, None, 0),
+            (self.STAT_OFF, self.EV_NOT_READY):  (self.act_not_ready, None, 0),
+
+            (self.STAT_NEAR, self.EV_TOO_NEAR): (self.act_backward,
+                                                 self.STAT_NEAR, 2),
+            (self.STAT_NEAR, self.EV_NEAR):     (self.act_turn,
+                                                 self.STAT_NEAR, 2.5),
+            (self.STAT_NEAR, self.EV_YELLOW):   (self.act_suriashi,
+                                                 self.STAT_YELLOW, 0),
+            (self.STAT_NEAR, self.EV_MID):      (self.act_forward,
+                                                 self.STAT_NONE, 0),
+            (self.STAT_NEAR, self.EV_FAR):      (self.act_forward,
+                                                 self.STAT_FAR, 0),
+            (self.STAT_YELLOW, self.EV_FAR):    (self.act_forward,
+                                                 self.STAT_FAR, 0),
+            (self.STAT_NONE, self.EV_FAR):      (self.act_none,
+                                                 self.STAT_FAR, 0),
+
+            # センサーの値が来ない間は止まり、来たら歩き直す
+            (self.STAT_NO_DATA, self.EV_YELLOW): (self.act_suriashi,
+                                                  self.STAT_YELLOW, 0),
+            (self.STAT_NO_DATA, self.EV_MID):    (self.act_forward,
+                                                  self.STAT_NONE, 0),
+            (self.STAT_NO_DATA, self.EV_FAR):    (self.act_forward,
+                                                  self.STAT_FAR, 0),
+        }
+        for st in (self.STAT_NONE, self.STAT_YELLOW, self.STAT_FAR,
+                   self.STAT_NEAR):
+            self.trans_table[(st, self.EV_NO_DATA)] = (
+                self.act_stop, self.STAT_NO_DATA, 0)
+        for st in (self.STAT_NONE, self.STAT_YELLOW, self.STAT_FAR,
+                   self.STAT_NEAR, self.STAT_NO_DATA):
+            self.trans_table[(st, self.EV_TOUCH)] = (self.act_touch, None, 0)
+            if st != self.STAT_NEAR:
+                self.trans_table[(st, self.EV_TOO_NEAR)] = (
+                    self.act_surprised, self.STAT_NEAR, 1)
+                self.trans_table[(st, self.EV_NEAR)] = (
+                    self.act_slide, self.STAT_NEAR, 1.5)
 
         super().__init__(daemon=True)
 
@@ -122,10 +202,16 @@ class OttoPiAuto(threading.Thread):
 
         self.join()
 
-        self.tof.stop_ranging()
+        if self.my_sensor:
+            self.sensor.end()
 
         self._log.debug('done')
 
+    def ctrl_send(self, cmd):
+        """ 自動運転の優先度で OttoPiCtrl にコマンドを送る """
+        self._log.debug('cmd=%s', cmd)
+        self.robot_ctrl.send(cmd, pri=OttoPiCtrl.PRI_AUTO)
+
     def cmd_null(self):
         """ do nothing (to get distance) """
         self._log.debug('')
@@ -136,18 +222,20 @@ class OttoPiAuto(threading.Thread):
         if not self.enable:
             self._log.warning('enable=%s .. ignored', self.enable)
             return
-        self.robot_ctrl.send('forward')
+        self.ctrl_send('forward')
         self.on = True
         self.touch_count = 0
         self.stat = self.STAT_NONE
+        self.cancel_timer()
 
     def cmd_off(self):
         """ cmd off """
         self._log.debug('')
-        self.robot_ctrl.send('stop')
+        self.ctrl_send('stop')
         self.on = False
         self.ready_count = 0
         self.stat = self.STAT_NONE
+        self.cancel_timer()
 
     def cmd_enable(self):
         """ cmd enable """
@@ -156,6 +244,7 @@ class OttoPiAuto(threading.Thread):
         self._log.debug('enable=%s', self.enable)
         self.ready_count = 0
         self.stat = self.STAT_NONE
+        self.cancel_timer()
 
     def cmd_disable(self):
         """ cmd disable """
@@ -178,10 +267,19 @@ class OttoPiAuto(threading.Thread):
         return self.active
 
     def send(self, cmd):
-        """ """
+        """
+        コマンドを自動運転スレッドに渡す (ブロックしない)
+
+        Returns
+        -------
+        d: int
+            最新の距離[mm]  センサーの値が来ていない場合は D_FAR
+        """
         self._log.debug('cmd=\'%s\'', cmd)
         self.cmdq.put(cmd)
         d = self.get_distance()
+        if d < 0:
+            d = self.D_FAR
         self._log.debug('d=%smm', '{:,}'.format(d))
         return d
 
@@ -198,22 +296,226 @@ class OttoPiAuto(threading.Thread):
         return cmd
 
     def get_distance(self):
-        """ """
-        self.distance = self.tof.get_distance()
-        if self.distance == 0:
-            # ???
-            self.distance = self.D_FAR
-            self._log.warning('Crrection: distance = %smm',
-                              '{:,}'.format(self.distance))
-
+        """
+        センサースレッドが推定した最新の距離 (速度は self.velocity)
+
+        センサーの異常値(0など)は、OttoPiSensorのフィルターで除かれる。
+        待たない(ブロックしない)。
+
+        Returns
+        -------
+        d: int
+            -1: 推定値がない、またはセンサーの読み込みが
+                SENSOR_MAX_AGE周期以上止まっている (I2Cエラーなど)
+        """
+        t, d, v = self.sensor.estimate()
+        t_latest = self.sensor.latest()[0]
+        if d is None or t_latest is None or \
+                self.sensor.clock() - t_latest > \
+                self.sensor.interval * self.SENSOR_MAX_AGE:
+            self._log.debug('no sensor data')
+            return -1
+
+        self.distance = int(d)
+        self.velocity = v
         return self.distance
 
+    def get_distance_ahead(self):
+        """ 近づいている場合、LOOKAHEAD_SEC秒後の予測距離 """
+        return self.distance + min(self.velocity, 0) * self.LOOKAHEAD_SEC
+
+    def classify(self, d):
+        """
+        距離と状態から、イベントを決める
+
+        Returns
+        -------
+        event: str
+            None: イベントなし
+        """
+        if d < 0:
+            return self.EV_NO_DATA if self.on else None
+
+        if not self.on:
+            if self.ready_count >= self.READY_COUNT_COMMIT:
+                return self.EV_READY
+            if d >= self.D_READY_MIN and d <= self.D_READY_MAX:
+                return self.EV_READY_ZONE
+            if self.ready_count > 0:
+                return self.EV_NOT_READY
+            return None
+
+        # 近づいている場合は、少し先の予測距離で判断する
+        d_ahead = self.get_distance_ahead()
+
+        if d <= self.D_TOUCH:
+            return self.EV_TOUCH
+        if d_ahead <= self.D_TOO_NEAR:
+            return self.EV_TOO_NEAR
+        if d_ahead <= self.D_NEAR:
+            return self.EV_NEAR
+        if d >= self.D_FAR:
+            return self.EV_FAR
+        if d <= self.D_NEAR + 50:
+            return self.EV_YELLOW
+        return self.EV_MID
+
+    def set_timer(self, now, sec, after=None):
+        """
+        タイマー: sec秒間は判断しない(コマンドとセンサーは処理する)
+        時間が来たら after() を呼ぶ
+        """
+        self.timer = (now + sec, after)
+
+    def cancel_timer(self):
+        """ cancel_timer """
+        self.timer = (0, None)
+
+    def step(self, now):
+        """
+        状態遷移を1回行う (ブロックしない)
+
+        Parameters
+        ----------
+        now: float
+            現在時刻 (time.monotonic())
+        """
+        expire, after = self.timer
+        if now < expire:
+            return
+        if after is not None:
+            self.timer = (expire, None)
+            stat = self.stat if self.on else self.STAT_OFF
+            after(now)
+            self.log_trans(now, stat, self.EV_TIMER, after, self.distance)
+            return
+
+        d = self.get_distance()
+
+        if not self.enable:
+            return
+
+        stat = self.stat if self.on else self.STAT_OFF
+        ev = self.classify(d)
+        if ev != self.EV_TOUCH:
+            self.touch_count = 0
+
+        if (stat, ev) not in self.trans_table:
+            return
+
+        action, next_stat, hold_sec = self.trans_table[(stat, ev)]
+
+        self.prev_stat = self.stat
+        if next_stat is not None:
+            self.stat = next_stat
+        if hold_sec > 0:
+            self.set_timer(now, hold_sec)
+
+        action(now)
+        self.log_trans(now, stat, ev, action, d)
+
+    def log_trans(self, now, stat, ev, action, d):
+        """ 状態遷移を記録する (get_trans_log()) """
+        self.trans_log.append((now, stat, ev, action.__name__,
+                               self.stat if self.on else self.STAT_OFF,
+                               d, self.velocity))
+        self._log.info('%s --(%s:%dmm)--> %s: %s', stat, ev, d,
+                       self.trans_log[-1][4], action.__name__)
+
+    def get_trans_log(self):
+        """
+        状態遷移の記録
+
+        Returns
+        -------
+        trans_log: list of tuple
+            (時刻, 状態, イベント, アクション, 次の状態, 距離, 速度)
+            タイマーで呼ばれたアクションのイベントは EV_TIMER
+        """
+        return list(self.trans_log)
+
+    def act_ready(self, now):
+        """ 手をかざした: 2回続いたら自動運転開始 """
+        self.ready_count += 1
+        self._log.info('ready_count=%d/%d',
+                       self.ready_count, self.READY_COUNT_COMMIT)
+        self.ctrl_send('happy')
+
+    def act_not_ready(self, now):
+        """ act_not_ready """
+        self.ready_count = 0
+
+    def act_on(self, now):
+        """ act_on """
+        self.cmd_on()
+
+    def act_touch(self, now):
+        """ 触れた: TOUCH_COUNT_COMMIT回続いたら停止 """
+        self.ctrl_send('surprised')
+
+        self.touch_count += 1
+        self._log.info('touch_count=%d', self.touch_count)
+        if self.touch_count >= self.TOUCH_COUNT_COMMIT:
+            self._log.warning('STOP!')
+            self.set_timer(now, 1, self.act_touch_stop)
+        else:
+            self.set_timer(now, 1, self.act_touch_backward)
+
+    def act_touch_backward(self, now):
+        """ act_touch_backward """
+        self.ctrl_send('backward')
+
+    def act_touch_stop(self, now):
+        """ act_touch_stop """
+        self.cmd_off()
+        self.set_timer(now, 3)
+
+    def act_surprised(self, now):
+        """ act_surprised """
+        self.ctrl_send('surprised')
+
+    def act_stop(self, now):
+        """ センサーの値が来ないので、止まって待つ """
+        self._log.warning('no sensor data .. stop')
+        self.ctrl_send('stop')
+
+    def act_backward(self, now):
+        """ act_backward """
+        self.ctrl_send('backward')
+
+    def act_slide(self, now):
+        """ 左右どちらかに避ける """
+        if random.random() < 0.5:
+            self.prev_rl = "right"
+        else:
+            self.prev_rl = "left"
+        self.ctrl_send('slide_' + self.prev_rl)
+
+    def act_turn(self, now):
+        """ 避けた方向に向きを変える """
+        if self.prev_rl == "right":
+            self.ctrl_send('turn_right')
+        else:
+            self.ctrl_send('turn_left')
+
+    def act_forward(self, now):
+        """ act_forward """
+        self.ctrl_send('forward')
+
+    def act_suriashi(self, now):
+        """ act_suriashi """
+        self.ctrl_send('suriashi_fwd')
+
+    def act_none(self, now):
+        """ 状態だけ変える """
+        pass
+
     def run(self):
         """ run """
         self._log.debug('')
 
         while self.active:
-            cmd = self.recv()
+            cmd = self.recv(min(self.DEF_RECV_TIMEOUT, self.sensor.interval))
             if cmd != '':
                 self._log.debug('cmd=%a', cmd)
                 cmdline = cmd.split()
@@ -224,105 +526,7 @@ class OttoPiAuto(threading.Thread):
                 else:
                     self._log.error('%s: invalid command .. ignore', cmd)
 
-            d = self.get_distance()
-            # self._log.debug('d = %smm', '{:,}'.format(d))
-            if d < 0:
-                continue
-
-            if not self.enable:
-                continue
-
-            if not self.on:
-                if self.ready_count > 0:
-                    self._log.info('ready_count=%d/%d',
-                                   self.ready_count, self.READY_COUNT_COMMIT)
-
-                if self.ready_count < self.READY_COUNT_COMMIT:
-                    if d >= self.D_READY_MIN and d <= self.D_READY_MAX:
-                        self._log.warn('%dmm <= %dmm <= %dmm',
-                                       self.D_READY_MIN,
-                                       d,
-                                       self.D_READY_MAX)
-                        self.ready_count += 1
-                        self.robot_ctrl.send('happy')
-                        time.sleep(1)
-                    else:
-                        self.ready_count = 0
-
-                else:  # self.ready_count >= self.READY_COUNT_COMMIT
-                    self.cmd_on()
-
-                continue
-
-            self.prev_stat = self.stat
-
-            if d <= self.D_TOUCH:
-                self._log.warn('touched(%dmm <= %dmm)', d, self.D_TOUCH)
-                self.robot_ctrl.send('suprised')
-                time.sleep(1)
-
-                if self.touch_count < self.TOUCH_COUNT_COMMIT:
-                    self.touch_count += 1
-                    self._log.info('touch_count=%d', self.touch_count)
-                    if self.touch_count >= self.TOUCH_COUNT_COMMIT:
-                        self._log.warn('STOP!')
-                        self.cmd_off()
-                        # self.robot_ctrl.send('suprised')
-                        time.sleep(3)
-                    else:
-                        self.robot_ctrl.send('backward')
-                    continue
-            else:
-                self.touch_count = 0
-
-            if d <= self.D_TOO_NEAR:
-                self._log.warn('TOO_NEAR(%dmm <= %dmm)', d, self.D_TOO_NEAR)
-                self.stat = self.STAT_NEAR
-
-                if self.prev_stat != self.STAT_NEAR:
-                    self.robot_ctrl.send('suprised')
-                    time.sleep(1)
-                else:
-                    self.robot_ctrl.send('backward')
-                    time.sleep(2)
-
-            elif d <= self.D_NEAR:
-                self._log.warn('NEAR(%dmm <= %dmm)', d, self.D_NEAR)
-                self.stat = self.STAT_NEAR
-                if self.prev_stat != self.STAT_NEAR:
-                    if random.random() < 0.5:
-                        self.prev_rl = "right"
-                        self.robot_ctrl.send('slide_right')
-                    else:
-                        self.prev_rl = "left"
-                        self.robot_ctrl.send('slide_left')
-                else:
-                    if self.prev_rl == "right":
-                        self.robot_ctrl.send('turn_right')
-                    else:
-                        self.robot_ctrl.send('turn_left')
-                    time.sleep(1)
-                time.sleep(1.5)
-
-            elif d >= self.D_FAR:
-                self._log.info('FAR(%dmm >= %dmm)', d, self.D_FAR)
-                self.stat = self.STAT_FAR
-                if self.prev_stat in [self.STAT_NEAR, self.STAT_YELLOW]:
-                    self.robot_ctrl.send('forward')
-
-            else:
-                if self.prev_stat == self.STAT_NEAR:
-                    self.stat = self.STAT_NONE
-                    if d <= self.D_NEAR + 50:
-                        self.stat = self.STAT_YELLOW
-                        self._log.info('stat: %s', self.stat)
-                        self.robot_ctrl.send('suriashi_fwd')
-                    else:
-                        self._log.info('stat: %s', self.stat)
-                        self.robot_ctrl.send('forward')
-
-            self.touch_count = 0
-            self._log.debug('stat=%s', self.stat)
+            self.step(time.monotonic())
 
         self._log.info('done(active=%s)', self.active)
 
@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+OttoPiAuto のシミュレーション
+
+ロボットと距離センサーがなくても、自動運転の判断を試せる。
+スレッドは使わず、仮想時刻で OttoPiSensor.read1() と OttoPiAuto.step() を
+交互に呼ぶので、実時間よりずっと速く動く。
+
+TraceTof -- 距離の記録(trace)を再生する、VL53L0Xの代わり
+SimCtrl  -- 送られたコマンドを仮想時刻付きで記録する、OttoPiCtrlの代わり
+            OttoPiCtrl にないコマンドは、実機と同じく実行しない(記録しない)
+
+trace file
+----------
+1行に「時刻[sec] 距離[mm]」。'#'以降はコメント。
+時刻の間は直線で補間する。
+
+  # ready -> approach
+  0.0  100
+  1.5  100
+  1.6  1000
+  4.0  1000
+  6.0  100
+
+------------------------------------------------------------
+OttoPiAutoSim
+ |
+ +- OttoPiAuto -- ロボットの自動運転 (step()だけを使う)
+     |
+     +- OttoPiSensor -- (read1()だけを使う)
+     |   |
+     |   +- TraceTof
+     |
+     +- SimCtrl
+------------------------------------------------------------
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+import time
+import bisect
+import random
+import PiServoSim
+from PiServoSim import VirtualClock
+
+# pigpiod がなくても import できるように、OttoPiAuto より先に置き換える
+PiServoSim.install()
+
+from OttoPiAuto import OttoPiAuto
+from OttoPiCtrl import OttoPiCtrl
+from OttoPiSensor import OttoPiSensor
+from MyLogger import get_logger, WARNING
+
+
+class TraceTof:
+    """
+    距離の記録を再生する (VL53L0X.VL53L0X の代わり)
+
+    noise: 距離に加える乱数の幅[mm]
+    glitch: 0を返す確率 (センサーの異常値)
+    """
+    DEF_TIMING = 33000  # usec
+
+    def __init__(self, trace, clock, timing=DEF_TIMING, noise=0, glitch=0,
+                 seed=0):
+        """
+        Parameters
+        ----------
+        trace: list of (float, int)
+            [(時刻[sec], 距離[mm]), ..] 時刻の順
+        clock: VirtualClock
+        """
+        self.trace_t = [p[0] for p in trace]
+        self.trace_d = [p[1] for p in trace]
+        self.clock = clock
+        self.timing = timing
+        self.noise = noise
+        self.glitch = glitch
+        self.rnd = random.Random(seed)
+
+    def end_time(self):
+        return self.trace_t[-1]
+
+    def true_distance(self, t):
+        """ 時刻tの距離(補間) """
+        i = bisect.bisect_right(self.trace_t, t)
+        if i <= 0:
+            return self.trace_d[0]
+        if i >= len(self.trace_t):
+            return self.trace_d[-1]
+
+        t0, t1 = self.trace_t[i - 1], self.trace_t[i]
+        d0, d1 = self.trace_d[i - 1], self.trace_d[i]
+        return d0 + (d1 - d0) * (t - t0) / (t1 - t0)
+
+    def get_timing(self):
+        return self.timing
+
+    def get_distance(self):
+        if self.glitch > 0 and self.rnd.random() < self.glitch:
+            return 0
+
+        d = self.true_distance(self.clock())
+        if self.noise > 0:
+            d += self.rnd.uniform(-self.noise, self.noise)
+        return max(int(d), 1)
+
+    def start_ranging(self, mode=None):
+        pass
+
+    def stop_ranging(self):
+        pass
+
+
+_ctrl_cmd_names = None
+
+
+def ctrl_cmd_names():
+    """
+    OttoPiCtrl のコマンド名 (モーションファイルの動作も含む)
+
+    最初の1回だけ、仮想時刻の OttoPiCtrl を作って調べる。
+    """
+    global _ctrl_cmd_names
+
+    if _ctrl_cmd_names is None:
+        pi = PiServoSim.pi(clock=VirtualClock())
+        ctrl = OttoPiCtrl(pi, debug=WARNING)
+        _ctrl_cmd_names = frozenset(ctrl.cmd_func.keys())
+        ctrl.opm.end()
+        pi.stop()
+
+    return _ctrl_cmd_names
+
+
+class SimCtrl:
+    """
+    送られたコマンドを記録する (OttoPiCtrl の代わり)
+
+    OttoPiCtrl にないコマンドは、cmd_log ではなく err_log に記録する。
+    """
+    def __init__(self, clock, cmd_names=None, debug=False):
+        """
+        Parameters
+        ----------
+        cmd_names: set of str
+            有効なコマンド名  None: ctrl_cmd_names()
+        """
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+
+        self.clock = clock
+        self.cmd_names = cmd_names
+        if self.cmd_names is None:
+            self.cmd_names = ctrl_cmd_names()
+        self.cmd_log = []  # [(時刻, コマンド, 優先度), ..]
+        self.err_log = []  # 無効なコマンド
+
+    def send(self, cmd, doInterrupt=True, pri=None):
+        cmdline = cmd.split()
+        if len(cmdline) == 0 or cmdline[0] not in self.cmd_names:
+            self._log.error('\'%s\': no such command .. ignore', cmd)
+            self.err_log.append((self.clock(), cmd, pri))
+            return
+
+        self.cmd_log.append((self.clock(), cmd, pri))
+
+    def end(self):
+        pass
+
+
+def load_trace(path):
+    """ trace fileを読み込む """
+    trace = []
+    with open(path) as f:
+        for line in f:
+            line = line.split('#')[0].split()
+            if len(line) < 2:
+                continue
+            trace.append((float(line[0]), int(line[1])))
+
+    return trace
+
+
+def trace_approach(speed, d_start=1000, d_end=100, ready_sec=1.5,
+                   hold_sec=2.0):
+    """
+    合成trace: 手をかざして自動運転を開始し、障害物が近づいてくる
+
+    Parameters
+    ----------
+    speed: float
+        近づく速さ[mm/sec]
+    """
+    t_start = ready_sec + 1.5
+    t_end = t_start + (d_start - d_end) / speed
+    return [(0.0, 100), (ready_sec, 100),
+            (ready_sec + 0.1, d_start), (t_start, d_start),
+            (t_end, d_end), (t_end + hold_sec, d_end)]
+
+
+def trace_step(d_start=1000, d_end=150, ready_sec=1.5, step_sec=5.0,
+               hold_sec=2.0):
+    """
+    合成trace: 自動運転の開始後、step_sec秒に障害物が急に現れる
+
+    Parameters
+    ----------
+    step_sec: float
+        距離が d_start から d_end に変わる時刻
+    """
+    return [(0.0, 100), (ready_sec, 100),
+            (ready_sec + 0.1, d_start), (step_sec, d_start),
+            (step_sec + 0.001, d_end), (step_sec + hold_sec, d_end)]
+
+
+class OttoPiAutoSim:
+    """
+    1つのtraceでシミュレーションする
+
+    Simple usage
+    ------------
+    sim = OttoPiAutoSim(trace_approach(300), glitch=0.05)
+    result = sim.run()
+    """
+    # 障害物を避けるコマンド (反応時間の計測に使う)
+    AVOID_CMDS = ('surprised', 'backward', 'slide_right', 'slide_left',
+                  'turn_right', 'turn_left', 'stop')
+
+    def __init__(self, trace, noise=0, glitch=0, seed=0, name='',
+                 debug=False):
+        """ __init__ """
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('name=%s, noise=%s, glitch=%s, seed=%s',
+                        name, noise, glitch, seed)
+
+        self.name = name
+
+        self.clock = VirtualClock()
+        self.tof = TraceTof(trace, self.clock, noise=noise, glitch=glitch,
+                            seed=seed)
+        # 遷移のたびにログを出すと遅いので、WARNING以上だけにする
+        log_level = self._dbg or WARNING
+        self.ctrl = SimCtrl(self.clock, debug=log_level)
+        self.sensor = OttoPiSensor(self.tof, clock=self.clock,
+                                   debug=log_level)
+        self.auto = OttoPiAuto(self.ctrl, sensor=self.sensor, debug=log_level)
+        self.seed = seed
+
+    def run(self):
+        """
+        traceの最後まで実行する
+
+        Returns
+        -------
+        result: dict
+        """
+        self._log.debug('')
+
+        random.seed(self.seed)  # act_slide() の左右
+        self.auto.cmd_enable()
+
+        step_n = 0
+        t_end = self.tof.end_time()
+        t0 = time.perf_counter()
+        while self.clock() < t_end:
+            self.clock.advance(self.sensor.interval)
+            self.sensor.read1()
+            self.auto.step(self.clock())
+            step_n += 1
+        wall_sec = time.perf_counter() - t0
+
+        result = {'name': self.name,
+                  'sim_sec': self.clock(),
+                  'wall_sec': wall_sec,
+                  'step_n': step_n,
+                  'step_per_sec': step_n / max(wall_sec, 1e-9),
+                  'speedup': self.clock() / max(wall_sec, 1e-9),
+                  'trans_n': len(self.auto.get_trans_log()),
+                  'cmd_n': len(self.ctrl.cmd_log),
+                  'cmd_err_n': len(self.ctrl.err_log),
+                  'reaction_msec': self.reaction_msec(),
+                  'false_avoid_n': self.false_avoid_n()}
+        self._log.debug('result=%s', result)
+        return result
+
+    def on_time(self):
+        """ 自動運転を開始した時刻 ('forward'を最初に送った時刻) """
+        for t, cmd, pri in self.ctrl.cmd_log:
+            if cmd == 'forward':
+                return t
+        return None
+
+    def reaction_msec(self, ahead_sec=1.0):
+        """
+        反応時間[msec]
+
+        自動運転の開始後、実際の距離が D_NEAR 以下になってから、
+        最初に避けるコマンドを送るまでの時間。
+        予測で早めに避けた場合は、負になる(ahead_sec秒前まで)。
+
+        Returns
+        -------
+        msec: float
+            None: 近づかなかった、または反応しなかった
+        """
+        t_on = self.on_time()
+        if t_on is None:
+            return None
+
+        t_near = None
+        t = t_on
+        while t < self.tof.end_time():
+            if self.tof.true_distance(t) <= OttoPiAuto.D_NEAR:
+                t_near = t
+                break
+            t += 0.001
+        if t_near is None:
+            return None
+
+        for t, cmd, pri in self.ctrl.cmd_log:
+            if t > t_on and t >= t_near - ahead_sec and \
+               cmd in self.AVOID_CMDS:
+                return (t - t_near) * 1000
+        return None
+
+    def false_avoid_n(self, ahead_sec=1.0):
+        """
+        誤って避けた回数
+
+        避けるコマンドを送ってから ahead_sec 秒以内に、
+        実際の距離が D_NEAR 以下にならなかった回数。
+        """
+        t_on = self.on_time()
+        if t_on is None:
+            return 0
+
+        n = 0
+        for t, cmd, pri in self.ctrl.cmd_log:
+            if t <= t_on or cmd not in self.AVOID_CMDS:
+                continue
+
+            d_min = min([self.tof.true_distance(t + i * 0.01)
+                         for i in range(int(ahead_sec / 0.01) + 1)])
+            if d_min > OttoPiAuto.D_NEAR:
+                n += 1
+        return n
+
+
+class OttoPiAutoSimApp:
+    """ シナリオをまとめて実行し、結果を表示する(ベンチマーク) """
+    def __init__(self, trace_file=(), count=100, debug=False):
+        """ __init__ """
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, debug)
+        self._log.debug('trace_file=%s, count=%d', trace_file, count)
+
+        self.trace_file = trace_file
+        self.count = count
+
+    def scenarios(self):
+        """ (name, trace, noise, glitch, seed) """
+        for path in self.trace_file:
+            yield (path, load_trace(path), 0, 0, 0)
+
+        rnd = random.Random(0)
+        for i in range(self.count):
+            speed = rnd.uniform(100, 800)
+            noise = rnd.uniform(0, 20)
+            glitch = rnd.uniform(0, 0.1)
+            name = 'approach%d(%.0fmm/s,noise=%.0f,glitch=%.2f)' % (
+                i, speed, noise, glitch)
+            yield (name, trace_approach(speed), noise, glitch, i)
+
+        for i in range(max(self.count // 5, 1)):
+            d_end = rnd.uniform(60, OttoPiAuto.D_NEAR - 20)
+            step_sec = rnd.uniform(4, 6)
+            noise = rnd.uniform(0, 20)
+            glitch = rnd.uniform(0, 0.1)
+            name = 'step%d(%.0fmm,noise=%.0f,glitch=%.2f)' % (
+                i, d_end, noise, glitch)
+            yield (name, trace_step(d_end=d_end, step_sec=step_sec),
+                   noise, glitch, self.count + i)
+
+    def main(self):
+        """ main """
+        self._log.debug('')
+
+        results = []
+        for name, trace, noise, glitch, seed in self.scenarios():
+            sim = OttoPiAutoSim(trace, noise=noise, glitch=glitch, seed=seed,
+                                name=name, debug=self._dbg)
+            r = sim.run()
+            results.append(r)
+
+            reaction = r['reaction_msec']
+            print('%-44s step=%4d %8.0f step/s x%6.0f reaction=%s'
+                  ' false=%d' % (
+                      r['name'], r['step_n'], r['step_per_sec'],
+                      r['speedup'],
+                      '%+5.0fms' % reaction if reaction is not None else '-',
+                      r['false_avoid_n']))
+
+        if len(results) == 0:
+            return
+
+        step_n = sum([r['step_n'] for r in results])
+        wall_sec = sum([r['wall_sec'] for r in results])
+        sim_sec = sum([r['sim_sec'] for r in results])
+        reactions = sorted([r['reaction_msec'] for r in results
+                            if r['reaction_msec'] is not None])
+        print('scenario=%d step=%d %.0f step/s speedup=x%.0f' % (
+            len(results), step_n, step_n / wall_sec, sim_sec / wall_sec))
+        if len(reactions) > 0:
+            print('reaction: min=%+.0fms median=%+.0fms max=%+.0fms'
+                  ' (no reaction: %d)' % (
+                      reactions[0], reactions[len(reactions) // 2],
+                      reactions[-1], len(results) - len(reactions)))
+        print('false avoid: %d' % sum([r['false_avoid_n'] for r in results]))
+        print('invalid command: %d' % sum([r['cmd_err_n'] for r in results]))
+
+
+import click
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.argument('trace_file', type=click.Path(exists=True), nargs=-1)
+@click.option('--count', '-n', 'count', type=int, default=100,
+              help='number of synthetic scenarios')
+@click.option('--debug', '-d', 'debug', is_flag=True, default=False,
+              help='debug flag')
+def main(trace_file, count, debug):
+    logger = get_logger(__name__, debug)
+    logger.debug('trace_file=%s, count=%d', trace_file, count)
+
+    app = OttoPiAutoSimApp(trace_file, count, debug=debug)
+    app.main()
+
+
+if __name__ == '__main__':
+    main()
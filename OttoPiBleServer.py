@@ -29,7 +29,7 @@ OttoPiServer -- ロボット制御サーバ (ネットワーク送受信スレ
 __author__ = 'Yoichi Tanibayashi'
 __data__   = '2020'
 
-from OttoPiClient import OttoPiClient
+from OttoPiClient import OttoPiClientPool
 from BlePeripheral import BlePeripheral, BleService, BleCharacteristic
 from BlePeripheral import BlePeripheralApp
 import json
@@ -56,10 +56,13 @@ class OttoPiBleServer(BlePeripheral):
         self._name = name
         self._robot_host = robot_host
         self._robot_port = robot_port
+        self._robot_pool = OttoPiClientPool(self._robot_host,
+                                            self._robot_port, debug=False)
 
         self._chara_resp = RespCharacteristic(debug=self._dbg)
         self._chara_cmd = CmdCharacteristic(self._robot_host, self._robot_port,
                                             self._chara_resp,
+                                            robot_pool=self._robot_pool,
                                             debug=self._dbg)
 
         self._svc = OttoPiService(charas=[self._chara_cmd, self._chara_resp],
@@ -87,7 +90,7 @@ class CmdCharacteristic(BleCharacteristic):
     _log = get_logger(__name__, False)
 
     def __init__(self, robot_host, robot_port, chara_resp,
-                 uuid=UUID, debug=False):
+                 uuid=UUID, robot_pool=None, debug=False):
         self._dbg = debug
         __class__._log = get_logger(__class__.__name__, self._dbg)
         self._log.debug('robot_host=%s, robot_port=%s', robot_host, robot_port)
@@ -98,6 +101,11 @@ class CmdCharacteristic(BleCharacteristic):
         self._robot_port = robot_port
         self._chara_resp = chara_resp
 
+        self._robot_pool = robot_pool
+        if self._robot_pool is None:
+            self._robot_pool = OttoPiClientPool(self._robot_host,
+                                                self._robot_port, debug=False)
+
         super().__init__(uuid, ['write', 'read', 'notify'], debug=debug)
 
     def onWriteRequest(self, data, offset, withoutRespoinse, callback):
@@ -108,13 +116,9 @@ class CmdCharacteristic(BleCharacteristic):
         cmd = data.decode('utf-8')
         self._log.debug('cmd=%a', cmd)
 
-        robot_client = OttoPiClient(self._robot_host, self._robot_port,
-                                    debug=False)
-        ret = robot_client.send_cmd(cmd)
+        ret = self._robot_pool.send_cmd(cmd)
         self._log.debug('ret=%s', ret)
 
-        robot_client.close()
-
         self._chara_resp._value = bytearray(json.dumps(ret).encode('utf-8'))
         self._log.debug('_chara_resp._value=%s', self._chara_resp._value)
 
@@ -166,14 +170,12 @@ class OttoPiBleServerApp(BlePeripheralApp):
         self._ble.start()
 
         chara_resp = self._ble._chara_resp
+        robot_pool = self._ble._robot_pool
 
         self._active = True
         while self._active:
             try:
-                robot_cl = OttoPiClient(self._robot_svr, self._robot_port,
-                                        debug=False)
-                ret = robot_cl.send_cmd(':.auto_null')
-                robot_cl.close()
+                ret = robot_pool.send_cmd(':.auto_null')
 
                 chara_resp._value = bytearray(json.dumps(ret).encode('utf-8'))
                 self._log.debug('chara_resp._value=%a', chara_resp._value)
@@ -192,6 +194,7 @@ class OttoPiBleServerApp(BlePeripheralApp):
         self._log.debug('')
         self._active = False
         self._ble.end()
+        self._ble._robot_pool.close()
         self._log.debug('done')
 
 
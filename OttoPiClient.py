@@ -7,6 +7,15 @@
 
 OttoPiServerにコマンドを送信する
 
+framed=True の場合、1行 1 JSON (リクエストID付き)で送受信する。
+返信を待たずに複数のコマンドを送信できる(send_cmds)。
+
+OttoPiClientPool は、接続を使い回す(スレッドセーフ)。
+HTTP, BLE のブリッジから使う。
+
+OttoPiAsyncClient は asyncio版(framed mode)。
+1つの接続で、返信を待たずに複数のコマンドを送信できる。
+
 -----------------------------------------------------------------
 OttoPiClient -- ロボット制御クライアント
 |
@@ -29,6 +38,10 @@ __date__   = '2019'
 
 from OttoPiServer import OttoPiServer
 import telnetlib
+import asyncio
+import threading
+import collections
+import contextlib
 import time
 import json
 
@@ -42,14 +55,21 @@ class OttoPiClient:
     DEF_HOST = 'localhost'
     DEF_PORT = 12345
 
-    def __init__(self, svr_host=DEF_HOST, svr_port=DEF_PORT, debug=False):
+    FRAME_SEP = b'\n'
+    FRAME_TIMEOUT = 5.0  # sec
+
+    def __init__(self, svr_host=DEF_HOST, svr_port=DEF_PORT, framed=False,
+                 debug=False):
         """ init """
         self._dbg = debug
         self._log = get_logger(__class__.__name__, debug)
-        self._log.debug('svr_host=%s, svr_port=%d', svr_host, svr_port)
+        self._log.debug('svr_host=%s, svr_port=%d, framed=%s',
+                        svr_host, svr_port, framed)
 
         self.svr_host = svr_host
         self.svr_port = svr_port
+        self.framed = framed
+        self.frame_id = 0
 
         self.tn = self.open(self.svr_host, self.svr_port)
 
@@ -61,13 +81,38 @@ class OttoPiClient:
     def open(self, svr_host=DEF_HOST, svr_port=DEF_PORT):
         """ open """
         self._log.debug('svr_host=%s, svr_port=%d', svr_host, svr_port)
-        return telnetlib.Telnet(self.svr_host, self.svr_port)
+        tn = telnetlib.Telnet(self.svr_host, self.svr_port)
+
+        if self.framed:
+            # '#Ready' を読み捨てる
+            ready = tn.read_until(self.FRAME_SEP, self.FRAME_TIMEOUT)
+            self._log.debug('ready=%a', ready)
+
+        return tn
 
     def close(self):
         """ close """
         self._log.debug('')
         self.tn.close()
 
+    def is_alive(self):
+        """
+        接続が切れていないか確認する(ブロックしない)
+
+        サーバーが切断した場合、ソケットは読み込み可能になり、EOFになる。
+        """
+        try:
+            if self.tn.get_socket() is None:
+                return False
+            if self.tn.sock_avail():
+                in_data = self.tn.read_very_eager()
+                self._log.debug('in_data=%a', in_data)
+        except (EOFError, OSError) as e:
+            self._log.debug('%s:%s', type(e).__name__, e)
+            return False
+
+        return True
+
     def recv_reply(self):
         """ recv_reply """
         self._log.debug('')
@@ -125,10 +170,86 @@ class OttoPiClient:
 
         return ret
 
+    def send_frame(self, cmd):
+        """
+        framed mode: コマンドを送信する(返信は待たない)
+
+        Returns
+        -------
+        frame_id: int
+        """
+        self._log.debug('cmd=%s', cmd)
+
+        self.frame_id += 1
+        frame = json.dumps({'ID': self.frame_id, 'CMD': cmd})
+        self.tn.write(frame.encode('utf-8') + self.FRAME_SEP)
+
+        return self.frame_id
+
+    def recv_frame(self):
+        """ framed mode: 返信を1つ受信する """
+        self._log.debug('')
+
+        try:
+            line = self.tn.read_until(self.FRAME_SEP, self.FRAME_TIMEOUT)
+        except (EOFError, OSError) as e:
+            self._log.warning('%s:%s', type(e).__name__, e)
+            line = b''
+        self._log.debug('line=%a', line)
+
+        if not line.endswith(self.FRAME_SEP):
+            # timeout or disconnected:
+            # 返信の対応が取れなくなるので、接続を閉じる(次回は接続し直す)
+            self.tn.close()
+            return {'ID': None, 'CMD': '', 'ACCEPT': False, 'MSG': 'timeout'}
+
+        try:
+            ret = json.loads(line.decode('utf-8'))
+        except (UnicodeDecodeError, ValueError):
+            ret = {'ID': None, 'CMD': '', 'ACCEPT': False,
+                   'MSG': line.decode('utf-8', 'replace')}
+
+        self._log.debug('ret=%s', ret)
+        return ret
+
+    def send_cmds(self, cmds):
+        """
+        framed mode: 複数のコマンドを続けて送信し、返信をまとめて受信する
+
+        Returns
+        -------
+        ret: list of dict
+            cmdsと同じ順番の返信
+        """
+        self._log.debug('cmds=%s', cmds)
+
+        try:
+            ids = [self.send_frame(c) for c in cmds]
+        except Exception as e:
+            self._log.warning('Retry:%s:%s:%s.', cmds, type(e), e)
+            self.tn = self.open(self.svr_host, self.svr_port)
+            ids = [self.send_frame(c) for c in cmds]
+
+        replies = {}
+        for i in range(len(ids)):
+            r = self.recv_frame()
+            if r['ID'] is None:
+                break
+            replies[r['ID']] = r
+
+        ret = [replies.get(i, {'ID': i, 'CMD': c, 'ACCEPT': False,
+                               'MSG': 'no reply'})
+               for i, c in zip(ids, cmds)]
+        self._log.debug('ret=%s', ret)
+        return ret
+
     def send_cmd(self, cmd):
         """ send_cmd """
         self._log.debug('cmd=%s', cmd)
 
+        if self.framed:
+            return self.send_cmds([cmd])[0]
+
         self.recv_reply()
 
         if cmd[0] == OttoPiServer.CMD_PREFIX:
@@ -141,22 +262,308 @@ class OttoPiClient:
         return ret
 
 
+class OttoPiClientPool:
+    """
+    OttoPiClient の接続プール (スレッドセーフ)
+
+    使い終わった接続を残しておき、次のコマンドで使い回す。
+    取り出すときに接続を確認し、切れていれば接続し直す。
+    接続数は size まで。足りない場合は、返却されるまで待つ。
+
+    Simple usage
+    ------------
+    pool = OttoPiClientPool('localhost', 12345)
+
+    ret = pool.send_cmd(':forward 2')
+
+    with pool.client() as cl:
+        ret = cl.send_cmds([':forward 2', ':happy'])
+
+    pool.close()
+    """
+    DEF_SIZE = 4
+
+    def __init__(self, svr_host=OttoPiClient.DEF_HOST,
+                 svr_port=OttoPiClient.DEF_PORT, size=DEF_SIZE,
+                 framed=True, debug=False):
+        """ __init__ """
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, debug)
+        self._log.debug('svr_host=%s, svr_port=%d, size=%d, framed=%s',
+                        svr_host, svr_port, size, framed)
+
+        self.svr_host = svr_host
+        self.svr_port = svr_port
+        self.size = size
+        self.framed = framed
+
+        self._idle = collections.deque()
+        self._lock = threading.Lock()
+        self._sem = threading.BoundedSemaphore(size)
+
+        self.stat = {'open': 0, 'reuse': 0, 'dead': 0}
+
+    def count(self, key):
+        """ 統計 (self.stat) を数える """
+        with self._lock:
+            self.stat[key] += 1
+
+    def get(self):
+        """ 接続を取り出す (使い終わったら put() で返却) """
+        self._log.debug('')
+
+        self._sem.acquire()
+        try:
+            while True:
+                with self._lock:
+                    if len(self._idle) == 0:
+                        break
+                    cl = self._idle.pop()
+
+                # 接続の確認(通信)は、排他しないで行う
+                if cl.is_alive():
+                    self.count('reuse')
+                    return cl
+
+                self._log.info('dead connection .. discard')
+                self.count('dead')
+                cl.close()
+
+            self.count('open')
+            return OttoPiClient(self.svr_host, self.svr_port,
+                                framed=self.framed, debug=self._dbg)
+
+        except Exception:
+            self._sem.release()
+            raise
+
+    def put(self, cl, reuse=True):
+        """ 接続を返却する """
+        self._log.debug('reuse=%s', reuse)
+
+        if reuse:
+            with self._lock:
+                self._idle.append(cl)
+        else:
+            cl.close()
+
+        self._sem.release()
+
+    @contextlib.contextmanager
+    def client(self):
+        """ with文で接続を取り出す。例外の場合は接続を捨てる """
+        cl = self.get()
+        try:
+            yield cl
+        except Exception:
+            self.put(cl, reuse=False)
+            raise
+        else:
+            self.put(cl)
+
+    def send_cmd(self, cmd):
+        """ send_cmd """
+        self._log.debug('cmd=%s', cmd)
+
+        with self.client() as cl:
+            ret = cl.send_cmd(cmd)
+
+        self._log.debug('ret=%s', ret)
+        return ret
+
+    def close(self):
+        """ 残っている接続をすべて閉じる """
+        self._log.debug('stat=%s', self.stat)
+
+        with self._lock:
+            while len(self._idle) > 0:
+                self._idle.pop().close()
+
+
+class OttoPiAsyncClient:
+    """
+    asyncio版クライアント (framed mode)
+
+    リクエストIDごとに Future を作り、受信タスクが返信で完了させる。
+    接続が切れている場合は、次の送信時に接続し直す。
+
+    Simple usage
+    ------------
+    cl = OttoPiAsyncClient('localhost', 12345)
+
+    ret = await cl.send_cmd(':forward 2')
+    ret_list = await cl.send_cmds([':forward 2', 'ws'])
+
+    await cl.close()
+    """
+    DEF_HOST = OttoPiClient.DEF_HOST
+    DEF_PORT = OttoPiClient.DEF_PORT
+
+    FRAME_SEP = OttoPiClient.FRAME_SEP
+    FRAME_TIMEOUT = OttoPiClient.FRAME_TIMEOUT
+
+    def __init__(self, svr_host=DEF_HOST, svr_port=DEF_PORT, debug=False):
+        """ __init__ """
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, debug)
+        self._log.debug('svr_host=%s, svr_port=%d', svr_host, svr_port)
+
+        self.svr_host = svr_host
+        self.svr_port = svr_port
+
+        self.frame_id = 0
+        self._pending = {}      # {frame_id: Future}
+        self._reader = None
+        self._writer = None
+        self._recv_task = None
+        self._open_lock = None  # イベントループ内で作る
+
+    def is_open(self):
+        """ is_open """
+        return self._recv_task is not None and not self._recv_task.done()
+
+    async def open(self):
+        """ 接続する(接続済みの場合は何もしない) """
+        self._log.debug('')
+
+        if self._open_lock is None:
+            self._open_lock = asyncio.Lock()
+
+        async with self._open_lock:
+            if self.is_open():
+                return
+
+            self._reader, self._writer = await asyncio.open_connection(
+                self.svr_host, self.svr_port)
+
+            # '#Ready' を読み捨てる
+            ready = await asyncio.wait_for(self._reader.readline(),
+                                           self.FRAME_TIMEOUT)
+            self._log.debug('ready=%a', ready)
+
+            self._recv_task = asyncio.ensure_future(self.recv_loop())
+
+    async def close(self):
+        """ close """
+        self._log.debug('')
+
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+        if self._recv_task is not None:
+            await asyncio.gather(self._recv_task, return_exceptions=True)
+            self._recv_task = None
+
+    async def recv_loop(self):
+        """ 受信タスク: 返信のIDに対応する Future を完了させる """
+        self._log.debug('')
+
+        try:
+            while True:
+                line = await self._reader.readline()
+                if not line.endswith(self.FRAME_SEP):
+                    self._log.debug('disconnected')
+                    break
+
+                try:
+                    ret = json.loads(line.decode('utf-8'))
+                except (UnicodeDecodeError, ValueError):
+                    self._log.warning('invalid reply: %a', line)
+                    continue
+
+                fut = self._pending.pop(ret.get('ID'), None)
+                if fut is None:
+                    self._log.warning('unknown ID: %s', ret)
+                    continue
+
+                if not fut.done():
+                    fut.set_result(ret)
+
+        except (ConnectionError, asyncio.CancelledError) as e:
+            self._log.debug('%s:%s', type(e).__name__, e)
+
+        finally:
+            # 返信が来なかったコマンドは、例外で完了させる
+            for fut in self._pending.values():
+                if not fut.done():
+                    fut.set_exception(ConnectionError('disconnected'))
+            self._pending = {}
+
+    def new_frame(self, cmd):
+        """ (frame_id, 送信データ, Future) を作る """
+        self.frame_id += 1
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[self.frame_id] = fut
+
+        frame = json.dumps({'ID': self.frame_id, 'CMD': cmd})
+        return self.frame_id, frame.encode('utf-8') + self.FRAME_SEP, fut
+
+    async def send_cmds(self, cmds, timeout=FRAME_TIMEOUT):
+        """
+        複数のコマンドを1回の書き込みで送信し、返信をまとめて待つ
+
+        Returns
+        -------
+        ret: list of dict
+            cmdsと同じ順番の返信
+        """
+        self._log.debug('cmds=%s', cmds)
+
+        await self.open()
+
+        frames = [self.new_frame(c) for c in cmds]
+        try:
+            self._writer.write(b''.join([f[1] for f in frames]))
+            await self._writer.drain()
+
+            ret = await asyncio.wait_for(
+                asyncio.gather(*[f[2] for f in frames]), timeout)
+        finally:
+            # タイムアウトなどで返信が来なかった Future を残さない
+            for f in frames:
+                self._pending.pop(f[0], None)
+
+        self._log.debug('ret=%s', ret)
+        return list(ret)
+
+    async def send_cmd(self, cmd, timeout=FRAME_TIMEOUT):
+        """
+        send_cmd
+
+        1-key commandの文字列は、1つのリクエストで送信する。
+        他のタスクからの send_cmd() と同時に使える。
+        """
+        self._log.debug('cmd=%s', cmd)
+
+        ret = await self.send_cmds([cmd], timeout)
+        return ret[0]
+
+
 class OttoPiClientApp:
     """ OttoPiClientApp """
-    def __init__(self, command, svr_host, svr_port, debug=False):
+    def __init__(self, command, svr_host, svr_port, framed=False,
+                 debug=False):
         """ __init__ """
         self._dbg = debug
         self._log = get_logger(__class__.__name__, debug)
         self._log.debug('command=%s', command)
-        self._log.debug('svr_host=%s, svr_port=%d', svr_host, svr_port)
+        self._log.debug('svr_host=%s, svr_port=%d, framed=%s',
+                        svr_host, svr_port, framed)
 
-        self.cl = OttoPiClient(svr_host, svr_port, debug=self._dbg)
+        self.cl = OttoPiClient(svr_host, svr_port, framed=framed,
+                               debug=self._dbg)
         self.command = command
 
     def main(self):
         """ __init__ """
         self._log.debug('command:\'%s\'', self.command)
 
+        if self.cl.framed:
+            for ret in self.cl.send_cmds(self.command):
+                print(ret)
+            return
+
         for cmd1 in self.command:
             if cmd1[0] == OttoPiServer.CMD_PREFIX:
                 ret = self.cl.send_cmd(cmd1)
@@ -182,15 +589,17 @@ class OttoPiClientApp:
 @click.option('--svr_port', '-p', 'svr_port', type=int,
               default=OttoPiClient.DEF_PORT,
               help='server port number')
+@click.option('--framed', '-f', 'framed', is_flag=True, default=False,
+              help='framed mode (JSON lines)')
 @click.option('--debug', '-d', 'debug', is_flag=True, default=False,
               help='debug flag')
-def main(command, svr_host, svr_port, debug):
+def main(command, svr_host, svr_port, framed, debug):
     """ main """
     _log = get_logger(__name__, debug)
-    _log.debug('command=%s, svr_host=%s, svr_port=%d',
-               command, svr_host, svr_port)
+    _log.debug('command=%s, svr_host=%s, svr_port=%d, framed=%s',
+               command, svr_host, svr_port, framed)
 
-    obj = OttoPiClientApp(command, svr_host, svr_port, debug=debug)
+    obj = OttoPiClientApp(command, svr_host, svr_port, framed, debug=debug)
     try:
         obj.main()
     finally:
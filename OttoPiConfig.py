@@ -13,6 +13,10 @@ DEF_CONF_PATH = ['.', os.environ['HOME'], '/etc']
 DEF_SECTION   = 'OttoPi'
 KEY_PIN       = 'pin'
 KEY_HOME      = 'home'
+KEY_SERVO_MODE = 'servo_mode'
+KEY_SERVO_PROFILE = 'servo_profile'
+KEY_V_MAX     = 'v_max'
+KEY_A_MAX     = 'a_max'
 
 
 class OttoPiConfig:
@@ -69,6 +73,13 @@ class OttoPiConfig:
         self.logger.debug('key=%s, int_list=%s', key, int_list)
         self.config[section][key] = ' '.join([str(i) for i in int_list])
 
+    def get_str(self, key, default='', section=DEF_SECTION):
+        self.logger.debug('key=%s, default=%s', key, default)
+        try:
+            return self.config[section][key]
+        except KeyError:
+            return default
+
     def get_pin(self):
         self.logger.debug('')
         return self.get_intlist(KEY_PIN)
@@ -77,6 +88,30 @@ class OttoPiConfig:
         self.logger.debug('')
         return self.get_intlist(KEY_HOME)
 
+    def get_servo_mode(self, default=''):
+        self.logger.debug('default=%s', default)
+        return self.get_str(KEY_SERVO_MODE, default)
+
+    def get_servo_profile(self, default=''):
+        self.logger.debug('default=%s', default)
+        return self.get_str(KEY_SERVO_PROFILE, default)
+
+    def get_v_max(self):
+        """ None: 設定なし """
+        self.logger.debug('')
+        try:
+            return self.get_intlist(KEY_V_MAX)
+        except KeyError:
+            return None
+
+    def get_a_max(self):
+        """ None: 設定なし """
+        self.logger.debug('')
+        try:
+            return self.get_intlist(KEY_A_MAX)
+        except KeyError:
+            return None
+
     def set_pin(self, v_list):
         self.logger.debug('v_list=%s', v_list)
         self.set_intlist(KEY_PIN, v_list)
@@ -9,6 +9,16 @@ send()にコマンド(文字列)を指定する。
 実行(モーター制御)は独立したスレッドで行う。
 このとき、現在の動作を「キリのいいところで」中断し、割り込む。
 
+コマンドは優先度クラス(安全停止 > マニュアル > 自動運転 > ダンス)ごとに
+キューイングされ、優先度の高いものから実行される。
+
+次のコマンドが待っている場合は、動作をつなぐ(blend)。
+同じ歩行が続く場合は、歩行を終えずに(ホームポジションに戻らずに)続け、
+ホームポジションから始まる動作は、姿勢が落ち着くまでの待ちを省く。
+
+set_velocity() で、歩行中に速度指令(前後, 旋回)を送り続けると、
+歩行を中断せずに、速さと曲がり方を変えられる(CMD_VEL)。
+
 ------------------------------------------------------------
 OttoPiCtrl -- コマンド制御 (動作実行スレッド)
  |
@@ -25,25 +35,166 @@ from OttoPiMotion import OttoPiMotion
 
 import pigpio
 import time
-import queue
 import threading
+import functools
+import collections
 
 from MyLogger import get_logger
 import click
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 
 
+class CmdScheduler:
+    """
+    優先度付きコマンドキュー
+
+    優先度クラス(0が最高)ごとにFIFOを持ち、優先度の高いクラスから取り出す。
+    同じクラスに同じコマンドが待っている場合は、追加しない(まとめる)。
+    """
+    def __init__(self, pri_n, debug=False):
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('pri_n=%d', pri_n)
+
+        self._pri_n = pri_n
+        self._q = [collections.deque() for i in range(self._pri_n)]
+        self._cv = threading.Condition()
+
+        # 実行中のコマンドの優先度 (get() から done() まで)
+        self.cur_pri = None
+
+    def _put(self, cmd, pri):
+        if cmd in self._q[pri]:
+            self._log.debug('%s(pri=%d): coalesced', cmd, pri)
+            return False
+
+        self._q[pri].append(cmd)
+        self._cv.notify()
+        return True
+
+    def put(self, cmd, pri):
+        """
+        Returns
+        -------
+        result: bool
+            False: 同じコマンドが待っていたので追加しなかった
+        """
+        self._log.debug('cmd=%s, pri=%d', cmd, pri)
+        with self._cv:
+            return self._put(cmd, pri)
+
+    def preempt(self, cmd, pri, interrupt_func=None):
+        """
+        interrupt_func() を実行し、優先度 pri 以下の待ちコマンドを破棄して、
+        cmd を追加する。
+
+        実行中のコマンドの方が優先度が高い場合は、中断も破棄もせずに、
+        追加するだけ。
+
+        get() との間で排他されるので、取り出し直後のコマンドが
+        中断を取りこぼすことはない。
+        """
+        self._log.debug('cmd=%s, pri=%d, cur_pri=%s', cmd, pri, self.cur_pri)
+        with self._cv:
+            if self.cur_pri is not None and pri > self.cur_pri:
+                self._log.debug('%s(pri=%d): running pri=%d .. queued',
+                                cmd, pri, self.cur_pri)
+                return self._put(cmd, pri)
+
+            if interrupt_func is not None:
+                interrupt_func()
+
+            for p in range(pri, self._pri_n):
+                if len(self._q[p]) > 0:
+                    self._log.debug('pri=%d: %s: ignored', p, list(self._q[p]))
+                    self._q[p] = collections.deque()
+
+            return self._put(cmd, pri)
+
+    def get(self, get_func=None):
+        """
+        最も優先度の高いコマンドを取り出す (なければ待つ)
+
+        get_func() は、取り出したときに(排他したまま)実行される。
+
+        Returns
+        -------
+        (cmd, pri)
+        """
+        with self._cv:
+            while True:
+                for pri in range(self._pri_n):
+                    if len(self._q[pri]) > 0:
+                        cmd = self._q[pri].popleft()
+                        self.cur_pri = pri
+                        if get_func is not None:
+                            get_func()
+                        return (cmd, pri)
+
+                self._cv.wait()
+
+    def done(self):
+        """ get() したコマンドの実行が終わった """
+        with self._cv:
+            self.cur_pri = None
+
+    def peek(self):
+        """
+        次に取り出されるコマンド (取り出さない)
+
+        Returns
+        -------
+        cmd: str
+            None: 待っているコマンドがない
+        """
+        with self._cv:
+            for pri in range(self._pri_n):
+                if len(self._q[pri]) > 0:
+                    return self._q[pri][0]
+            return None
+
+    def empty(self):
+        with self._cv:
+            return all([len(q) == 0 for q in self._q])
+
+    def clear(self):
+        with self._cv:
+            self._q = [collections.deque() for i in range(self._pri_n)]
+
+
 class OttoPiCtrl(threading.Thread):
     CMD_HOME   = 'home'
     CMD_STOP   = 'stop'
     CMD_RESUME = 'resume'
     CMD_HELP   = 'help'
     CMD_END    = 'end'
-
-    def __init__(self, pi=None, debug=False):
+    CMD_VEL    = 'vel'  # 速度指令で歩く (set_velocity())
+
+    # 優先度クラス (小さいほど優先)
+    PRI_STOP   = 0  # 安全停止
+    PRI_MANUAL = 1  # マニュアル操作
+    PRI_AUTO   = 2  # 自動運転
+    PRI_DANCE  = 3  # ダンス
+    PRI_N      = 4
+
+    # 前の動作の途中の姿勢から続けられるコマンドと、その歩行の種類
+    #   (OttoPiMotion.walk(), suriashi() の gait と同じ)
+    CMD_GAIT = {
+        'forward':      ('walk', 'f'),
+        'backward':     ('walk', 'b'),
+        'suriashi_fwd': ('suriashi', 'f'),
+        CMD_VEL:        ('walk', 'f')}
+
+    def __init__(self, pi=None, blend=True, debug=False):
+        """
+        Parameters
+        ----------
+        blend: bool
+            次のコマンドが待っていれば、動作をつなぐ
+        """
         self._dbg = debug
         self._log = get_logger(__class__.__name__, self._dbg)
-        self._log.debug('pi=%s', str(pi))
+        self._log.debug('pi=%s, blend=%s', str(pi), blend)
 
         if type(pi) == pigpio.pi:
             self.pi   = pi
@@ -67,6 +218,7 @@ class OttoPiCtrl(threading.Thread):
             'right_backward': {'func': self.opm.right_backward, 'loop': True},
             'left_backward':  {'func': self.opm.left_backward,  'loop': True},
             'suriashi_fwd':   {'func': self.opm.suriashi,       'loop': True},
+            self.CMD_VEL:     {'func': self.opm.vel_walk,       'loop': True},
 
             'turn_right':     {'func': self.opm.turn_right,     'loop': True},
             'turn_left':      {'func': self.opm.turn_left,      'loop': True},
@@ -112,9 +264,29 @@ class OttoPiCtrl(threading.Thread):
             self.CMD_HELP:    {'func': self.help,               'loop': False},
             self.CMD_END :    {'func': None,                    'loop': False}}
 
-        self.cmdq = queue.Queue()
+        # モーションファイルで定義された動作
+        for name, motion in self.opm.motion_def.items():
+            if name in self.cmd_func:
+                self._log.warning('%s: already defined .. ignored', name)
+                continue
+
+            self.cmd_func[name] = {
+                'func': functools.partial(self.opm.motion_file, name),
+                'loop': motion['loop']}
+
+        self.cmdq = CmdScheduler(self.PRI_N, debug=self._dbg)
         self.active = False
 
+        # 動作のつなぎ
+        #   blend_next: 前のコマンドの終了時に、次のコマンドが待っていた
+        self.blend = blend
+        self.blend_next = False
+        self.opm.lookahead = self.lookahead
+
+        # 実行中のコマンド
+        self.cur_cmd  = None
+        self.cur_loop = False
+
         super().__init__(daemon=True)
 
     def end(self):
@@ -124,7 +296,7 @@ class OttoPiCtrl(threading.Thread):
         self.join()
 
         self.opm.end()
-        time.sleep(0.5)
+        self.opm.servo.clock.sleep(0.5)
         if self.mypi:
             self.pi.stop()
             self.mypi = False
@@ -133,9 +305,7 @@ class OttoPiCtrl(threading.Thread):
 
     def clear_cmdq(self):
         self._log.debug('')
-        while not self.cmdq.empty():
-            c = self.cmdq.get()
-            self._log.debug('%s: ignored', c)
+        self.cmdq.clear()
 
     def is_valid_cmd(self, cmd=''):
         self._log.debug('cmd = \'%s\'', cmd)
@@ -148,26 +318,96 @@ class OttoPiCtrl(threading.Thread):
         self._log.warn('')
         self.opm.stop()
 
-    def send(self, cmd, doInterrupt=True):
+    def send(self, cmd, doInterrupt=True, pri=PRI_MANUAL):
         """
         cmd: "<cmd_name> <cmd_n>"
+        doInterrupt: 実行中の動作を中断し、優先度 pri 以下の待ちを破棄する
+                     (実行中の動作の方が優先度が高ければ、待たせるだけ)
+        pri: 優先度クラス (stop, end は常に PRI_STOP)
         """
-        self._log.info('cmd=\'%s\' doInterrupt=%s', cmd, doInterrupt)
+        self._log.info('cmd=\'%s\' doInterrupt=%s, pri=%d',
+                       cmd, doInterrupt, pri)
 
         cmdline = cmd.split()
         self._log.info('cmdline=%s', cmdline)
 
-        if doInterrupt:
-            self.interrupt_loop()
-            self.clear_cmdq()
+        if len(cmdline) > 0 and cmdline[0] in [self.CMD_STOP, self.CMD_END]:
+            pri = self.PRI_STOP
+
+        if not doInterrupt:
+            self.cmdq.put(cmd, pri)
+            return
+
+        # 同じ連続動作を実行中で、待ちもなければ、割り込まない
+        if (cmd == self.cur_cmd and self.cur_loop and
+                not self.opm.stop_flag and self.cmdq.empty()):
+            self._log.info('\'%s\': already running .. coalesced', cmd)
+            return
+
+        self.cmdq.preempt(cmd, pri, self.interrupt_loop)
+
+    def set_velocity(self, vx, yaw):
+        """
+        速度指令 (ジョイスティックなどから、10..50Hz で送り続ける)
+
+        CMD_VEL の歩行中は、中断せずに、次の1歩から歩幅と旋回を変える。
+        同じ歩行(CMD_GAIT)のコマンドを実行中なら、CMD_VEL を中断せずに待たせ、
+        次の1歩の区切りで引き継ぐ(OttoPiMotion.walk())。
+        それ以外の場合は、CMD_VEL を送る(割り込む)。
+        指令が (0, 0) になるか、途切れる(OttoPiMotion.VEL_TIMEOUT)と止まる。
+
+        Parameters
+        ----------
+        vx, yaw: float
+            -1 .. 1 (OttoPiMotion.set_vel())
+        """
+        self._log.debug('vx=%s, yaw=%s', vx, yaw)
+
+        if not self.opm.set_vel(vx, yaw):
+            return
+
+        if self.cur_cmd == self.CMD_VEL and not self.opm.stop_flag:
+            return
+        if self.cmdq.peek() == self.CMD_VEL:
+            return
+
+        cur_name = (self.cur_cmd or '').split()[:1]
+        if (self.blend and len(cur_name) > 0 and not self.opm.stop_flag and
+                self.CMD_GAIT.get(cur_name[0]) ==
+                self.CMD_GAIT[self.CMD_VEL]):
+            self._log.debug('%s: same gait .. hand over', self.cur_cmd)
+            self.send(self.CMD_VEL, doInterrupt=False)
+            return
+
+        self.send(self.CMD_VEL)
+
+    def lookahead(self):
+        """
+        次に実行するコマンド (OttoPiMotion が動作のつなぎ方を決める)
+
+        Returns
+        -------
+        (cmd_name, gait): (str, tuple)
+            gait: CMD_GAIT  None: 途中の姿勢から続けられない
+            None: 待っているコマンドがない (つながない場合も)
+        """
+        if not self.blend:
+            return None
+
+        cmd = self.cmdq.peek()
+        if cmd is None or len(cmd.split()) == 0:
+            return None
 
-        self.cmdq.put(self.CMD_RESUME)
-        self.cmdq.put(cmd)
+        cmd_name = cmd.split()[0]
+        return (cmd_name, self.CMD_GAIT.get(cmd_name))
 
     def recv(self):
+        """
+        コマンドを取り出し、中断を解除(resume)する
+        """
         self._log.debug('')
-        cmd = self.cmdq.get()
-        self._log.debug('cmd=\'%s\'', cmd)
+        (cmd, pri) = self.cmdq.get(self.opm.resume)
+        self._log.debug('cmd=\'%s\', pri=%d', cmd, pri)
         return cmd
 
     def exec_cmd(self, cmd):
@@ -204,8 +444,26 @@ class OttoPiCtrl(threading.Thread):
             n = 0  # loop move
         self._log.debug('n=%d', n)
 
+        # 前のコマンドからのつなぎ
+        self.opm.blend_begin(self.CMD_GAIT.get(cmd_name),
+                             self.blend and self.blend_next)
+
         # コマンド実行
-        self.cmd_func[cmd_name]['func'](n)
+        self.cur_cmd  = cmd
+        self.cur_loop = (n == 0)
+        try:
+            self.cmd_func[cmd_name]['func'](n)
+        finally:
+            self.cur_cmd  = None
+            self.cur_loop = False
+            self.cmdq.done()
+
+        self.blend_next = not self.opm.stop_flag and not self.cmdq.empty()
+
+        # 中断された場合は、途中の姿勢から安全な姿勢に戻す
+        if self.opm.stop_flag and cmd_name != self.CMD_STOP:
+            self.opm.settle()
+
         return True
 
     def help(self, n=1):
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+歩行パラメータから、1歩ごとのキーフレームを作る
+
+パラメータ
+----------
+stride   歩幅 (OttoPiMotion の元の値に対する比, 0: 足踏み)
+lift     足を上げる(足首を傾ける)大きさ (比)
+turn     旋回 (-1 .. 1)  > 0: 右に曲がる (右足の歩幅を小さく, 左足を大きく)
+cadence  歩調 [歩/sec]  None: v (PiServo の速度)のまま
+
+パラメータは set() で、いつでも(別スレッドからでも)変更できる。
+歩行中は、1歩ごとに(step())、目標値に向けて少しずつ変化させるので、
+歩行を止めずに、速さや曲がり方を滑らかに変えられる。
+
+キーフレームは [((p1, p2, p3, p4), sleep_sec), ..] (OttoPiMotion.move1() の値)。
+
+------------------------------------------------------------
+OttoPiMotion -- 動作定義 (walk(), suriashi())
+ |
+ +- GaitGenerator
+------------------------------------------------------------
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+import threading
+import collections
+from MyLogger import get_logger
+
+
+GaitParam = collections.namedtuple('GaitParam',
+                                   ['stride', 'lift', 'turn', 'cadence'])
+
+
+class GaitGenerator:
+    """
+    Simple usage
+    ------------
+    gait = GaitGenerator()
+    gait.set(stride=1.2, turn=0.3)      # 別スレッドからでもよい
+
+    p = gait.step()                     # 1歩ごと
+    frames = gait.walk_frames('f', 'r', p.stride, p.lift, p.turn)
+    """
+    DEF_PARAM = GaitParam(stride=1.0, lift=1.0, turn=0.0, cadence=None)
+
+    STRIDE_RANGE  = (0.0, 1.5)
+    LIFT_RANGE    = (0.5, 1.3)
+    TURN_RANGE    = (-1.0, 1.0)
+    CADENCE_RANGE = (0.3, 3.0)  # 歩/sec
+
+    # 1歩あたりの変化の上限
+    RAMP = GaitParam(stride=0.25, lift=0.15, turn=0.25, cadence=0.5)
+
+    # キャッシュ(OttoPiMotion.compile_motion)が効くように丸める
+    ROUND_N = 2
+
+    # cadence から求める v の範囲 (速すぎると転ぶ)
+    V_RANGE = (0.3, 3.0)
+
+    # 基本の姿勢 (元の OttoPiMotion.walk1(), suriashi1() の値)
+    WALK_LIFT = (70, 20)
+    WALK_STRIDE = 30
+    WALK_PAUSE = 0.02  # sec
+    SURIASHI_LIFT = (40, 15)
+    SURIASHI_STRIDE = 25
+
+    def __init__(self, debug=False):
+        """ __init__ """
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('')
+
+        self._lock = threading.Lock()
+        self._target = self.DEF_PARAM
+        self._cur = self.DEF_PARAM
+
+    @staticmethod
+    def clip(x, x_range):
+        return min(max(x, x_range[0]), x_range[1])
+
+    def set(self, stride=None, lift=None, turn=None, cadence=None,
+            cadence_off=False):
+        """
+        目標値を変更する (None: そのまま)
+
+        Parameters
+        ----------
+        cadence_off: bool
+            True: cadence を None (v のまま) に戻す
+        """
+        self._log.debug('stride=%s, lift=%s, turn=%s, cadence=%s, '
+                        'cadence_off=%s', stride, lift, turn, cadence,
+                        cadence_off)
+
+        with self._lock:
+            t = self._target
+            if stride is not None:
+                t = t._replace(stride=self.clip(stride, self.STRIDE_RANGE))
+            if lift is not None:
+                t = t._replace(lift=self.clip(lift, self.LIFT_RANGE))
+            if turn is not None:
+                t = t._replace(turn=self.clip(turn, self.TURN_RANGE))
+            if cadence is not None:
+                t = t._replace(cadence=self.clip(cadence,
+                                                 self.CADENCE_RANGE))
+            if cadence_off:
+                t = t._replace(cadence=None)
+            self._target = t
+
+    def reset(self):
+        """ 目標値と現在値を、元の歩行に戻す """
+        self._log.debug('')
+        with self._lock:
+            self._target = self.DEF_PARAM
+            self._cur = self.DEF_PARAM
+
+    def target(self):
+        with self._lock:
+            return self._target
+
+    def current(self):
+        with self._lock:
+            return self._cur
+
+    def start(self):
+        """ 歩き始め: 現在値を目標値にする """
+        with self._lock:
+            self._cur = self._target
+            return self._cur
+
+    def step(self):
+        """
+        1歩進める: 現在値を目標値に近づける (RAMP まで)
+
+        cadence が None (v のまま) との間で変わる場合は、すぐに変える。
+
+        Returns
+        -------
+        param: GaitParam
+            この1歩のパラメータ
+        """
+        with self._lock:
+            cur, t = self._cur, self._target
+
+            p = {}
+            for k in ('stride', 'lift', 'turn'):
+                x0, x1, r = getattr(cur, k), getattr(t, k), getattr(self.RAMP,
+                                                                     k)
+                p[k] = round(x0 + self.clip(x1 - x0, (-r, r)), self.ROUND_N)
+
+            if t.cadence is None or cur.cadence is None:
+                p['cadence'] = t.cadence
+            else:
+                r = self.RAMP.cadence
+                p['cadence'] = round(
+                    cur.cadence + self.clip(t.cadence - cur.cadence, (-r, r)),
+                    self.ROUND_N)
+
+            self._cur = GaitParam(**p)
+            return self._cur
+
+    def walk_frames(self, mv, rl, stride=1.0, lift=1.0, turn=0.0):
+        """
+        walk の1歩
+
+        Parameters
+        ----------
+        mv: str
+            'f'orward, 'b'ackward, 'e'nd (足を揃えてホームポジションに戻る)
+        rl: str
+            'r'ight, 'l'eft
+
+        Returns
+        -------
+        frames: list of ((p1, p2, p3, p4), sleep_sec)
+        """
+        p1 = (self.WALK_LIFT[0] * lift, self.WALK_LIFT[1] * lift)
+        p2 = self.WALK_STRIDE * stride
+
+        if mv[0] == 'backward'[0]:
+            p2 = -p2
+
+        frames = []
+        if rl[0] == 'right'[0]:
+            p2 *= 1 - turn
+            frames.append(((p1[0], p2/2, 0, p1[1]), 0))
+            if mv[0] != 'end'[0]:
+                frames.append(((p1[0]/2, p2/2, p2/2, p1[1]), 0))
+
+        if rl[0] == 'left'[0]:
+            p2 *= 1 + turn
+            frames.append(((-p1[1], 0, -p2/2, -p1[0]), 0))
+            if mv[0] != 'end'[0]:
+                frames.append(((-p1[1], -p2/2, -p2/2, -p1[0]/2), 0))
+
+        if len(frames) > 0:
+            frames[-1] = (frames[-1][0], self.WALK_PAUSE)
+
+        if mv[0] == 'end'[0]:
+            frames.append(((0, 0, 0, 0), 0))
+            return frames
+
+        if rl[0] == 'right'[0]:
+            frames.append(((0, p2, p2, 0), 0))
+
+        if rl[0] == 'left'[0]:
+            frames.append(((0, -p2, -p2, 0), 0))
+
+        return frames
+
+    def suriashi_frames(self, mv, rl, stride=1.0, lift=1.0, turn=0.0):
+        """ suriashi の1歩 (walk_frames() と同じ) """
+        if mv[0] == 'end'[0]:
+            return [((0, 0, 0, 0), 0)]
+
+        if mv[0] != 'forward'[0]:
+            return []
+
+        p1 = self.SURIASHI_LIFT[0] * lift
+        p2 = self.SURIASHI_LIFT[1] * lift
+        p3 = self.SURIASHI_STRIDE * stride
+
+        if rl[0] == 'right'[0]:
+            p3 *= 1 - turn
+            return [((p1, p3, p3, p2), 0), ((-p2, p3, p3, -p1), 0)]
+
+        if rl[0] == 'left'[0]:
+            p3 *= 1 + turn
+            return [((-p2, -p3, -p3, -p1), 0), ((p1, -p3, -p3, p2), 0)]
+
+        return []
+
+    def cadence_v(self, frames, pos0, cadence, pulse_unit=10):
+        """
+        1歩の時間が 1/cadence 秒になる v (PiServo の PROFILE_LINEAR の場合)
+
+        PROFILE_LINEAR の移動時間は、最も大きく動くサーボの移動量 × v [msec]。
+
+        Parameters
+        ----------
+        frames: list
+            walk_frames() など
+        pos0: list of float
+            1歩の開始位置 (OttoPiMotion.get_cur_position())
+        pulse_unit: int
+            キーフレームの値 1 あたりのパルス幅
+
+        Returns
+        -------
+        v: float
+            V_RANGE の範囲に収める  None: 動かない
+        """
+        d = 0
+        pause = 0
+        p = pos0
+        for pos, sleep_sec in frames:
+            d += max([abs(pos[i] - p[i]) for i in range(len(pos))])
+            pause += sleep_sec
+            p = pos
+        if d == 0:
+            return None
+
+        msec = max(1000 / cadence - pause * 1000, 0)
+        v = msec / (d * pulse_unit)
+        return round(self.clip(v, self.V_RANGE), self.ROUND_N + 1)
+
+
+import click
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--stride', '-s', 'stride', type=float,
+              default=GaitGenerator.DEF_PARAM.stride, help='stride')
+@click.option('--lift', '-l', 'lift', type=float,
+              default=GaitGenerator.DEF_PARAM.lift, help='lift')
+@click.option('--turn', '-t', 'turn', type=float,
+              default=GaitGenerator.DEF_PARAM.turn, help='turn rate')
+@click.option('--cadence', '-c', 'cadence', type=float, default=None,
+              help='cadence [steps/sec]')
+@click.option('--count', '-n', 'count', type=int, default=4,
+              help='number of steps')
+@click.option('--debug', '-d', 'debug', is_flag=True, default=False,
+              help='debug flag')
+def main(stride, lift, turn, cadence, count, debug):
+    """ 歩き始めから、指定したパラメータに変化する各歩のキーフレームを表示 """
+    logger = get_logger(__name__, debug)
+    logger.debug('stride=%s, lift=%s, turn=%s, cadence=%s, count=%d',
+                 stride, lift, turn, cadence, count)
+
+    gait = GaitGenerator(debug=debug)
+    gait.start()
+    gait.set(stride, lift, turn, cadence)
+
+    pos = (0, 0, 0, 0)
+    rl = 'r'
+    for i in range(count):
+        p = gait.step()
+        frames = gait.walk_frames('f', rl, p.stride, p.lift, p.turn)
+        v = None
+        if p.cadence is not None:
+            v = gait.cadence_v(frames, pos, p.cadence)
+        print('%d: %s v=%s' % (i, p, v))
+        for f in frames:
+            print('    %s' % (f,))
+
+        pos = frames[-1][0]
+        rl = 'l' if rl == 'r' else 'r'
+
+
+if __name__ == '__main__':
+    main()
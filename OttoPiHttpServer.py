@@ -29,9 +29,10 @@ __date__   = '2019'
 
 import os
 import sys
+import threading
 from flask import Flask, render_template, request
 import netifaces
-from OttoPiClient import OttoPiClient
+from OttoPiClient import OttoPiClientPool
 from SpeakClient import SpeakClient
 from MyLogger import get_logger
 
@@ -50,6 +51,23 @@ FlagVideo = 'off'
 
 RobotHost = DEF_HOST
 RobotPort = DEF_PORT
+RobotPool = None
+RobotPoolLock = threading.Lock()
+
+
+def get_robot_pool():
+    """
+    OttoPiServerへの接続プール (最初に呼ばれたときに作る)
+
+    threaded で同時に呼ばれても、1つだけ作る
+    """
+    global RobotPool
+
+    with RobotPoolLock:
+        if RobotPool is None:
+            RobotPool = OttoPiClientPool(RobotHost, RobotPort)
+
+        return RobotPool
 
 
 def get_ipaddr():
@@ -101,9 +119,7 @@ def action():
     cmd = str(request.form['cmd'])
     print(MyName + ': cmd = \'' + cmd + '\'')
 
-    rc = OttoPiClient(RobotHost, RobotPort)
-    ret = rc.send_cmd(cmd)
-    rc.close()
+    ret = get_robot_pool().send_cmd(cmd)
 
     return ''
 
@@ -186,6 +202,8 @@ def main(robot_host, robot_port, debug):
         app.run(host='0.0.0.0', debug=debug)
     finally:
         logger.info('finally')
+        if RobotPool is not None:
+            RobotPool.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+コマンドの遅延(クライアント → サーボ出力)のベンチマーク
+
+ロボット制御サーバ(OttoPiServer)を、PiServoSim(出力を記録するだけの
+pigpio)と、一定の距離を返す距離センサーで動かし、
+各経路(transport)からコマンドを送って、途中の各段の時刻を記録する。
+
+transport
+---------
+tcp      OttoPiClient (framed mode, 接続したまま)
+tcp_new  OttoPiClient (コマンドごとに接続する、以前の OttoPiHttpServer)
+http     OttoPiHttpServer.action (Flaskの test_client)
+websock  OttoPiWebsockServer
+ble      OttoPiBleServer.CmdCharacteristic.onWriteRequest
+
+必要なモジュールがない transport は、スキップする。
+
+各段 (send からの経過時間 [msec])
+--------------------------------
+dispatch  サーバがコマンドを受信した (CmdDispatcher.dispatch)
+queue     OttoPiCtrl.send
+exec      動作実行スレッドがコマンドを取り出した (OttoPiCtrl.exec_cmd)
+servo     最初のサーボ出力
+reply     クライアントが返信を受け取った
+
+-----------------------------------------------------------------
+OttoPiLatencyBench
+ |
+ +- OttoPiClient, OttoPiHttpServer, OttoPiWebsockServer, ..
+     |
+     +- OttoPiServer (BenchServer)
+         |
+         +- OttoPiCtrl -- OttoPiMotion -- PiServo -- PiServoSim.pi
+         +- OttoPiAuto -- OttoPiSensor -- TraceTof
+-----------------------------------------------------------------
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+import time
+import json
+import asyncio
+import threading
+import PiServoSim
+
+# pigpiod がなくても動くように、OttoPiServer より先に置き換える
+PiServoSim.install()
+
+from PiServo import Clock
+from OttoPiServer import OttoPiServer
+from OttoPiClient import OttoPiClient, OttoPiClientPool
+from OttoPiSensor import OttoPiSensor
+from OttoPiAutoSim import TraceTof
+from MyLogger import get_logger, WARNING
+
+
+class BenchServer(OttoPiServer):
+    """ 続けて実行できるように、TIME_WAIT のポートも使う """
+    allow_reuse_address = True
+
+
+class HopStamp:
+    """
+    各段の時刻を記録する
+
+    インスタンスのメソッドを包んで、最初に呼ばれた時刻を記録する。
+    同時に送るコマンドは1つだけなので、clear() してから送る。
+    first が記録される前の呼び出し(前のコマンドの切断による stop など)は
+    記録しない。
+    """
+    def __init__(self, first):
+        self.first = first
+        self.t = {}
+
+    def clear(self):
+        self.t = {}
+
+    def stamp(self, hop):
+        if hop != self.first and self.first not in self.t:
+            return
+        self.t.setdefault(hop, time.monotonic())
+
+    def wrap(self, obj, method, hop):
+        func = getattr(obj, method)
+
+        def wrapper(*args, **kwargs):
+            self.stamp(hop)
+            return func(*args, **kwargs)
+
+        setattr(obj, method, wrapper)
+
+
+class OttoPiLatencyBench:
+    """
+    Simple usage
+    ------------
+    bench = OttoPiLatencyBench()
+    result = bench.run('tcp', 100)
+    bench.end()
+    """
+    DEF_PORT = 12346      # ロボットで動いているサーバと重ならないように
+    DEF_WS_PORT = 9002
+    DEF_DISTANCE = 1000   # mm (自動運転が反応しない距離)
+
+    TRANSPORTS = ('tcp', 'tcp_new', 'http', 'websock', 'ble')
+    HOPS = ('dispatch', 'queue', 'exec', 'servo', 'reply')
+
+    # サーボが少し動いて戻る
+    CMDS = (':move_up0 1', ':move_down0 1')
+
+    SAMPLE_TIMEOUT = 2.0  # sec
+    WARMUP_N = 3
+
+    def __init__(self, port=DEF_PORT, ws_port=DEF_WS_PORT, debug=False):
+        """ __init__ """
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('port=%d, ws_port=%d', port, ws_port)
+
+        self.port = port
+        self.ws_port = ws_port
+
+        # サーボ出力の時刻を、time.monotonic() と比べられるように実時間にする
+        self.pi = PiServoSim.pi(clock=Clock())
+
+        tof = TraceTof([(0.0, self.DEF_DISTANCE)], time.monotonic)
+        svr_dbg = self._dbg or WARNING
+        self.sensor = OttoPiSensor(tof, debug=svr_dbg)
+        self.sensor.start()
+
+        self.svr = BenchServer(self.pi, self.port, sensor=self.sensor,
+                               debug=svr_dbg)
+        self.svr_th = threading.Thread(target=self.svr.serve_forever,
+                                       daemon=True)
+        self.svr_th.start()
+
+        self.hop = HopStamp(self.HOPS[0])
+        disp = self.svr._disp
+        self.hop.wrap(disp, 'dispatch', 'dispatch')
+        self.hop.wrap(disp._ctrl, 'send', 'queue')
+        self.hop.wrap(disp._ctrl, 'exec_cmd', 'exec')
+
+        self.clients = []   # end() で close する
+        self.ws_svr = None
+        self.ws_loop = None
+
+    def end(self):
+        """ end """
+        self._log.debug('')
+
+        for cl in self.clients:
+            cl.close()
+
+        if self.ws_svr is not None:
+            self.ws_svr.loop.call_soon_threadsafe(self.ws_svr.loop.stop)
+
+        self.svr.shutdown()
+        self.svr.server_close()
+        self.svr.end()
+        self.sensor.end()
+
+        self._log.debug('done')
+
+    def open_tcp(self):
+        cl = OttoPiClient('localhost', self.port, framed=True)
+        self.clients.append(cl)
+        return cl.send_cmd
+
+    def open_tcp_new(self):
+        def send(cmd):
+            cl = OttoPiClient('localhost', self.port)
+            ret = cl.send_cmd(cmd)
+            cl.close()
+            return ret
+
+        return send
+
+    def open_http(self):
+        import OttoPiHttpServer
+
+        OttoPiHttpServer.RobotHost = 'localhost'
+        OttoPiHttpServer.RobotPort = self.port
+        self.clients.append(OttoPiHttpServer.get_robot_pool())
+
+        client = OttoPiHttpServer.app.test_client()
+
+        def send(cmd):
+            return client.post('/action', data={'cmd': cmd}).status_code
+
+        return send
+
+    def open_websock(self):
+        import websockets
+        from OttoPiWebsockServer import OttoPiWebsockServer
+
+        ready = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(asyncio.new_event_loop())
+            self.ws_svr = OttoPiWebsockServer(port=self.ws_port,
+                                              host='localhost',
+                                              svrport=self.port,
+                                              debug=self._dbg or WARNING)
+            self.ws_svr.loop.run_until_complete(self.ws_svr.start_server)
+            ready.set()
+            self.ws_svr.loop.run_forever()
+
+        threading.Thread(target=run, daemon=True).start()
+        ready.wait(self.SAMPLE_TIMEOUT)
+
+        uri = 'ws://localhost:%d' % (self.ws_port)
+        self.ws_loop = asyncio.new_event_loop()
+
+        async def send1(cmd):
+            async with websockets.connect(uri) as ws:
+                await ws.send(cmd)
+                return json.loads(await ws.recv())
+
+        def send(cmd):
+            return self.ws_loop.run_until_complete(send1(cmd))
+
+        return send
+
+    def open_ble(self):
+        from OttoPiBleServer import CmdCharacteristic, RespCharacteristic
+
+        pool = OttoPiClientPool('localhost', self.port)
+        self.clients.append(pool)
+
+        chara_resp = RespCharacteristic()
+        chara_cmd = CmdCharacteristic('localhost', self.port, chara_resp,
+                                      robot_pool=pool)
+
+        def send(cmd):
+            chara_cmd.onWriteRequest(cmd.encode('utf-8'), 0, False,
+                                     lambda result: None)
+            return bytes(chara_resp._value)
+
+        return send
+
+    def wait_done(self, t_send):
+        """
+        コマンドの実行が終わるまで待ち、最初のサーボ出力の時刻を記録する
+        """
+        ctrl = self.svr._disp._ctrl
+        t_end = time.monotonic() + self.SAMPLE_TIMEOUT
+        while time.monotonic() < t_end:
+            if 'exec' in self.hop.t and ctrl.cur_cmd is None and \
+               ctrl.cmdq.empty():
+                break
+            time.sleep(0.001)
+
+        for t, pin, width in self.pi.get_servo_log():
+            if t >= t_send:
+                self.hop.t['servo'] = t
+                break
+
+    def sample(self, send, cmd):
+        """
+        Returns
+        -------
+        msec: dict
+            {hop: send からの時間[msec]}  記録できなかった段はない
+        """
+        self.pi.clear_servo_log()
+        self.hop.clear()
+
+        t_send = time.monotonic()
+        send(cmd)
+        self.hop.t['reply'] = time.monotonic()
+
+        self.wait_done(t_send)
+
+        return {hop: (t - t_send) * 1000 for hop, t in self.hop.t.items()}
+
+    @staticmethod
+    def percentile(sorted_list, p):
+        if len(sorted_list) == 0:
+            return None
+        i = min(int(len(sorted_list) * p / 100), len(sorted_list) - 1)
+        return sorted_list[i]
+
+    def run(self, transport, count):
+        """
+        Returns
+        -------
+        result: dict
+            {'n': count, 'hops': {hop: {'p50':, 'p95':, 'p99':, 'lost':}}}
+            None: transport が使えない
+        """
+        self._log.debug('transport=%s, count=%d', transport, count)
+
+        try:
+            send = getattr(self, 'open_' + transport)()
+        except Exception as e:
+            self._log.warning('%s: skipped (%s:%s)',
+                              transport, type(e).__name__, e)
+            return None
+
+        samples = []
+        for i in range(self.WARMUP_N + count):
+            msec = self.sample(send, self.CMDS[i % len(self.CMDS)])
+            if i >= self.WARMUP_N:
+                samples.append(msec)
+
+        hops = {}
+        for hop in self.HOPS:
+            v = sorted([s[hop] for s in samples if hop in s])
+            hops[hop] = {'p50': self.percentile(v, 50),
+                         'p95': self.percentile(v, 95),
+                         'p99': self.percentile(v, 99),
+                         'lost': count - len(v)}
+
+        return {'n': count, 'hops': hops}
+
+
+def print_results(results):
+    print('%-8s %-8s %8s %8s %8s %5s' % (
+        'transport', 'hop', 'p50', 'p95', 'p99', 'lost'))
+
+    for transport, r in results.items():
+        if r is None:
+            print('%-8s (skipped)' % (transport))
+            continue
+
+        for hop in OttoPiLatencyBench.HOPS:
+            h = r['hops'][hop]
+            if h['p50'] is None:
+                print('%-8s %-8s %8s %8s %8s %5d' % (
+                    transport, hop, '-', '-', '-', h['lost']))
+                continue
+
+            print('%-8s %-8s %7.2fms %7.2fms %7.2fms %5d' % (
+                transport, hop, h['p50'], h['p95'], h['p99'], h['lost']))
+
+
+import click
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--transport', '-t', 'transport', multiple=True,
+              type=click.Choice(OttoPiLatencyBench.TRANSPORTS),
+              help='transport (default: all)')
+@click.option('--count', '-n', 'count', type=int, default=100,
+              help='number of commands for each transport')
+@click.option('--port', '-p', 'port', type=int,
+              default=OttoPiLatencyBench.DEF_PORT,
+              help='server port number')
+@click.option('--json', '-j', 'json_file', type=click.Path(), default=None,
+              help='write results to JSON file')
+@click.option('--debug', '-d', 'debug', is_flag=True, default=False,
+              help='debug flag')
+def main(transport, count, port, json_file, debug):
+    logger = get_logger(__name__, debug)
+    logger.debug('transport=%s, count=%d, port=%d', transport, count, port)
+
+    if len(transport) == 0:
+        transport = OttoPiLatencyBench.TRANSPORTS
+
+    bench = OttoPiLatencyBench(port, debug=debug)
+    try:
+        results = {t: bench.run(t, count) for t in transport}
+    finally:
+        logger.debug('finally')
+        bench.end()
+
+    if json_file is not None:
+        with open(json_file, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    print_results(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,21 +9,42 @@ PiServo を利用して、4個のサーボを制御し、歩行やダンスな
 
 また、OttoPiConfigで、設定ファイルから、GPIOピン番号とサーボの初期値を読み込む。
 
+モーションファイル(MOTION_DIR/*.json)に記述された動作も読み込む。
+
+  {
+    "name": "kick",      (省略時はファイル名)
+    "loop": false,       (コマンドの回数省略時に連続実行するか)
+    "mirror": true,      (true: "<name>_right"と左右反転した"<name>_left")
+    "v": null,           (速度: 省略時は PiServo の既定値)
+    "frames": [
+      [p1, p2, p3, p4],
+      [p1, p2, p3, p4, sleep_sec],
+      {"pos": [p1, p2, p3, p4], "sleep": sleep_sec, "v": v, "q": false},
+      ..
+    ]
+  }
+
 OttoPiMotion -- 動作定義
  |
  +- PiServo -- 複数サーボの同期制御
  +- OttoPiConfig -- 設定ファイルの読み込み・保存
+ +- GaitGenerator -- 歩行パラメータから、1歩ごとのキーフレームを作る
 
 '''
 
-from PiServo import PiServo
+from PiServo import PiServo, MODE_SLEEP, MODE_WAVE, PROFILE_LINEAR
 from OttoPiConfig import OttoPiConfig
+from OttoPiGait import GaitGenerator
 
 import pigpio
 import time
 import random
+import collections
+import os
+import glob
+import json
 
-from MyLogger import get_logger
+from MyLogger import get_logger, get_tracer
 
 
 DEF_PIN        = [17, 27, 22, 23]
@@ -33,11 +54,27 @@ DEF_PULSE_MAX  = [2500, 2500, 2500, 2500]
 
 N_CONTINUOUS = 99999
 
+MOTION_CACHE_SIZE = 64  # コンパイル済みモーションの保持数
+
+# 速度指令 (vel_walk())
+VEL_TIMEOUT     = 0.5   # sec: 指令が途切れたら歩行を終える (deadman)
+VEL_DEADBAND    = 0.05  # これより小さい指令は 0
+VEL_TURN_STRIDE = 0.5   # その場で旋回する時の歩幅 (yaw = 1)
+
+# 姿勢ごとの記録は、logger ではなくトレースで行う
+_trace = get_tracer()
+TR_MOVE1 = _trace.event('OttoPiMotion.move1')  # p1..p4 (x10)
+
+MOTION_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                          'motion')
+MOTION_EXT = '.json'
+
 
 class OttoPiMotion:
     """ OttoPiMotion """
     def __init__(self, pi=None, pin=[], pulse_home=[],
                  pulse_min=DEF_PULSE_MIN, pulse_max=DEF_PULSE_MAX,
+                 servo_mode='', servo_profile='', motion_dir=MOTION_DIR,
                  debug=False):
         """ __init__ """
         self.debug = debug
@@ -47,6 +84,9 @@ class OttoPiMotion:
         self.logger.debug('pulse_home = %s', pulse_home)
         self.logger.debug('pulse_min  = %s', pulse_min)
         self.logger.debug('pulse_max  = %s', pulse_max)
+        self.logger.debug('servo_mode = %s', servo_mode)
+        self.logger.debug('servo_profile = %s', servo_profile)
+        self.logger.debug('motion_dir = %s', motion_dir)
 
         if type(pi) == pigpio.pi:
             self.pi   = pi
@@ -73,8 +113,46 @@ class OttoPiMotion:
         self.pulse_min = pulse_min
         self.pulse_max = pulse_max
 
+        if servo_mode != '':
+            self.servo_mode = servo_mode
+        else:
+            self.servo_mode = self.cnf.get_servo_mode(MODE_SLEEP)
+            self.logger.debug('servo_mode = %s', self.servo_mode)
+
+        if servo_profile != '':
+            self.servo_profile = servo_profile
+        else:
+            self.servo_profile = self.cnf.get_servo_profile(PROFILE_LINEAR)
+            self.logger.debug('servo_profile = %s', self.servo_profile)
+
+        # None: PiServo のデフォルト
+        self.v_max = self.cnf.get_v_max()
+        self.a_max = self.cnf.get_a_max()
+        self.logger.debug('v_max = %s, a_max = %s', self.v_max, self.a_max)
+
         self.stop_flag = False
 
+        # 動作のつなぎ (OttoPiCtrl が設定する)
+        #   lookahead(): 次に実行するコマンド (cmd_name, gait) or None
+        #   blend_in: 前のコマンドから待たずに続けて実行する
+        #   gait_state: 終えずに残した歩行 (gait, func, rl, v, q)
+        self.lookahead = None
+        self.blend_in = False
+        self.gait_state = None
+
+        # 歩行パラメータ (歩行中でも、別スレッドから変更できる)
+        self.gait = GaitGenerator(debug=self.debug)
+
+        # 速度指令 (vx, yaw, 時刻)  set_vel() で、まとめて置き換える
+        self.vel_cmd = (0.0, 0.0, 0.0)
+
+        # コンパイル済みモーション (LRU)
+        self.motion_cache = collections.OrderedDict()
+
+        # モーションファイルで定義された動作
+        self.motion_def = {}
+        self.load_motion_dir(motion_dir)
+
         self.servo = None
         self.reset_servo()
 
@@ -84,18 +162,25 @@ class OttoPiMotion:
 
     def reset_servo(self):
         self.logger.debug('')
+        if self.servo is not None:
+            self.servo.end()
         del(self.servo)
         self.servo = PiServo(self.pi, self.pin,
                              self.pulse_home, self.pulse_min, self.pulse_max,
+                             mode=self.servo_mode,
+                             profile=self.servo_profile,
+                             v_max=self.v_max, a_max=self.a_max,
                              debug=self.debug)
         self.servo.home()
 
     def end(self):
         self.logger.debug('')
 
+        self.finish_gait()
         self.home()
-        time.sleep(1)
+        self.servo.clock.sleep(1)
         self.off()
+        self.servo.end()
 
         if self.mypi:
             self.pi.stop()
@@ -108,15 +193,124 @@ class OttoPiMotion:
     def stop(self, n=1):
         self.logger.debug('n = %d', n)
         self.stop_flag = True
+        self.servo.stop()
 
     def resume(self, n=1):
         self.logger.debug('n = %d', n)
         self.stop_flag = False
+        self.servo.resume()
+
+    def settle(self, v=None):
+        """
+        中断された動作の途中の姿勢から、ホームポジションに戻す
+
+        stop_flag はそのまま (次の resume まで連続動作は再開しない)。
+        """
+        self.logger.debug('v=%s', v)
+        self.logger.info('stop_stat=%s', self.get_stop_stat())
+        self.servo.resume()
+        self.home(v=v)
+
+    def get_stop_stat(self):
+        """ stop() から動作停止までの遅延 """
+        return self.servo.get_stop_stat()
 
     def home(self, n=1, v=None, q=False):
         self.logger.debug('n=%d, v=%s, q=%s', n, v, q)
         self.move1(0, 0, 0, 0, v=v, q=q)
 
+    def is_home(self):
+        """ ホームポジションにいるか """
+        return max([abs(self.servo.cur_pulse[i] - self.pulse_home[i])
+                    for i in range(len(self.pulse_home))]) < 1
+
+    def start_home(self, sec):
+        """
+        ホームポジションに移動し、姿勢が落ち着くまで sec 秒待つ (動作の開始)
+
+        前のコマンドから続けて実行する場合(blend_in)で、
+        すでにホームポジションにいれば、待たない。
+        """
+        blend = self.blend_in and self.is_home()
+        self.home()
+        if blend:
+            self.logger.debug('blend: skip sleep(%s)', sec)
+            return
+
+        self.sleep(sec)
+
+    def blend_begin(self, gait=None, blend=False):
+        """
+        コマンドの開始 (OttoPiCtrl から呼ばれる)
+
+        Parameters
+        ----------
+        gait: tuple
+            このコマンドの歩行の種類
+            残した歩行(gait_state)と違えば、先に終える
+        blend: bool
+            前のコマンドから待たずに続けて実行する
+        """
+        self.logger.debug('gait=%s, blend=%s', gait, blend)
+
+        if self.gait_state is not None and self.gait_state[0] != gait:
+            self.finish_gait()
+
+        self.blend_in = blend
+
+    def next_gait_is(self, gait):
+        """ 次に実行するコマンド(lookahead())が、同じ歩行か """
+        if self.lookahead is None:
+            return False
+
+        nxt = self.lookahead()
+        return nxt is not None and nxt[1] == gait
+
+    def keep_gait(self, gait, func, rl, v=None, q=False):
+        """
+        次のコマンドが同じ歩行なら、終わりの動作をせずに残す
+
+        Returns
+        -------
+        result: bool
+            True: 残した (gait_state)
+        """
+        if self.stop_flag or not self.next_gait_is(gait):
+            return False
+
+        self.logger.debug('keep: gait=%s, rl=%s', gait, rl)
+        self.gait_state = (gait, func, rl, v, q)
+        return True
+
+    def resume_gait(self, gait):
+        """
+        残した歩行の続きから始める
+
+        Returns
+        -------
+        rl: str
+            続きの足  None: 続きではない (違う歩行は終える)
+        """
+        if self.gait_state is None or self.gait_state[0] != gait:
+            self.finish_gait()
+            return None
+
+        rl = self.gait_state[2]
+        self.gait_state = None
+        self.blend_in = False
+        self.logger.debug('resume: gait=%s, rl=%s', gait, rl)
+        return rl
+
+    def finish_gait(self):
+        """ 残した歩行を終える (ホームポジションに戻る) """
+        if self.gait_state is None:
+            return
+
+        gait, func, rl, v, q = self.gait_state
+        self.gait_state = None
+        self.logger.debug('finish: gait=%s, rl=%s', gait, rl)
+        self.play_motion(func, 'end', rl, v=v, q=q, **self.gait_kwargs())
+
     def change_pos(self, i, d_pos, n=1, v=None, q=False):
         self.logger.debug('i=%d, d_pos=%d', i, d_pos)
 
@@ -166,6 +360,7 @@ class OttoPiMotion:
         cnf = OttoPiConfig(debug=self.debug)
         cnf.set_intlist('home', self.pulse_home)
         cnf.save()
+        self.motion_cache.clear()
         self.reset_servo()
 
     def home_up0(self, n=1):
@@ -209,23 +404,116 @@ class OttoPiMotion:
         return cur_pos
 
     def move(self, p_list=[], interval_msec=0, v=None, q=False):
-        self.logger.debug('p_list=%s, interval_msec=%d, v=%s, q=%s',
-                          p_list, interval_msec, v, q)
+        """ キーフレームの列をまとめて PiServo.move() に渡す """
+        pos_list = []
         for p in p_list:
             if p == []:
-                self.logger.debug('p=%s: ignored', p)
                 continue
-            self.move1(p[0], p[1], p[2], p[3], v, q)
-            time.sleep(interval_msec/1000)
+            if _trace.on:
+                _trace.rec(TR_MOVE1, p[0] * 10, p[1] * 10, p[2] * 10,
+                           p[3] * 10)
+            pos_list.append([p[0]*10, p[1]*10, p[2]*10, p[3]*10])
+
+        if len(pos_list) == 0:
+            return
+
+        self.blend_in = False
+        self.servo.move(pos_list, interval_msec, v, q)
 
     def move1(self, p1, p2, p3, p4, v=None, q=False):
-        self.logger.debug('(p1, p2, p3, p4)=%s, v=%s, q=%s',
-                          (p1, p2, p3, p4), v, q)
+        if _trace.on:
+            _trace.rec(TR_MOVE1, p1 * 10, p2 * 10, p3 * 10, p4 * 10)
+        self.blend_in = False
         self.servo.move1([p1*10, p2*10, p3*10, p4*10], v, q)
 
-    def change_rl(self, rl=''):
-        self.logger.debug('rl=%s', rl)
+    def sleep(self, sec):
+        self.servo.sleep(sec)
+
+    def play_frames(self, frames, v=None, q=False):
+        """ GaitGenerator のキーフレーム [((p1, p2, p3, p4), sleep_sec), ..] """
+        for pos, sleep_sec in frames:
+            self.move1(*pos, v=v, q=q)
+            if sleep_sec > 0:
+                self.sleep(sleep_sec)
 
+    def gait_step(self, frames_func, mv, rl, v=None):
+        """
+        歩行パラメータを1歩進め、この1歩の引数を求める
+
+        Parameters
+        ----------
+        frames_func: function
+            GaitGenerator.walk_frames など
+
+        Returns
+        -------
+        (v, kwargs): (float, dict)
+            cadence が None なら v はそのまま
+        """
+        p = self.gait.step()
+        kwargs = {'stride': p.stride, 'lift': p.lift, 'turn': p.turn}
+
+        if p.cadence is not None:
+            pos0 = [(self.servo.cur_pulse[i] - self.pulse_home[i]) / 10
+                    for i in range(len(self.pulse_home))]
+            v_cad = self.gait.cadence_v(frames_func(mv, rl, **kwargs), pos0,
+                                        p.cadence)
+            if v_cad is not None:
+                v = v_cad
+
+        return (v, kwargs)
+
+    def gait_kwargs(self):
+        """ 歩行の終わりの動作の引数 (現在の歩行パラメータ) """
+        p = self.gait.current()
+        return {'stride': p.stride, 'lift': p.lift, 'turn': p.turn}
+
+    def compile_motion(self, func, *args, **kwargs):
+        """
+        モーション関数の出力を、フレーム列 [(t_msec, pulse), ..] に変換する
+
+        同じ (関数, 引数, 開始位置, ホームポジション, 速度プロファイル) の
+        結果はキャッシュする。
+
+        Returns
+        -------
+        motion: (frames, total_msec)
+        """
+        key = (func.__name__, args, tuple(sorted(kwargs.items())),
+               tuple(self.servo.cur_pulse), tuple(self.pulse_home),
+               self.servo.profile)
+
+        motion = self.motion_cache.get(key)
+        if motion is not None:
+            self.motion_cache.move_to_end(key)
+            return motion
+
+        self.logger.debug('compile: %s', key)
+        self.servo.start_record()
+        try:
+            func(*args, **kwargs)
+        finally:
+            motion = self.servo.stop_record()
+
+        self.motion_cache[key] = motion
+        if len(self.motion_cache) > MOTION_CACHE_SIZE:
+            self.motion_cache.popitem(last=False)
+
+        return motion
+
+    def play_motion(self, func, *args, **kwargs):
+        """
+        コンパイル済みのフレーム列を再生する
+
+        MODE_WAVE の場合は、waveで出力するため、関数をそのまま実行する。
+        """
+        if self.servo.mode == MODE_WAVE:
+            func(*args, **kwargs)
+            return
+
+        self.servo.play(self.compile_motion(func, *args, **kwargs))
+
+    def change_rl(self, rl=''):
         if rl[0] == 'right'[0]:
             return 'left'
         if rl[0] == 'left'[0]:
@@ -243,7 +531,7 @@ class OttoPiMotion:
             if self.stop_flag:
                 break
 
-            func(rl, interval_msec=interval_msec, v=v, q=q)
+            self.play_motion(func, rl, interval_msec=interval_msec, v=v, q=q)
 
     def ojigi(self, n=1, interval_msec=1000, v=None, q=False):
         self.logger.debug('n=%d, interval_msec=%d, v=%s, q=%s',
@@ -256,8 +544,7 @@ class OttoPiMotion:
         p1 = [10, 15, 15]
         p2 = 85
 
-        self.home()
-        time.sleep(0.3)
+        self.start_home(0.3)
 
         for i in range(n):
             if self.stop_flag:
@@ -270,7 +557,7 @@ class OttoPiMotion:
                       interval_msec=500, v=v, q=q)
             self.move([[-p1[0], -p2, 0, 0],
                        [0, 0, 0, 0]], v=v, q=q)
-            time.sleep(interval_msec / 1000)
+            self.sleep(interval_msec / 1000)
 
     def ojigi2(self, n=1, interval_msec=1000, v=None, q=False):
         self.logger.debug('n=%d, interval_msec=%d, v=%s, q=%s',
@@ -280,8 +567,7 @@ class OttoPiMotion:
             n = N_CONTINUOUS
             self.logger.debug('n=%d!', n)
 
-        self.home()
-        time.sleep(0.3)
+        self.start_home(0.3)
 
         for i in range(n):
             if self.stop_flag:
@@ -293,7 +579,7 @@ class OttoPiMotion:
                        [0, 0, 0, 0]],
                       interval_msec=500)
 
-            time.sleep(interval_msec / 1000)
+            self.sleep(interval_msec / 1000)
 
     def happy(self, n=1, interval_msec=0, v=None, q=False):
         self.logger.debug('n=%d, interval_msec=%d, v=%s, q=%s',
@@ -306,8 +592,7 @@ class OttoPiMotion:
         p1 = 70
         p2 = 10
 
-        self.home()
-        time.sleep(0.3)
+        self.start_home(0.3)
 
         for i in range(n):
             if self.stop_flag:
@@ -317,12 +602,10 @@ class OttoPiMotion:
                        [0,  0, 0,  0],
                        [p2, 0, 0, -p1],
                        [0, 0, 0, 0]], v=v, q=q)
-            time.sleep(interval_msec / 1000)
+            self.sleep(interval_msec / 1000)
 
     def hi1(self, rl='r', interval_msec=0, v=None, q=False):
         """ hi1 """
-        self.logger.info('rl=%s, interval_msec=%d, v=%s, q=%s',
-                          rl, interval_msec, str(v), q)
         p1 = -65
         p2 = [0, -85]
         p3 = 0
@@ -333,20 +616,20 @@ class OttoPiMotion:
         if rl[0] == 'right'[0]:
             self.move1(p1, p2[0], p3, p4, v=v, q=q)
             self.move1(p1, p2[1], p3, p4, v=v, q=q)
-            time.sleep(0.5)
+            self.sleep(0.5)
             self.move1(p1, p2[0], p3, p4, v=v, q=q)
             self.move1(0, 0, 0, 0, v=v, q=q)
 
         if rl[0] == 'left'[0]:
             self.move1(-p4, -p3, -p2[0], -p1, v=v, q=q)
             self.move1(-p4, -p3, -p2[1], -p1, v=v, q=q)
-            time.sleep(0.5)
+            self.sleep(0.5)
             self.move1(-p4, -p3, -p2[0], -p1, v=v, q=q)
             self.move1(0, 0, 0, 0, v=v, q=q)
 
-        time.sleep(0.5)
+        self.sleep(0.5)
         self.home()
-        time.sleep(0.1)
+        self.sleep(0.1)
 
     def hi_right(self, n=1, interval_msec=0, v=None, q=False):
         self.logger.debug('n=%d, interval_msec=%d, v=%s, q=%s',
@@ -360,8 +643,6 @@ class OttoPiMotion:
 
     def bye1(self, rl='r', interval_msec=0, v=None, q=False):
         """ bye1 """
-        self.logger.debug('rl=%s, interval_msec=%d, v=%s, q=%s',
-                          rl, interval_msec, str(v), q)
         p1 = [-70, -60]
         p2 = [0, -85]
         p3 = 0
@@ -372,16 +653,16 @@ class OttoPiMotion:
         if rl[0] == 'right'[0]:
             self.move1(p1[0], p2[0], p3, p4, v=v, q=q)
             self.move1(p1[0], p2[1], p3, p4, v=v, q=q)
-            time.sleep(0.5)
+            self.sleep(0.5)
 
             self.move1(p1[1], p2[1], p3, p4, v=v, q=q)
-            time.sleep(0.1)
+            self.sleep(0.1)
             self.move1(p1[0], p2[1], p3, p4, v=v, q=q)
-            time.sleep(0.1)
+            self.sleep(0.1)
             self.move1(p1[1], p2[1], p3, p4, v=v, q=q)
-            time.sleep(0.1)
+            self.sleep(0.1)
             self.move1(p1[0], p2[1], p3, p4, v=v, q=q)
-            time.sleep(0.5)
+            self.sleep(0.5)
 
             self.move1(p1[0], p2[0], p3, p4, v=v, q=q)
             self.move1(0, 0, 0, 0, v=v, q=q)
@@ -389,23 +670,23 @@ class OttoPiMotion:
         if rl[0] == 'left'[0]:
             self.move1(-p4, -p3, -p2[0], -p1[0], v=v, q=q)
             self.move1(-p4, -p3, -p2[1], -p1[0], v=v, q=q)
-            time.sleep(0.5)
+            self.sleep(0.5)
 
             self.move1(-p4, -p3, -p2[1], -p1[1], v=v, q=q)
-            time.sleep(0.1)
+            self.sleep(0.1)
             self.move1(-p4, -p3, -p2[1], -p1[0], v=v, q=q)
-            time.sleep(0.1)
+            self.sleep(0.1)
             self.move1(-p4, -p3, -p2[1], -p1[1], v=v, q=q)
-            time.sleep(0.1)
+            self.sleep(0.1)
             self.move1(-p4, -p3, -p2[1], -p1[0], v=v, q=q)
-            time.sleep(0.5)
+            self.sleep(0.5)
 
             self.move1(-p4, -p3, -p2[0], -p1[0], v=v, q=q)
             self.move1(0, 0, 0, 0, v=v, q=q)
 
-        time.sleep(0.5)
+        self.sleep(0.5)
         self.home()
-        time.sleep(0.1)
+        self.sleep(0.1)
 
     def bye_right(self, n=1, interval_msec=0, v=None, q=False):
         self.logger.debug('n=%d, interval_msec=%d, v=%s, q=%s',
@@ -426,12 +707,11 @@ class OttoPiMotion:
             if self.stop_flag:
                 break
 
-            self.home()
-            time.sleep(.2)
+            self.start_home(.2)
             self.move1(-p1, 0, 0, p1, q=True)
-            time.sleep(.3)
+            self.sleep(.3)
             self.home()
-            time.sleep(0.3)
+            self.sleep(0.3)
 
     def slide_right(self, n=1, interval_msec=0, v=None, q=False):
         self.logger.debug('n=%d, interval_msec=%d, v=%s, q=%s',
@@ -444,14 +724,11 @@ class OttoPiMotion:
         self.cmd_n(self.slide1, 'l', n, interval_msec, v, q)
 
     def slide1(self, rl='r', interval_msec=0, v=None, q=False):
-        self.logger.debug('rl=%s, interval_msec=%d, v=%s, q=%s',
-                          rl, interval_msec, str(v), q)
-
         p1 = (80, 20)
         p2 = (-10, -60)
 
         self.home()
-        time.sleep(interval_msec / 1000)
+        self.sleep(interval_msec / 1000)
 
         if rl[0] == 'left'[0]:
             self.move([[p1[0], 0, 0, p1[1]],
@@ -473,38 +750,35 @@ class OttoPiMotion:
         v:
         q:
         """
-        self.logger.debug('rl=%s, interval_msec=%d, v=%s, q=%s',
-                          rl, interval_msec, str(v), q)
-
         p1 = (55, 20)
         p2 = (15, 5)
         p3 = 0.6
         sleep_sec = 0.1
 
         self.home()
-        time.sleep(interval_msec/1000)
+        self.sleep(interval_msec/1000)
 
         if rl[0] == 'left'[0]:
             self.move([[ p1[0],       p2[0],  p2[0],  p1[1]     ],
                        [ p1[0] * p3, -p2[0],  p2[0],  p1[1]     ],
                        [ 0,          -p2[0],  p2[0],  0         ]],
                       interval_msec=interval_msec, v=v, q=q)
-            time.sleep(sleep_sec)
+            self.sleep(sleep_sec)
             self.move([[-p1[1],      -p2[0],  p2[0], -p1[0]     ],
                        [-p1[1],       p2[1], -p2[1], -p1[0] * p3],
                        [0, 0, 0, 0]], interval_msec=interval_msec, v=v, q=q)
-            time.sleep(sleep_sec)
+            self.sleep(sleep_sec)
 
         if rl[0] == 'right'[0]:
             self.move([[-p1[1],      -p2[0], -p2[0], -p1[0]     ],
                        [-p1[1],      -p2[0],  p2[0], -p1[0] * p3],
                        [ 0,          -p2[0],  p2[0],  0         ]],
                       interval_msec=interval_msec, v=v, q=q)
-            time.sleep(sleep_sec)
+            self.sleep(sleep_sec)
             self.move([[ p1[0],      -p2[0],  p2[0],  p1[1]     ],
                        [ p1[0] * p3,  p2[1], -p2[1],  p1[1]     ],
                        [0, 0, 0, 0]], interval_msec=interval_msec, v=v, q=q)
-            time.sleep(sleep_sec)
+            self.sleep(sleep_sec)
 
     def right_forward(self, n=1, interval_msec=0, v=None, q=False):
         self.logger.debug('n=%d, interval_msec=%d, v=%s, q=%s',
@@ -544,66 +818,60 @@ class OttoPiMotion:
                           n, interval_msec, str(v), q)
         self.cmd_n(self.turn1, 'l', n, interval_msec, v, q)
 
-    def walk1(self, mv='f', rl='r', v=None, q=False):
-        """ walk1 """
-        self.logger.debug('mv=%s, rl=%s, v=%s, q=%s',
-                          mv, rl, str(v), q)
-
+    def walk1(self, mv='f', rl='r', v=None, q=False, stride=1.0, lift=1.0,
+              turn=0.0):
+        """ walk1 (キーフレームは GaitGenerator.walk_frames()) """
         if rl == '':
             return
 
-        p1 = (70, 20)
-        p2 = 30
-
-        if mv[0] == 'backward'[0]:
-            p2 = -p2
-
-        if rl[0] == 'right'[0]:
-            self.move1(     p1[0],   p2/2,     0, p1[1],    v=v, q=q)
-            if mv[0] != 'end'[0]:
-                self.move1( p1[0]/2, p2/2,  p2/2, p1[1],    v=v, q=q)
-
-        if rl[0] == 'left'[0]:
-            self.move1(    -p1[1],      0, -p2/2, -p1[0],   v=v, q=q)
-            if mv[0] != 'end'[0]:
-                self.move1(-p1[1],  -p2/2, -p2/2, -p1[0]/2, v=v, q=q)
-
-        time.sleep(.02)
-
-        if mv[0] == 'end'[0]:
-            self.home(v=v, q=q)
-            return
-
-        if rl[0] == 'right'[0]:
-            self.move1(0,  p2,  p2, 0, v=v, q=q)
-
-        if rl[0] == 'left'[0]:
-            self.move1(0, -p2, -p2, 0, v=v, q=q)
+        self.play_frames(self.gait.walk_frames(mv, rl, stride, lift, turn),
+                         v=v, q=q)
 
     def walk(self, n=1, mv='f', rl='', v=None, q=False):
-        """ walk    """
+        """
+        walk
+
+        連続歩行(n=0)中に、同じ歩行のコマンドが待っていれば、
+        1歩の区切りで終え、歩行を残して引き継ぐ(keep_gait())。
+        """
         self.logger.debug('n=%d, mv=%s rl=%s, v=%s, q=%s',
                           n, mv, rl, str(v), q)
 
+        loop = (n == 0)
         if n == 0:
             n = N_CONTINUOUS
             self.logger.debug('n=%d!', n)
 
-        if rl == '':
-            rl = 'rl'[random.randint(0, 1)]
-            self.logger.debug('rl=%s', rl)
+        gait = ('walk', mv)
+        rl_cont = self.resume_gait(gait)
+        if rl_cont is not None:
+            # 前のコマンドの歩行の続き (ホームポジションに戻らない)
+            rl = rl_cont
+        else:
+            if rl == '':
+                rl = 'rl'[random.randint(0, 1)]
+                self.logger.debug('rl=%s', rl)
 
-        self.home()
-        time.sleep(0.2)
+            self.start_home(0.2)
+            self.gait.start()
 
         for i in range(n):
             if self.stop_flag:
                 break
 
-            self.walk1(mv, rl, v=v, q=q)
+            v1, kwargs = self.gait_step(self.gait.walk_frames, mv, rl, v)
+            self.play_motion(self.walk1, mv, rl, v=v1, q=q, **kwargs)
             rl = self.change_rl(rl)
 
-        self.walk1('end', rl, v=v, q=q)
+            if loop and self.next_gait_is(gait):
+                self.logger.debug('hand over: gait=%s', gait)
+                break
+
+        if self.keep_gait(gait, self.walk1, rl, v=v, q=q):
+            return
+
+        self.play_motion(self.walk1, 'end', rl, v=v, q=q,
+                         **self.gait_kwargs())
 
     def forward(self, n=1, rl='', v=None, q=False):
         self.logger.debug('n=%d, rl=%s, v=%s, q=%s', n, rl, str(v), q)
@@ -613,42 +881,125 @@ class OttoPiMotion:
         self.logger.debug('n=%d, rl=%s, v=%s, q=%s', n, rl, str(v), q)
         self.walk(n, 'b', rl, v=v, q=q)
 
-    def suriashi1(self, mv='f', rl='r', v=None, q=False):
-        """ suriashi1 """
-        self.logger.debug('mv=%s, rl=%s, v=%s, q=%s',
-                          mv, rl, str(v), q)
+    def set_vel(self, vx, yaw):
+        """
+        速度指令 (OttoPiCtrl.set_velocity() から、別スレッドで呼ばれる)
+
+        Parameters
+        ----------
+        vx: float
+            前後 -1 .. 1  (> 0: 前進, 1: 最大の歩幅)
+        yaw: float
+            旋回 -1 .. 1  (> 0: 右)
+
+        Returns
+        -------
+        moving: bool
+            False: 止まる指令 (不感帯の中)
+        """
+        vx = min(max(vx, -1.0), 1.0)
+        yaw = min(max(yaw, -1.0), 1.0)
+        if abs(vx) < VEL_DEADBAND:
+            vx = 0.0
+        if abs(yaw) < VEL_DEADBAND:
+            yaw = 0.0
+
+        self.vel_cmd = (vx, yaw, self.servo.clock.time())
+        return vx != 0 or yaw != 0
+
+    def get_vel(self):
+        """ (vx, yaw)  指令が VEL_TIMEOUT 秒より古ければ (0, 0) """
+        vx, yaw, t = self.vel_cmd
+        if (vx != 0 or yaw != 0) and \
+           self.servo.clock.time() - t > VEL_TIMEOUT:
+            self.logger.warning('velocity command timeout (%.1f sec)',
+                                self.servo.clock.time() - t)
+            self.vel_cmd = (0.0, 0.0, t)
+            return (0.0, 0.0)
+
+        return (vx, yaw)
+
+    def vel_gait(self, vx, yaw, mv):
+        """
+        速度指令を、歩行パラメータの目標値にする
+
+        Returns
+        -------
+        mv: str
+            この1歩の向き (前後は、歩幅が 0 になってから変える)
+        """
+        mv_cmd = mv
+        if vx != 0:
+            mv_cmd = 'f' if vx > 0 else 'b'
+
+        stride = max(abs(vx) * GaitGenerator.STRIDE_RANGE[1],
+                     abs(yaw) * VEL_TURN_STRIDE)
+        if mv_cmd != mv:
+            if self.gait.current().stride > 0:
+                stride = 0.0
+            else:
+                mv = mv_cmd
+
+        self.gait.set(stride=stride, turn=yaw)
+        return mv
+
+    def vel_walk(self, n=0, v=None, q=False):
+        """
+        速度指令(set_vel())に従って歩く
 
-        p1 = 40
-        p2 = 15
-        p3 = 25
+        1歩ごとに指令を読むので、歩行を止めずに、速さと曲がり方が変わる。
+        指令が (0, 0) になるか、途切れる(VEL_TIMEOUT)と、歩行を終える。
+        """
+        self.logger.debug('n=%d, v=%s, q=%s', n, str(v), q)
 
-        if mv[0] == 'end'[0]:
-            self.home(v=v, q=q)
+        if n == 0:
+            n = N_CONTINUOUS
+            self.logger.debug('n=%d!', n)
+
+        vx, yaw = self.get_vel()
+        if vx == 0 and yaw == 0:
+            self.logger.debug('no velocity command')
             return
 
-        if rl[0] == 'right'[0]:
-            if mv[0] == 'forward'[0]:
-                self.move1(p1, p3, p3, p2, v=v, q=q)
-            else:
-                pass
+        # 速度指令で変えた目標値は、終わったら戻す
+        saved = self.gait.target()
 
-        if rl[0] == 'left'[0]:
-            if mv[0] == 'forward'[0]:
-                self.move1(-p2, -p3, -p3, -p1, v=v, q=q)
-            else:
-                pass
+        mv = 'f'
+        rl = self.resume_gait(('walk', mv))
+        if rl is None:
+            mv = 'b' if vx < 0 else 'f'
+            rl = 'rl'[random.randint(0, 1)]
+            self.start_home(0.2)
+            self.vel_gait(vx, yaw, mv)
+            self.gait.start()
 
-        if rl[0] == 'right'[0]:
-            if mv[0] == 'forward'[0]:
-                self.move1(-p2, p3, p3, -p1, v=v, q=q)
-            else:
-                pass
+        for i in range(n):
+            if self.stop_flag:
+                break
 
-        if rl[0] == 'left'[0]:
-            if mv[0] == 'forward'[0]:
-                self.move1(p1, -p3, -p3, p2, v=v, q=q)
-            else:
-                pass
+            vx, yaw = self.get_vel()
+            if vx == 0 and yaw == 0:
+                break
+
+            mv = self.vel_gait(vx, yaw, mv)
+            v1, kwargs = self.gait_step(self.gait.walk_frames, mv, rl, v)
+            self.play_motion(self.walk1, mv, rl, v=v1, q=q, **kwargs)
+            rl = self.change_rl(rl)
+
+        self.gait.set(saved.stride, saved.lift, saved.turn, saved.cadence,
+                      cadence_off=(saved.cadence is None))
+
+        if self.keep_gait(('walk', mv), self.walk1, rl, v=v, q=q):
+            return
+
+        self.play_motion(self.walk1, 'end', rl, v=v, q=q,
+                         **self.gait_kwargs())
+
+    def suriashi1(self, mv='f', rl='r', v=None, q=False, stride=1.0,
+                  lift=1.0, turn=0.0):
+        """ suriashi1 (キーフレームは GaitGenerator.suriashi_frames()) """
+        self.play_frames(self.gait.suriashi_frames(mv, rl, stride, lift, turn),
+                         v=v, q=q)
 
     def suriashi(self, n=1, mv='f', rl='', v=None, q=False):
         """ suriashi """
@@ -659,27 +1010,34 @@ class OttoPiMotion:
             n = N_CONTINUOUS
             self.logger.debug('n=%d!', n)
 
-        if rl == '':
-            rl = 'rl'[random.randint(0, 1)]
-            self.logger.debug('rl=%s', rl)
+        gait = ('suriashi', mv)
+        rl_cont = self.resume_gait(gait)
+        if rl_cont is not None:
+            rl = rl_cont
+        else:
+            if rl == '':
+                rl = 'rl'[random.randint(0, 1)]
+                self.logger.debug('rl=%s', rl)
 
-        self.home()
-        time.sleep(0.5)
+            self.start_home(0.5)
+            self.gait.start()
 
         for i in range(n):
             if self.stop_flag:
                 break
 
-            self.suriashi1(mv, rl, v=v, q=q)
+            v1, kwargs = self.gait_step(self.gait.suriashi_frames, mv, rl, v)
+            self.play_motion(self.suriashi1, mv, rl, v=v1, q=q, **kwargs)
             rl = self.change_rl(rl)
 
-        self.suriashi1('end', rl, v=v, q=q)
+        if self.keep_gait(gait, self.suriashi1, rl, v=v, q=q):
+            return
+
+        self.play_motion(self.suriashi1, 'end', rl, v=v, q=q,
+                         **self.gait_kwargs())
 
     def toe1(self, rl, n=3, v=None, q=False):
         """ toe1 """
-        self.logger.debug('rl=%s, n=%d, v=%s, q=%s',
-                          rl, n, v, q)
-
         interval_sec = 0.15
 
         p0 = [-13, 0]
@@ -692,15 +1050,15 @@ class OttoPiMotion:
         if rl[0] in 'rR':
             for i in range(n):
                 self.move1(p0[0], p1, p2, p3)
-                time.sleep(interval_sec)
+                self.sleep(interval_sec)
                 self.move1(p0[1], p1, p2, p3)
-                time.sleep(interval_sec)
+                self.sleep(interval_sec)
         else:
             for i in range(n):
                 self.move1(-p3, -p2, -p1, -p0[0])
-                time.sleep(interval_sec)
+                self.sleep(interval_sec)
                 self.move1(-p3, -p2, -p1, -p0[1])
-                time.sleep(interval_sec)
+                self.sleep(interval_sec)
 
         self.home()
 
@@ -718,8 +1076,6 @@ class OttoPiMotion:
 
     def heel1(self, rl, n=3, v=None, q=False):
         """ heel_right """
-        self.logger.debug('rl=%s, n=%d, v=%s, q=%s', n, v, q)
-
         interval_sec = 0.15
 
         p0 = [20, 0]
@@ -732,15 +1088,15 @@ class OttoPiMotion:
         if rl[0] in 'rR':
             for i in range(n):
                 self.move1(p0[0], p1, p2, p3)
-                time.sleep(interval_sec)
+                self.sleep(interval_sec)
                 self.move1(p0[1], p1, p2, p3)
-                time.sleep(interval_sec)
+                self.sleep(interval_sec)
         else:
             for i in range(n):
                 self.move1(-p3, -p2, -p1, -p0[0])
-                time.sleep(interval_sec)
+                self.sleep(interval_sec)
                 self.move1(-p3, -p2, -p1, -p0[1])
-                time.sleep(interval_sec)
+                self.sleep(interval_sec)
 
         self.home()
 
@@ -756,6 +1112,86 @@ class OttoPiMotion:
 
         self.heel1('left', n, v, q)
 
+    def load_motion_dir(self, motion_dir=MOTION_DIR):
+        """ motion_dir 以下のモーションファイルを全て読み込む """
+        self.logger.debug('motion_dir=%s', motion_dir)
+
+        for path in sorted(glob.glob(os.path.join(motion_dir,
+                                                  '*' + MOTION_EXT))):
+            try:
+                self.load_motion_file(path)
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                self.logger.warning('%s: %s:%s .. ignored',
+                                    path, type(e).__name__, e)
+
+        self.logger.debug('motion_def=%s', list(self.motion_def.keys()))
+
+    def load_motion_file(self, path):
+        """ モーションファイルを読み込んで、self.motion_def に登録する """
+        self.logger.debug('path=%s', path)
+
+        with open(path) as f:
+            motion = json.load(f)
+
+        if type(motion) != dict:
+            raise ValueError('not a JSON object')
+
+        name = motion.get('name',
+                          os.path.splitext(os.path.basename(path))[0])
+        v = motion.get('v', None)
+        if v is not None:
+            v = float(v)
+
+        frames = []
+        for fr in motion['frames']:
+            if type(fr) == list:
+                fr = {'pos': fr[:4], 'sleep': fr[4] if len(fr) > 4 else 0}
+
+            if len(fr['pos']) != 4:
+                raise ValueError('%s: invalid pos: %s' % (name, fr['pos']))
+
+            v1 = fr.get('v', v)
+            frames.append({'pos':   [float(p) for p in fr['pos']],
+                           'sleep': float(fr.get('sleep', 0)),
+                           'v':     None if v1 is None else float(v1),
+                           'q':     bool(fr.get('q', False))})
+
+        loop = bool(motion.get('loop', False))
+
+        if not motion.get('mirror', False):
+            self.motion_def[name] = {'loop': loop, 'frames': frames}
+            return
+
+        # 左右反転: [p1, p2, p3, p4] -> [-p4, -p3, -p2, -p1]
+        frames_l = []
+        for fr in frames:
+            fr_l = dict(fr)
+            fr_l['pos'] = [-p for p in reversed(fr['pos'])]
+            frames_l.append(fr_l)
+
+        self.motion_def[name + '_right'] = {'loop': loop, 'frames': frames}
+        self.motion_def[name + '_left'] = {'loop': loop, 'frames': frames_l}
+
+    def motion_file1(self, name):
+        """ モーションファイルの動作を1回実行する """
+        for fr in self.motion_def[name]['frames']:
+            p = fr['pos']
+            self.move1(p[0], p[1], p[2], p[3], v=fr['v'], q=fr['q'])
+            self.sleep(fr['sleep'])
+
+    def motion_file(self, name, n=1):
+        """ モーションファイルの動作を n回(0: 連続)実行する """
+        self.logger.debug('name=%s, n=%d', name, n)
+
+        if n == 0:
+            n = N_CONTINUOUS
+            self.logger.debug('n=%d!', n)
+
+        for i in range(n):
+            if self.stop_flag:
+                break
+
+            self.play_motion(self.motion_file1, name)
 
 
 class App:
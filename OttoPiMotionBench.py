@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+OttoPiMotion のベンチマーク
+
+OttoPiCtrl.cmd_func に登録されたコマンドを、PiServoSim(出力を記録する
+だけの pigpio)で実行し、コマンドごとに次の値を計測する。
+
+  sim_sec     動作時間 (時計の上の時間)
+  wall_msec   実際にかかった時間
+  cpu_msec    Python の CPU時間 (time.process_time)
+  write_n     サーボへの出力回数
+  pigpio_n    pigpiod とのやりとりの回数
+  frame_n     play() で出力したフレーム数
+  jitter_*    各フレームの出力時刻の、予定からの遅れ [msec](実時間)
+
+--speed 0 (VirtualClock) では待ち時間がないので、動作時間と
+Python の処理コストを速く計測できる(jitter は 0 になる)。
+jitter を計測するには、--speed 1 (実時間) で実行する。
+
+home_* (ホームポジションを変更して保存する) と stop, resume, help, end,
+vel (速度指令がないと動かない) は実行しない。
+
+--json で結果をファイルに保存し、--compare で以前の結果と比べられる。
+
+--seq では、指定したコマンドを(常に次のコマンドを待たせながら)続けて実行し、
+動作のつなぎ(OttoPiCtrl の blend)の有無で、全体の動作時間を比べる。
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+import sys
+import time
+import json
+import platform
+import PiServoSim
+from PiServoSim import VirtualClock, ScaledClock
+
+# pigpiod がなくても動くように、PiServo より先に置き換える
+PiServoSim.install()
+
+from PiServo import MODE_SLEEP, MODE_WAVE
+from OttoPiCtrl import OttoPiCtrl
+from MyLogger import get_logger, WARNING
+
+
+class OttoPiMotionBench:
+    """
+    Simple usage
+    ------------
+    bench = OttoPiMotionBench(speed=0)
+    results = bench.run()
+    bench.end()
+    """
+    SKIP_PREFIX = 'home_'
+
+    def __init__(self, cmds=(), speed=0, mode=None, repeat=1, debug=False):
+        """
+        Parameters
+        ----------
+        cmds: list of str
+            コマンド名 (): 全コマンド
+        speed: float
+            0: VirtualClock, それ以外: ScaledClock(speed)
+        mode: str
+            MODE_SLEEP, MODE_WAVE  None: 設定ファイルのまま
+        repeat: int
+            コマンドごとの実行回数 (時間は中央値)
+        """
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('cmds=%s, speed=%s, mode=%s, repeat=%d',
+                        cmds, speed, mode, repeat)
+
+        self.speed = speed
+        self.repeat = max(repeat, 1)
+
+        if self.speed > 0:
+            self.clock = ScaledClock(self.speed)
+        else:
+            self.clock = VirtualClock()
+
+        self.pi = PiServoSim.pi(clock=self.clock)
+
+        # コマンドごとのログは計測の邪魔なので、WARNING以上だけにする
+        self.robot_ctrl = OttoPiCtrl(self.pi, debug=self._dbg or WARNING)
+
+        self.opm = self.robot_ctrl.opm
+        if mode is not None and mode != self.opm.servo_mode:
+            self.opm.servo_mode = mode
+            self.opm.reset_servo()
+        self.mode = self.opm.servo_mode
+
+        skip = (OttoPiCtrl.CMD_STOP, OttoPiCtrl.CMD_RESUME,
+                OttoPiCtrl.CMD_HELP, OttoPiCtrl.CMD_END, OttoPiCtrl.CMD_VEL)
+        self.cmds = list(cmds)
+        if len(self.cmds) == 0:
+            self.cmds = [c for c in self.robot_ctrl.cmd_func
+                         if c not in skip and
+                         not c.startswith(self.SKIP_PREFIX)]
+        self._log.debug('cmds=%s', self.cmds)
+
+    def end(self):
+        """ end """
+        self._log.debug('')
+        self.opm.end()
+        self.pi.stop()
+        self._log.debug('done')
+
+    def info(self):
+        """ 計測条件 """
+        return {'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'host': platform.node(),
+                'python': platform.python_version(),
+                'speed': self.speed,
+                'mode': self.mode,
+                'repeat': self.repeat}
+
+    def run1(self, cmd):
+        """
+        コマンドを1回実行する (ホームポジションから)
+
+        Returns
+        -------
+        result: dict
+        """
+        self._log.debug('cmd=%s', cmd)
+
+        self.robot_ctrl.exec_cmd(self.robot_ctrl.CMD_HOME)
+        self.pi.clear_servo_log()
+
+        servo = self.opm.servo
+        servo.sched_log = []
+
+        t0 = self.clock.time()
+        cpu0 = time.process_time()
+        wall0 = time.perf_counter()
+
+        # 連続動作も1回だけ
+        self.robot_ctrl.exec_cmd('%s 1' % cmd)
+
+        wall_sec = time.perf_counter() - wall0
+        cpu_sec = time.process_time() - cpu0
+        sim_sec = self.clock.time() - t0
+
+        late = [max(t_out - t_sched, 0) for t_sched, t_out in servo.sched_log]
+        servo.sched_log = None
+
+        # 時計の上の時間 -> 実時間
+        if self.speed > 0:
+            late = [x / self.speed for x in late]
+
+        return {'sim_sec': sim_sec,
+                'wall_msec': wall_sec * 1000,
+                'cpu_msec': cpu_sec * 1000,
+                'write_n': len(self.pi.get_servo_log()),
+                'pigpio_n': self.pi.cmd_n,
+                'late_msec': [x * 1000 for x in late]}
+
+    @staticmethod
+    def percentile(sorted_list, p):
+        if len(sorted_list) == 0:
+            return 0.0
+        i = min(int(len(sorted_list) * p / 100), len(sorted_list) - 1)
+        return sorted_list[i]
+
+    def run_seq(self, blend=True):
+        """
+        コマンドを続けて実行する (ホームポジションから)
+
+        次のコマンドを1つキューに入れてから、コマンドを実行する
+        (クライアントが、常に次のコマンドを送ってある状態)。
+
+        Returns
+        -------
+        result: dict
+            {'sim_sec':, 'wall_msec':, 'cpu_msec':}
+        """
+        self._log.debug('blend=%s', blend)
+
+        ctrl = self.robot_ctrl
+        ctrl.blend = blend
+        ctrl.exec_cmd(ctrl.CMD_HOME)
+        ctrl.blend_next = False
+
+        pending = ['%s 1' % cmd for cmd in self.cmds]
+
+        t0 = self.clock.time()
+        cpu0 = time.process_time()
+        wall0 = time.perf_counter()
+
+        ctrl.cmdq.put(pending.pop(0), ctrl.PRI_MANUAL)
+        while not ctrl.cmdq.empty():
+            cmd = ctrl.recv()
+            if len(pending) > 0:
+                ctrl.cmdq.put(pending.pop(0), ctrl.PRI_MANUAL)
+            ctrl.exec_cmd(cmd)
+
+        wall_sec = time.perf_counter() - wall0
+        cpu_sec = time.process_time() - cpu0
+        sim_sec = self.clock.time() - t0
+
+        ctrl.blend = True
+        return {'sim_sec': sim_sec,
+                'wall_msec': wall_sec * 1000,
+                'cpu_msec': cpu_sec * 1000}
+
+    def run(self):
+        """
+        Returns
+        -------
+        results: dict
+            {'info': info(), 'cmds': {cmd: result, ..}}
+        """
+        self._log.debug('')
+
+        results = {}
+        for cmd in self.cmds:
+            r_list = [self.run1(cmd) for i in range(self.repeat)]
+
+            late = sorted(sum([r['late_msec'] for r in r_list], []))
+            r = {}
+            for k in ('sim_sec', 'wall_msec', 'cpu_msec',
+                      'write_n', 'pigpio_n'):
+                r[k] = sorted([r1[k] for r1 in r_list])[len(r_list) // 2]
+            r['frame_n'] = len(late) // self.repeat
+            r['jitter_mean_msec'] = sum(late) / max(len(late), 1)
+            r['jitter_p95_msec'] = self.percentile(late, 95)
+            r['jitter_max_msec'] = self.percentile(late, 100)
+            results[cmd] = r
+
+            self._log.debug('%s: %s', cmd, r)
+
+        return {'info': self.info(), 'cmds': results}
+
+
+def print_results(results, old=None):
+    """
+    Parameters
+    ----------
+    old: dict
+        以前の結果: cpu_msec と sim_sec の変化を表示する
+    """
+    print('# %s' % (json.dumps(results['info'])))
+    print('%-16s %8s %9s %8s %6s %6s %6s %7s %7s' % (
+        'cmd', 'sim_sec', 'wall_msec', 'cpu_msec', 'write', 'pigpio',
+        'frame', 'jit_p95', 'jit_max'), end='')
+    print('  cpu(old)  sim(old)' if old is not None else '')
+
+    for cmd, r in results['cmds'].items():
+        print('%-16s %8.3f %9.1f %8.1f %6d %6d %6d %7.2f %7.2f' % (
+            cmd, r['sim_sec'], r['wall_msec'], r['cpu_msec'], r['write_n'],
+            r['pigpio_n'], r['frame_n'], r['jitter_p95_msec'],
+            r['jitter_max_msec']), end='')
+
+        if old is None:
+            print()
+            continue
+
+        r0 = old['cmds'].get(cmd)
+        if r0 is None:
+            print('  (new)')
+            continue
+
+        print('  %+7.1f%%  %+7.3fs' % (
+            (r['cpu_msec'] / max(r0['cpu_msec'], 1e-9) - 1) * 100,
+            r['sim_sec'] - r0['sim_sec']))
+
+    total = {k: sum([r[k] for r in results['cmds'].values()])
+             for k in ('sim_sec', 'wall_msec', 'cpu_msec', 'write_n')}
+    print('total: sim=%.3fs wall=%.1fms cpu=%.1fms write=%d' % (
+        total['sim_sec'], total['wall_msec'], total['cpu_msec'],
+        total['write_n']))
+
+
+import click
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.argument('cmds', type=str, nargs=-1)
+@click.option('--speed', '-s', 'speed', type=float, default=0,
+              help='clock speed (0: virtual clock, 1: real time)')
+@click.option('--mode', '-m', 'mode',
+              type=click.Choice([MODE_SLEEP, MODE_WAVE]), default=None,
+              help='servo output mode')
+@click.option('--repeat', '-r', 'repeat', type=int, default=1,
+              help='repeat count for each command')
+@click.option('--json', '-j', 'json_file', type=click.Path(), default=None,
+              help='write results to JSON file (\'-\': stdout)')
+@click.option('--compare', '-c', 'compare_file',
+              type=click.Path(exists=True), default=None,
+              help='compare with previous JSON results')
+@click.option('--seq', '-S', 'seq', is_flag=True, default=False,
+              help='run cmds in sequence with/without blending')
+@click.option('--debug', '-d', 'debug', is_flag=True, default=False,
+              help='debug flag')
+def main(cmds, speed, mode, repeat, json_file, compare_file, seq, debug):
+    logger = get_logger(__name__, debug)
+    logger.debug('cmds=%s, speed=%s, mode=%s, repeat=%d, seq=%s',
+                 cmds, speed, mode, repeat, seq)
+
+    if seq:
+        bench = OttoPiMotionBench(cmds, speed, mode, debug=debug)
+        try:
+            for blend in (False, True):
+                r = bench.run_seq(blend)
+                print('blend=%-5s sim=%.3fs wall=%.1fms cpu=%.1fms' % (
+                    blend, r['sim_sec'], r['wall_msec'], r['cpu_msec']))
+        finally:
+            logger.debug('finally')
+            bench.end()
+        return
+
+    old = None
+    if compare_file is not None:
+        with open(compare_file) as f:
+            old = json.load(f)
+
+    bench = OttoPiMotionBench(cmds, speed, mode, repeat, debug=debug)
+    try:
+        results = bench.run()
+    finally:
+        logger.debug('finally')
+        bench.end()
+
+    if json_file == '-':
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
+
+    if json_file is not None:
+        with open(json_file, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    print_results(results, old)
+
+
+if __name__ == '__main__':
+    main()
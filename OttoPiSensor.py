@@ -0,0 +1,464 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+距離センサー読み込みスレッド
+
+VL53L0Xを計測周期(timing budget)ごとに読み込み、
+時刻付きの値をリングバッファ(collections.deque)に貯める。
+
+読む側(OttoPiAuto, サーバのスレッド)は、バッファを見るだけで、
+I2Cにはアクセスしない。
+deque の append() と [-1], copy() はスレッドセーフなので、ロックは使わない。
+
+さらに、サンプルごとにフィルター(DistanceFilter)で
+外れ値除去 → メディアン → 指数平滑 → 速度推定 を行い、
+推定値 (t, d, v) を別のリングバッファに貯める(estimate())。
+各段は固定長の窓だけを使うので、1サンプルあたりの計算量は一定。
+
+------------------------------------------------------------
+OttoPiAuto -- ロボットの自動運転 (自動運転スレッド)
+ |
+ +- OttoPiSensor -- 距離センサー読み込み (センサースレッド)
+ |   |
+ |   +- VL53L0X
+ |
+ +- OttoPiCtrl -- コマンド制御 (動作実行スレッド)
+------------------------------------------------------------
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+import time
+import collections
+import threading
+from MyLogger import get_logger
+
+
+class OutlierFilter:
+    """
+    外れ値除去
+
+    0以下(センサーの異常値)や、前回値からの急な変化は捨てる。
+    ただし、max_reject回続いた場合は、本当に変化したとみなして採用する。
+    0以下が続いた場合は、d_invalid(範囲外 = 遠い)とする。
+
+    本当に変化したとみなした値(と、範囲外から戻った値)は jumped を True にする。
+    """
+    DEF_MAX_JUMP = 500    # mm (1サンプルあたり)
+    DEF_MAX_REJECT = 3
+    DEF_D_INVALID = 8000  # mm
+
+    def __init__(self, max_jump=DEF_MAX_JUMP, max_reject=DEF_MAX_REJECT,
+                 d_invalid=DEF_D_INVALID):
+        self.max_jump = max_jump
+        self.max_reject = max_reject
+        self.d_invalid = d_invalid
+
+        self.prev_d = None
+        self.reject_n = 0
+        self.jumped = False
+
+    def reset(self):
+        self.prev_d = None
+        self.reject_n = 0
+        self.jumped = False
+
+    def update(self, t, d):
+        """
+        Returns
+        -------
+        d: int
+            None: 捨てた
+        """
+        self.jumped = False
+
+        if d <= 0:
+            self.reject_n += 1
+            if self.reject_n < self.max_reject:
+                return None
+
+            # 次の正常値は、急な変化でも採用する
+            self.prev_d = None
+            return self.d_invalid
+
+        if self.prev_d is not None and \
+                abs(d - self.prev_d) > self.max_jump:
+            self.reject_n += 1
+            if self.reject_n < self.max_reject:
+                return None
+            self.jumped = True
+
+        elif self.prev_d is None and self.reject_n >= self.max_reject:
+            # 範囲外から戻った
+            self.jumped = True
+
+        self.reject_n = 0
+        self.prev_d = d
+        return d
+
+
+class MedianFilter:
+    """ 直近n個のメディアン """
+    DEF_N = 3
+
+    def __init__(self, n=DEF_N):
+        self.win = collections.deque(maxlen=n)
+
+    def reset(self):
+        self.win.clear()
+
+    def update(self, t, d):
+        self.win.append(d)
+        return sorted(self.win)[len(self.win) // 2]
+
+
+class EmaFilter:
+    """ 指数平滑 (alpha: 新しい値の重み) """
+    DEF_ALPHA = 0.5
+
+    def __init__(self, alpha=DEF_ALPHA):
+        self.alpha = alpha
+        self.d = None
+
+    def reset(self):
+        self.d = None
+
+    def update(self, t, d):
+        if self.d is None:
+            self.d = d
+        else:
+            self.d += self.alpha * (d - self.d)
+        return self.d
+
+
+class VelocityEstimator:
+    """
+    速度推定 [mm/sec]
+
+    近づいている場合は負。差分を指数平滑する。
+    max_speedを超える変化は、不連続(範囲外との切り替わりなど)とみなし、
+    推定し直す。
+    """
+    DEF_ALPHA = 0.3
+    DEF_MAX_SPEED = 2000  # mm/sec
+
+    def __init__(self, alpha=DEF_ALPHA, max_speed=DEF_MAX_SPEED):
+        self.alpha = alpha
+        self.max_speed = max_speed
+        self.prev = None
+        self.v = 0.0
+
+    def reset(self):
+        self.prev = None
+        self.v = 0.0
+
+    def update(self, t, d):
+        if self.prev is not None:
+            dt = t - self.prev[0]
+            if dt > 0:
+                v1 = (d - self.prev[1]) / dt
+                if abs(v1) > self.max_speed:
+                    self.v = 0.0
+                else:
+                    self.v += self.alpha * (v1 - self.v)
+        self.prev = (t, d)
+        return self.v
+
+
+class DistanceFilter:
+    """
+    距離の推定 (フィルターの組み合わせ)
+
+    stagesの順に update(t, d) を呼ぶ。
+    途中で None を返した場合(外れ値)、そのサンプルは捨てる。
+    最後に velocity で速度を推定する。
+
+    途中の段が jumped を True にした場合(急に近づいた障害物など)、
+    後の段と velocity を reset() して、新しい値から始め直す。
+    メディアンや指数平滑の遅れで、避けるのが遅れないようにするため。
+
+    Simple usage
+    ------------
+    f = DistanceFilter()
+    est = f.update(t, d)   # (t, d, v) or None
+    """
+    def __init__(self, stages=None, velocity=None):
+        """
+        Parameters
+        ----------
+        stages: list
+            update(t, d) -> d or None と reset() を持つオブジェクトのリスト
+            None: 外れ値除去, メディアン, 指数平滑
+        velocity: VelocityEstimator
+        """
+        if stages is None:
+            stages = [OutlierFilter(), MedianFilter(), EmaFilter()]
+        if velocity is None:
+            velocity = VelocityEstimator()
+
+        self.stages = stages
+        self.velocity = velocity
+
+    def update(self, t, d):
+        """
+        Returns
+        -------
+        (t, d, v): (float, float, float)
+            None: 捨てた
+        """
+        for i, st in enumerate(self.stages):
+            d = st.update(t, d)
+            if d is None:
+                return None
+
+            if getattr(st, 'jumped', False):
+                for st2 in self.stages[i + 1:]:
+                    st2.reset()
+                self.velocity.reset()
+
+        return (t, d, self.velocity.update(t, d))
+
+
+class OttoPiSensor(threading.Thread):
+    """
+    距離センサー読み込みスレッド
+
+    Simple usage
+    ------------
+    sensor = OttoPiSensor()
+    sensor.start()
+
+    t, d = sensor.latest()         # 最新値 (時刻[sec], 距離[mm])
+    samples = sensor.window(0.5)   # 直近0.5秒分 [(t, d), ..]
+    t, d, v = sensor.estimate()    # フィルター後の距離と速度[mm/sec]
+
+    sensor.end()
+    """
+    DEF_BUF_SIZE = 64
+    DEF_INTERVAL = 0.05  # sec (計測周期が取得できない場合)
+
+    def __init__(self, tof=None, buf_size=DEF_BUF_SIZE, dist_filter=None,
+                 clock=time.monotonic, debug=False):
+        """
+        Parameters
+        ----------
+        tof: VL53L0X.VL53L0X
+            None: ここで作って、計測を開始する
+        buf_size: int
+            リングバッファのサイズ(サンプル数)
+        dist_filter: DistanceFilter
+            None: デフォルトの DistanceFilter
+        clock: function
+            サンプルの時刻 (シミュレーションでは仮想時刻)
+        """
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('tof=%s, buf_size=%d, dist_filter=%s',
+                        tof, buf_size, dist_filter)
+
+        self.my_tof = False
+        self.tof = tof
+        if self.tof is None:
+            # センサーがない環境でも import できるように、ここで import する
+            import VL53L0X as VL53L0X
+
+            self.my_tof = True
+            self.tof = VL53L0X.VL53L0X()
+            # self.tof.start_ranging(VL53L0X.VL53L0X_BEST_ACCURACY_MODE)
+            self.tof.start_ranging(VL53L0X.VL53L0X_BETTER_ACCURACY_MODE)
+
+        self.interval = self.tof.get_timing() / 1000000  # usec -> sec
+        if self.interval <= 0:
+            self.interval = self.DEF_INTERVAL
+        self._log.info('interval = %.02f ms', self.interval * 1000)
+
+        self.clock = clock
+        self.buf = collections.deque(maxlen=buf_size)
+        self.dist_filter = dist_filter
+        if self.dist_filter is None:
+            self.dist_filter = DistanceFilter()
+        self.est_buf = collections.deque(maxlen=buf_size)
+        self.reject_n = 0
+        self.sample_n = 0
+        self.err_n = 0
+        self.new_sample = threading.Event()
+
+        self.active = False
+
+        super().__init__(daemon=True)
+
+    def end(self):
+        """ end """
+        self._log.debug('')
+
+        self.active = False
+        if self.is_alive():
+            self.join()
+
+        if self.my_tof:
+            self.tof.stop_ranging()
+
+        self._log.debug('done')
+
+    def start(self):
+        """ start """
+        self._log.debug('')
+        self.active = True
+        super().start()
+
+    def read1(self):
+        """ センサーを1回読み込み、バッファに追加する """
+        try:
+            d = self.tof.get_distance()
+        except Exception as e:
+            self.err_n += 1
+            self._log.warning('%s:%s', type(e).__name__, e)
+            return None
+
+        sample = (self.clock(), d)
+        self.buf.append(sample)
+        self.sample_n += 1
+
+        est = self.dist_filter.update(*sample)
+        if est is None:
+            self.reject_n += 1
+            self._log.debug('rejected: %s', sample)
+        else:
+            self.est_buf.append(est)
+
+        self.new_sample.set()
+
+        return sample
+
+    def run(self):
+        """ run """
+        self._log.debug('')
+
+        t_next = time.monotonic()
+        while self.active:
+            self.read1()
+
+            # 計測周期に合わせる (遅れた場合は待たない)
+            t_next += self.interval
+            sleep_sec = t_next - time.monotonic()
+            if sleep_sec > 0:
+                time.sleep(sleep_sec)
+            else:
+                t_next = time.monotonic()
+
+        self._log.info('done(sample_n=%d, err_n=%d, reject_n=%d)',
+                       self.sample_n, self.err_n, self.reject_n)
+
+    def latest(self):
+        """
+        最新値
+
+        Returns
+        -------
+        (t, d): (float, int)
+            (None, None): まだ読み込んでいない
+        """
+        try:
+            return self.buf[-1]
+        except IndexError:
+            return (None, None)
+
+    def estimate(self):
+        """
+        フィルター後の最新の推定値
+
+        Returns
+        -------
+        (t, d, v): (float, float, float)
+            d: 距離[mm], v: 速度[mm/sec] (近づいている場合は負)
+            (None, None, None): まだ推定値がない
+        """
+        try:
+            return self.est_buf[-1]
+        except IndexError:
+            return (None, None, None)
+
+    def window(self, sec=None):
+        """
+        直近 sec 秒のサンプル (古い順)
+
+        Parameters
+        ----------
+        sec: float
+            None: バッファ全部
+        """
+        samples = self.buf.copy()
+        if sec is None or len(samples) == 0:
+            return list(samples)
+
+        t_min = samples[-1][0] - sec
+        return [s for s in samples if s[0] >= t_min]
+
+    def wait(self, timeout=None):
+        """
+        次のサンプルを待つ
+
+        スレッドが動いていない場合(read1()を直接呼ぶ場合)は、待たない。
+
+        Returns
+        -------
+        (t, d): latest()
+        """
+        if not self.active:
+            return self.latest()
+
+        self.new_sample.clear()
+        self.new_sample.wait(timeout)
+        return self.latest()
+
+
+class OttoPiSensorApp:
+    """ OttoPiSensorApp """
+    def __init__(self, debug=False):
+        """ init """
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, debug)
+        self._log.debug('')
+
+        self.sensor = OttoPiSensor(debug=self._dbg)
+        self.sensor.start()
+
+    def main(self):
+        """ main """
+        self._log.debug('')
+
+        while True:
+            time.sleep(1)
+            samples = self.sensor.window(1)
+            print('%d samples/sec, latest: %s, estimate: %s' % (
+                len(samples), self.sensor.latest(), self.sensor.estimate()))
+
+    def end(self):
+        """ end """
+        self._log.debug('')
+        self.sensor.end()
+        self._log.debug('done')
+
+
+import click
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--debug', '-d', 'debug', is_flag=True, default=False,
+              help='debug flag')
+def main(debug):
+    logger = get_logger(__name__, debug)
+
+    app = OttoPiSensorApp(debug=debug)
+    try:
+        app.main()
+    finally:
+        logger.info('finally')
+        app.end()
+
+
+if __name__ == '__main__':
+    main()
@@ -12,6 +12,25 @@ __date__   = '2020'
 
 自動運転のON/OFF、マニュアル操作が行える。
 
+ThreadingTCPServer版(接続ごとにスレッド)と、
+asyncio版(1スレッドで全接続を処理, --asyncio)がある。
+
+framed mode
+-----------
+接続後、最初の受信データが '{' で始まる場合、
+1行 1 JSON (改行区切り)のリクエスト/返信になる。
+リクエストIDで返信を対応付けられるので、複数コマンドを続けて送信できる。
+
+  request: {"ID": 1, "CMD": ":forward 2"}
+  reply:   {"ID": 1, "CMD": ":forward 2", "ACCEPT": true, "MSG": ""}
+
+velocity command
+----------------
+":vel <vx> <yaw>" (-1 .. 1) を 10..50Hz で送り続けると、
+歩行を中断せずに、速さと曲がり方を変えながら歩く(OttoPiCtrl.set_velocity)。
+":vel 0 0" を送るか、送るのをやめると止まる。
+framed mode で接続したまま送るとよい。
+
 -----------------------------------------------------------------
 OttoPiServer -- ロボット制御サーバ (ネットワーク送受信スレッド)
  |
@@ -26,16 +45,445 @@ OttoPiServer -- ロボット制御サーバ (ネットワーク送受信スレ
 -----------------------------------------------------------------
 """
 import time
+import math
 import socketserver
+import asyncio
+import concurrent.futures
 import json
 import pigpio
 
 from OttoPiCtrl import OttoPiCtrl
 from OttoPiAuto import OttoPiAuto
+from OttoPiSensor import OttoPiSensor
 from dance import Dance, Dance2
 from MyLogger import get_logger
 
 
+class CmdDispatcher:
+    """
+    受信したデータ(短縮文字、またはコマンド文字列)を解釈して、
+    OttoPiCtrl, OttoPiAuto, Dance に振り分ける
+
+    通信方式(ThreadingTCPServer, asyncio)に依存しない部分。
+    """
+    CMD_KEY = {
+        # auto switch commands
+        '@': 'auto_on',
+        ' ': 'auto_off',
+
+        # dance switch commands
+        '$': 'dance_on',
+        '%': 'donce_off',
+        '$': 'dance_true',
+        '%': 'donce_false',
+
+        # dance2 switch commands
+        '$': 'dance2_on',
+        '%': 'donce2_off',
+        '$': 'dance2_true',
+        '%': 'donce2_false',
+
+        # robot control commands
+        'w': 'forward',
+        'q': 'left_forward',
+        'e': 'right_forward',
+        'x': 'backward',
+        'W': 'suriashi_fwd',
+        'a': 'turn_left',
+        'd': 'turn_right',
+        'A': 'slide_left',
+        'D': 'slide_right',
+        '1': 'happy',
+        '2': 'hi_right',
+        '3': 'hi_left',
+        '4': 'bye_right',
+        '5': 'bye_left',
+        '6': 'surprised',
+        '8': 'ojigi',
+        '9': 'ojigi2',
+        't': 'toe_right',
+        'T': 'toe_right',
+        'h': 'heel_right',
+        'H': 'heel_right',
+        '0': 'home',
+
+        'h': 'move_up0',
+        'H': 'move_down0',
+        'j': 'move_up1',
+        'J': 'move_down1',
+        'k': 'move_up2',
+        'K': 'move_down2',
+        'l': 'move_up3',
+        'L': 'move_down3',
+
+        'u': 'home_up0',
+        'U': 'home_down0',
+        'i': 'home_up1',
+        'I': 'home_down1',
+        'o': 'home_up2',
+        'O': 'home_down2',
+        'p': 'home_up3',
+        'P': 'home_down3',
+
+        's': OttoPiCtrl.CMD_STOP,
+        'S': OttoPiCtrl.CMD_STOP,
+        '' : OttoPiCtrl.CMD_END}
+
+    CMD_PREFIX = ':'           # word command
+    CMD_PREFIX2 = '.'          # interupt off
+    CMD_AUTO_PREFIX = 'auto_'  # auto command
+
+    FRAME_START = b'{'         # framed mode (1行 1 JSON)
+    FRAME_SEP = b'\n'
+    FRAME_MAX = 4096           # 1行の最大長 (改行を送らない相手への対策)
+
+    def __init__(self, pi=None, sensor=None, debug=False):
+        """
+        Parameters
+        ----------
+        sensor: OttoPiSensor
+            None: ここで作る
+            (OttoPiAuto を作り直しても、同じセンサーを使い続ける)
+        """
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, debug)
+        self._log.debug('pi=%s, sensor=%s', pi, sensor)
+
+        if type(pi) == pigpio.pi:
+            self._pi   = pi
+            self._mypi = False
+        else:
+            self._pi   = pigpio.pi()
+            self._mypi = True
+        self._log.debug('mypi = %s', self._mypi)
+
+        self.cmd_key = self.CMD_KEY
+
+        self._ctrl = OttoPiCtrl(self._pi, debug=self._dbg)
+        self._ctrl.start()
+
+        self._my_sensor = False
+        self._sensor = sensor
+        if self._sensor is None:
+            self._my_sensor = True
+            self._sensor = OttoPiSensor(debug=self._dbg)
+            self._sensor.start()
+
+        self._auto = OttoPiAuto(self._ctrl, sensor=self._sensor,
+                                debug=self._dbg)
+        self._auto.start()
+
+        self._dance = None
+        self._dance2 = None
+
+    def end(self):
+        """ end """
+        self._log.debug('')
+
+        if self._auto.is_active():
+            self._auto.end()
+            self._log.debug('_auto thread: done')
+
+        if self._ctrl.is_active():
+            self._ctrl.end()
+            self._log.debug('_ctrl thread: done')
+
+        if self._my_sensor:
+            self._sensor.end()
+            self._my_sensor = False
+            self._log.debug('_sensor thread: done')
+
+        if self._mypi:
+            self._log.debug('clean up pigpio')
+            self._pi.stop()
+            self._mypi = False
+
+        self._log.debug('done')
+
+    def reply(self, cmd, accept=True, msg=''):
+        """ 返信データ (JSON文字列にして送信する) """
+        return {'CMD': cmd, 'ACCEPT': accept, 'MSG': msg}
+
+    def decode(self, net_data):
+        """
+        受信データをデコードし、コントロールキャラクターを削除する
+
+        Returns
+        -------
+        data: str
+            None: デコードできなかった
+        """
+        # デコード(UTF-8)
+        try:
+            decoded_data = net_data.decode('utf-8')
+        except UnicodeDecodeError as e:
+            self._log.warning('%s:%s .. ignored', type(e), e)
+            return None
+        else:
+            self._log.debug('decoded_data:%a', decoded_data)
+
+        # 文字列抽出(コントロールキャラクター削除)
+        data = ''
+        for ch in decoded_data:
+            if ord(ch) >= 0x20:
+                data += ch
+        self._log.debug('data=%a', data)
+
+        return data
+
+    def stop(self):
+        """ 通信異常時などの停止 """
+        self._log.warning('send: OttoPiCtrl.CMD_STOP')
+        self._ctrl.send(OttoPiCtrl.CMD_STOP)
+
+    def check_threads(self):
+        """ 制御スレッド、自動運転スレッドが動いていない場合は、再起動 """
+
+        # 制御スレッドが動いていない場合は(異常終了など?)、再起動
+        if not self._ctrl.is_active():
+            self._log.warning('robot control thread is dead !? .. restart')
+            self._ctrl = OttoPiCtrl(self._pi, debug=self._dbg)
+            self._ctrl.start()
+
+        # 自動運転スレッドが動いていない場合は(異常終了など?)、再起動
+        if not self._auto.is_active():
+            self._log.warning('auto control thread is dead !? .. restart')
+            self._auto = OttoPiAuto(self._ctrl, sensor=self._sensor,
+                                    debug=self._dbg)
+            self._auto.start()
+
+    def dispatch(self, data):
+        """
+        コマンドを実行する
+
+        Parameters
+        ----------
+        data: str
+            decode() 後の文字列 (空でないこと)
+
+        Returns
+        -------
+        replies: list of dict
+            reply() のリスト (1-key commandの場合は1文字ごと)
+        """
+        self._log.debug('data=%a', data)
+
+        self.check_threads()
+
+        # word command
+        #   ex. ":.forward 2", ":happy 1", ":auto_off"
+        if data[0] == self.CMD_PREFIX:
+            return [self.dispatch_word(data)]
+
+        # one-key command
+        return [self.dispatch_key(ch) for ch in data]
+
+    def split_frames(self, buf):
+        """
+        framed mode: 受信バッファを改行で区切る
+
+        Returns
+        -------
+        (lines, rest): (list of bytes, bytes)
+            rest: 改行が来ていない残り
+                  None: FRAME_MAX を超えた (残りは捨てる)
+        """
+        lines = buf.split(self.FRAME_SEP)
+        rest = lines.pop()
+        if len(rest) > self.FRAME_MAX:
+            self._log.warning('frame too long (%d bytes) .. dropped',
+                              len(rest))
+            rest = None
+        return [l for l in lines if l.strip()], rest
+
+    def frame_overflow(self):
+        """ framed mode: FRAME_MAX を超えた場合の返信 """
+        ret = self.reply('', False, 'invalid frame')
+        ret['ID'] = None
+        return ret
+
+    def dispatch_frame(self, line):
+        """
+        framed mode: 1行(JSON)を実行して、返信(ID付き)を返す
+
+        request: {"ID": 1, "CMD": ":forward 2"}
+        reply:   {"ID": 1, "CMD": ":forward 2", "ACCEPT": true, "MSG": ""}
+
+        1-key commandが複数文字の場合、"MSG"は1文字ごとの返信のリスト。
+        """
+        self._log.debug('line=%a', line)
+
+        if len(line) > self.FRAME_MAX:
+            self._log.warning('frame too long (%d bytes)', len(line))
+            return self.frame_overflow()
+
+        try:
+            req = json.loads(line.decode('utf-8'))
+            req_id = req['ID']
+            data = self.decode(str(req['CMD']).encode('utf-8'))
+        except (UnicodeDecodeError, ValueError, TypeError, KeyError) as e:
+            self._log.warning('%s:%s', type(e).__name__, e)
+            ret = self.reply(line.decode('utf-8', 'replace'),
+                             False, 'invalid frame')
+            ret['ID'] = None
+            return ret
+
+        if len(data) == 0:
+            ret = self.reply(data, False, 'no command')
+            ret['ID'] = req_id
+            return ret
+
+        replies = self.dispatch(data)
+        if len(replies) == 1:
+            ret = replies[0]
+        else:
+            ret = self.reply(data, all([r['ACCEPT'] for r in replies]),
+                             replies)
+        ret['ID'] = req_id
+        return ret
+
+    def dispatch_word(self, data):
+        """ word command """
+        cmd = data[1:]
+        interrupt_flag = True
+
+        if data[1:2] == self.CMD_PREFIX2:
+            cmd = data[2:]
+            interrupt_flag = False
+
+        if len(cmd.split()) == 0:
+            msg = 'invalid control command'
+            self._log.warning('%a: %s', cmd, msg)
+            return self.reply(data, False, msg)
+
+        cmd_name = cmd.split()[0]
+
+        # 速度指令は頻繁に来るので、ログは debug
+        if cmd_name == OttoPiCtrl.CMD_VEL:
+            return self.dispatch_vel(data, cmd)
+
+        self._log.info('cmd=%s, cmd_name=%s, interrupt_flag=%s',
+                       cmd, cmd_name, interrupt_flag)
+
+        """ dance """
+        # ダンスのスレッドは、終了を待たない
+        # (asyncio版では、他の接続のコマンドが待たされる)
+        if cmd_name in ['dance_on', 'dance_true']:
+            if self._dance2 is not None:
+                self._dance2.end(wait=False)
+                self._dance2 = None
+
+            if self._dance is None:
+                self._dance = Dance(self._ctrl, max_sleep_sec=3, debug=True)
+                self._dance.start()
+
+            return self.reply(data, True, '')
+
+        """ dance2 """
+        if cmd_name in ['dance2_on', 'dance2_true']:
+            if self._dance is not None:
+                self._dance.end(wait=False)
+                self._dance = None
+
+            if self._dance2 is None:
+                self._dance2 = Dance2(self._ctrl, max_sleep_sec=3, debug=True)
+                self._dance2.start()
+
+            return self.reply(data, True, '')
+
+        """ dance and dance2 off """
+        if cmd_name in ['dance_off', 'dance_false',
+                        'dance2_off', 'dance2_false']:
+            if self._dance is not None:
+                self._dance.end(wait=False)
+                self._dance = None
+
+            if self._dance2 is not None:
+                self._dance2.end(wait=False)
+                self._dance2 = None
+
+            return self.reply(data, True, '')
+
+        """ auto """
+        if cmd.startswith(self.CMD_AUTO_PREFIX):
+            """
+            auto command
+
+            注意
+            ----
+            auto commandは、回数パラメータがないため、
+            cmd_nameだけをsendする。
+
+            """
+            auto_cmd = cmd.replace(self.CMD_AUTO_PREFIX, '')
+            cmd_name = cmd_name.replace(self.CMD_AUTO_PREFIX, '')
+            self._log.info('auto_cmd=%s, cmd_name=%s', auto_cmd, cmd_name)
+
+            if cmd_name in self._auto.cmd_func.keys():
+                d = self._auto.send(cmd_name)
+                self._log.info('d=%smm', '{:,}'.format(d))
+
+                return self.reply(data, True, {'d': d})
+
+            self._log.warning('%s: invalid auto command', auto_cmd)
+            return self.reply(data, False, 'invalid auto command')
+
+        """ control command """
+        if cmd_name in self._ctrl.cmd_func.keys():
+            self._ctrl.send(cmd, interrupt_flag)
+            return self.reply(data, True, '')
+
+        msg = 'invalid control command'
+        self._log.warning('%s: %s', cmd, msg)
+        return self.reply(data, False, msg)
+
+    def dispatch_vel(self, data, cmd):
+        """
+        速度指令 "vel <vx> [<yaw>]"  (引数がなければ止まる)
+
+        歩行を中断しないので、割り込み(CMD_PREFIX2)の有無は関係ない。
+        """
+        self._log.debug('cmd=%s', cmd)
+
+        try:
+            vel = [float(x) for x in cmd.split()[1:3]]
+        except ValueError as e:
+            self._log.warning('%s: %s', cmd, e)
+            return self.reply(data, False, 'invalid velocity')
+
+        if not all([math.isfinite(x) for x in vel]):
+            self._log.warning('%s: invalid velocity', cmd)
+            return self.reply(data, False, 'invalid velocity')
+
+        vel += [0.0] * (2 - len(vel))
+        self._ctrl.set_velocity(vel[0], vel[1])
+        return self.reply(data, True, '')
+
+    def dispatch_key(self, ch):
+        """ one-key command """
+        self._log.info('ch=%a', ch)
+
+        if ch not in self.cmd_key.keys():
+            self._ctrl.send(OttoPiCtrl.CMD_STOP)
+            self._log.warning('invalid 1-key command:%a .. stop', ch)
+            return self.reply(ch, False, 'invalid 1-key command')
+
+        cmd = self.cmd_key[ch]
+        self._log.info('cmd=%s', cmd)
+
+        if cmd.startswith(self.CMD_AUTO_PREFIX):
+            # auto command
+            auto_cmd = cmd.replace(self.CMD_AUTO_PREFIX, '')
+            self._log.info('auto_cmd=%s', auto_cmd)
+
+            self._auto.send(auto_cmd)
+            return self.reply('%s(%s)' % (ch, cmd), True, '')
+
+        # control command
+        self._ctrl.send(cmd)
+        return self.reply('%s(%s)' % (ch, cmd), True, '')
+
+
 class ServerHandler(socketserver.StreamRequestHandler):
     """ server handler """
     def __init__(self, request, client_address, server):
@@ -44,74 +492,8 @@ class ServerHandler(socketserver.StreamRequestHandler):
         self._log = get_logger(__class__.__name__, self._dbg)
         self._log.debug('client_address: %s', client_address)
 
-        self._svr     = server
-        self._ctrl = server._ctrl
-        self._auto = server._auto
-        self._dance = None
-        self._dance2 = None
-
-        self.cmd_key = {
-            # auto switch commands
-            '@': 'auto_on',
-            ' ': 'auto_off',
-
-            # dance switch commands
-            '$': 'dance_on',
-            '%': 'donce_off',
-            '$': 'dance_true',
-            '%': 'donce_false',
-
-            # dance2 switch commands
-            '$': 'dance2_on',
-            '%': 'donce2_off',
-            '$': 'dance2_true',
-            '%': 'donce2_false',
-
-            # robot control commands
-            'w': 'forward',
-            'q': 'left_forward',
-            'e': 'right_forward',
-            'x': 'backward',
-            'W': 'suriashi_fwd',
-            'a': 'turn_left',
-            'd': 'turn_right',
-            'A': 'slide_left',
-            'D': 'slide_right',
-            '1': 'happy',
-            '2': 'hi_right',
-            '3': 'hi_left',
-            '4': 'bye_right',
-            '5': 'bye_left',
-            '6': 'surprised',
-            '8': 'ojigi',
-            '9': 'ojigi2',
-            't': 'toe_right',
-            'T': 'toe_right',
-            'h': 'heel_right',
-            'H': 'heel_right',
-            '0': 'home',
-
-            'h': 'move_up0',
-            'H': 'move_down0',
-            'j': 'move_up1',
-            'J': 'move_down1',
-            'k': 'move_up2',
-            'K': 'move_down2',
-            'l': 'move_up3',
-            'L': 'move_down3',
-
-            'u': 'home_up0',
-            'U': 'home_down0',
-            'i': 'home_up1',
-            'I': 'home_down1',
-            'o': 'home_up2',
-            'O': 'home_down2',
-            'p': 'home_up3',
-            'P': 'home_down3',
-
-            's': OttoPiCtrl.CMD_STOP,
-            'S': OttoPiCtrl.CMD_STOP,
-            '' : OttoPiCtrl.CMD_END}
+        self._svr  = server
+        self._disp = server._disp
 
         super().__init__(request, client_address, server)
 
@@ -135,11 +517,7 @@ class ServerHandler(socketserver.StreamRequestHandler):
         """ send_reply """
         self._log.debug('cmd=%s, accept=%s, msg=%s', cmd, accept, msg)
 
-        ret_str = json.dumps({
-            'CMD': cmd,
-            'ACCEPT': accept,
-            'MSG': msg
-        })
+        ret_str = json.dumps(self._disp.reply(cmd, accept, msg))
         self._log.debug('ret_str=%s', ret_str)
 
         ret = ret_str.encode('utf-8')
@@ -147,6 +525,13 @@ class ServerHandler(socketserver.StreamRequestHandler):
 
         self.net_write(ret)
 
+    def send_frame(self, reply):
+        """ framed mode: 返信を1行のJSONで送信 """
+        ret = json.dumps(reply).encode('utf-8') + CmdDispatcher.FRAME_SEP
+        self._log.info('ret=%a', ret)
+
+        self.net_write(ret)
+
     def handle(self):
         """ handle """
         self._log.debug('')
@@ -162,6 +547,7 @@ class ServerHandler(socketserver.StreamRequestHandler):
         self.net_write('#Ready\r\n'.encode('utf-8'))
 
         net_data = b''
+        frame_buf = None   # framed modeの場合、受信バッファ
         flag_continue = True
         while flag_continue:
             # データー受信
@@ -172,29 +558,37 @@ class ServerHandler(socketserver.StreamRequestHandler):
                 return
             except BaseException as e:
                 self._log.warning('BaseException:%s:%s.', type(e), e)
-                self._log.warning('send: OttoPiCtrl.CMD_STOP')
-                self._ctrl.send(OttoPiCtrl.CMD_STOP)
+                self._disp.stop()
                 return
             else:
                 self._log.debug('net_data:%a', net_data)
 
-            # デコード(UTF-8)
-            try:
-                decoded_data = net_data.decode('utf-8')
-            except UnicodeDecodeError as e:
-                self._log.warning('%s:%s .. ignored', type(e), e)
+            # framed mode: 最初の受信データが '{' で始まる場合
+            if frame_buf is None and \
+               net_data.startswith(CmdDispatcher.FRAME_START):
+                self._log.info('framed mode')
+                frame_buf = b''
+
+            if frame_buf is not None:
+                if len(net_data) == 0:
+                    self._log.debug('disconnected')
+                    break
+
+                lines, frame_buf = self._disp.split_frames(frame_buf +
+                                                           net_data)
+                for line in lines:
+                    self.send_frame(self._disp.dispatch_frame(line))
+                if frame_buf is None:
+                    # 長すぎる行: 返信して切断する
+                    self.send_frame(self._disp.frame_overflow())
+                    break
                 continue
-            else:
-                self._log.debug('decoded_data:%a', decoded_data)
 
-            self.net_write('\r\n'.encode('utf-8'))
+            data = self._disp.decode(net_data)
+            if data is None:
+                continue
 
-            # 文字列抽出(コントロールキャラクター削除)
-            data = ''
-            for ch in decoded_data:
-                if ord(ch) >= 0x20:
-                    data += ch
-            self._log.debug('data=%a', data)
+            self.net_write('\r\n'.encode('utf-8'))
 
             # 文字数が0の場合、コネクションが切断されたと判断し終了
             if len(data) == 0:
@@ -203,146 +597,8 @@ class ServerHandler(socketserver.StreamRequestHandler):
                 self.net_write((msg + '\r\n').encode('utf-8'))
                 break
 
-            # 制御スレッドが動いていない場合は(異常終了など?)、再起動
-            if not self._ctrl.is_active():
-                self._log.warning('robot control thread is dead !? .. restart')
-                self._svr._ctrl = OttoPiCtrl(self._svr._pi,
-                                             debug=self._svr._dbg)
-
-                self._ctrl = self._svr._ctrl
-                self._ctrl.start()
-
-            # 自動運転スレッドが動いていない場合は(異常終了など?)、再起動
-            if not self._auto.is_active():
-                self._log.warning('auto control thread is dead !? .. restart')
-                self._svr._auto = OttoPiAuto(self._ctrl, debug=self._svr._dbg)
-
-                self._auto = self._svr._auto
-                self._auto.start()
-
-            # word command
-            #   ex. ":.forward 2", ":happy 1", ":auto_off"
-            if data[0] == OttoPiServer.CMD_PREFIX:
-                cmd = data[1:]
-                interrupt_flag = True
-
-                if data[1] == OttoPiServer.CMD_PREFIX2:
-                    cmd = data[2:]
-                    interrupt_flag = False
-
-                cmd_name = cmd.split()[0]
-
-                self._log.info('cmd=%s, cmd_name=%s, interrupt_flag=%s',
-                               cmd, cmd_name, interrupt_flag)
-
-                """ dance """
-                if cmd_name in ['dance_on', 'dance_true']:
-                    if self._svr._dance2 is not None:
-                        self._svr._dance2.end()
-                        self._svr._dance2 = None
-                        
-                    if self._svr._dance is None:
-                        self._svr._dance = Dance(self._svr._ctrl,
-                                                 max_sleep_sec=3,
-                                                 debug=True)
-                        self._svr._dance.start()
-
-                    self.send_reply(data, True, '')
-                    continue
-
-                """ dance2 """
-                if cmd_name in ['dance2_on', 'dance2_true']:
-                    if self._svr._dance is not None:
-                        self._svr._dance.end()
-                        self._svr._dance = None
-
-                    if self._svr._dance2 is None:
-                        self._svr._dance2 = Dance2(self._svr._ctrl,
-                                                 max_sleep_sec=3,
-                                                 debug=True)
-                        self._svr._dance2.start()
-
-                    self.send_reply(data, True, '')
-                    continue
-
-                """ dance and dance2 off """
-                if cmd_name in ['dance_off', 'dance_false',
-                                'dance2_off', 'dance2_false']:
-                    if self._svr._dance is not None:
-                        self._svr._dance.end()
-                        self._svr._dance = None
-
-                    if self._svr._dance2 is not None:
-                        self._svr._dance2.end()
-                        self._svr._dance2 = None
-
-                    self.send_reply(data, True, '')
-                    continue
-
-                """ auto """
-                if cmd.startswith(OttoPiServer.CMD_AUTO_PREFIX):
-                    """
-                    auto command
-
-                    注意
-                    ----
-                    auto commandは、回数パラメータがないため、
-                    cmd_nameだけをsendする。
-
-                    """
-                    auto_cmd = cmd.replace(OttoPiServer.CMD_AUTO_PREFIX, '')
-                    cmd_name = cmd_name.replace(OttoPiServer.CMD_AUTO_PREFIX,
-                                                '')
-                    self._log.info('auto_cmd=%s, cmd_name=%s',
-                                   auto_cmd, cmd_name)
-
-                    if cmd_name in self._auto.cmd_func.keys():
-                        d = self._auto.send(cmd_name)
-                        self._log.info('d=%smm', '{:,}'.format(d))
-
-                        self.send_reply(data, True, {'d': d})
-                    else:
-                        self._log.warning('%s: invalid auto command', auto_cmd)
-                        self.send_reply(data, False, 'invalid auto command')
-
-                    continue
-
-                """ control command """
-                if cmd_name in self._ctrl.cmd_func.keys():
-                    self._ctrl.send(cmd, interrupt_flag)
-                    self.send_reply(data, True, '')
-                else:
-                    msg = 'invalid control command'
-                    self._log.warning('%s: %s', cmd, msg)
-                    self.send_reply(data, False, msg)
-
-                continue
-
-            # one-key command
-            for ch in data:
-                self._log.info('ch=%a', ch)
-
-                if ch not in self.cmd_key.keys():
-                    self._ctrl.send(OttoPiCtrl.CMD_STOP)
-                    self._log.warning('invalid 1-key command:%a .. stop', ch)
-                    self.send_reply(ch, False, 'invalid 1-key command')
-                    continue
-
-                cmd = self.cmd_key[ch]
-                self._log.info('cmd=%s', cmd)
-
-                if cmd.startswith(OttoPiServer.CMD_AUTO_PREFIX):
-                    # auto command
-                    auto_cmd = cmd.replace(OttoPiServer.CMD_AUTO_PREFIX, '')
-                    self._log.info('auto_cmd=%s', auto_cmd)
-
-                    self._auto.send(auto_cmd)
-                    self.send_reply('%s(%s)' % (ch, cmd), True, '')
-
-                else:
-                    # control command
-                    self._ctrl.send(cmd)
-                    self.send_reply('%s(%s)' % (ch, cmd), True, '')
+            for r in self._disp.dispatch(data):
+                self.send_reply(r['CMD'], r['ACCEPT'], r['MSG'])
 
         self._log.debug('done')
 
@@ -355,32 +611,17 @@ class ServerHandler(socketserver.StreamRequestHandler):
 class OttoPiServer(socketserver.ThreadingTCPServer):
     """ server """
     DEF_PORT = 12345
-    CMD_PREFIX = ':'           # word command
-    CMD_PREFIX2 = '.'          # interupt off
-    CMD_AUTO_PREFIX = 'auto_'  # auto command
+    CMD_PREFIX = CmdDispatcher.CMD_PREFIX
+    CMD_PREFIX2 = CmdDispatcher.CMD_PREFIX2
+    CMD_AUTO_PREFIX = CmdDispatcher.CMD_AUTO_PREFIX
 
-    def __init__(self, pi=None, port=DEF_PORT, debug=False):
+    def __init__(self, pi=None, port=DEF_PORT, sensor=None, debug=False):
         """ __init__ """
         self._dbg = debug
         self._log = get_logger(__class__.__name__, debug)
-        self._log.debug('pi=%s, port=%s', pi, port)
-
-        if type(pi) == pigpio.pi:
-            self._pi   = pi
-            self._mypi = False
-        else:
-            self._pi   = pigpio.pi()
-            self._mypi = True
-        self._log.debug('mypi = %s', self._mypi)
+        self._log.debug('pi=%s, port=%s, sensor=%s', pi, port, sensor)
 
-        self._ctrl = OttoPiCtrl(self._pi, debug=self._dbg)
-        self._ctrl.start()
-
-        self._auto = OttoPiAuto(self._ctrl, debug=self._dbg)
-        self._auto.start()
-
-        self._dance = None
-        self._dance2 = None
+        self._disp = CmdDispatcher(pi, sensor, debug=self._dbg)
 
         time.sleep(1)
 
@@ -395,38 +636,168 @@ class OttoPiServer(socketserver.ThreadingTCPServer):
     def end(self):
         """ end """
         self._log.debug('')
+        self._disp.end()
+        self._log.debug('done')
+
+    def _del_(self):
+        """ _del_ """
+        self._log.debug('')
+        self.end()
 
-        if self._auto.is_active():
-            self._auto.end()
-            self._log.debug('_auto thread: done')
 
-        if self._ctrl.is_active():
-            self._ctrl.end()
-            self._log.debug('_ctrl thread: done')
+class OttoPiAsyncServer:
+    """
+    asyncio版サーバ
 
-        if self._mypi:
-            self._log.debug('clean up pigpio')
-            self._pi.stop()
-            self._mypi = False
+    1スレッドで多数の接続を扱う(接続ごとにスレッドを作らない)。
+    プロトコルと返信形式は OttoPiServer と同じ。
+    コマンドの実行(OttoPiCtrl への送信, 距離センサーの読み込み)は、
+    イベントループを止めないように、1つのワーカースレッドで順番に行う。
+
+    注意
+    ----
+    ワーカーが1つなので、CmdDispatcher は排他しなくてよいが、
+    ブロックするコマンドがあると、その間、全ての接続の返信が遅れる。
+    CmdDispatcher.dispatch() に、待つ処理を入れないこと。
+    (OttoPiAuto.send() はセンサーを待たない。Dance.end() は wait=False)
+    """
+    DEF_PORT = OttoPiServer.DEF_PORT
+    RECV_SIZE = 512
+
+    def __init__(self, pi=None, port=DEF_PORT, sensor=None, debug=False):
+        """ __init__ """
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, debug)
+        self._log.debug('pi=%s, port=%s, sensor=%s', pi, port, sensor)
+
+        self._disp = CmdDispatcher(pi, sensor, debug=self._dbg)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+        self._port = port
+        self._svr = None
+
+    async def net_write(self, writer, msg):
+        """ net_write """
+        self._log.debug('msg=%s', msg)
+
+        try:
+            writer.write(msg)
+            await writer.drain()
+        except ConnectionError as e:
+            self._log.debug('%s:%s', type(e).__name__, e)
+
+    async def handle(self, reader, writer):
+        """ 1接続分の処理 """
+        self._log.debug('peer=%s', writer.get_extra_info('peername'))
+
+        loop = asyncio.get_running_loop()
+
+        await self.net_write(writer, '#Ready\r\n'.encode('utf-8'))
+
+        frame_buf = None   # framed modeの場合、受信バッファ
+        while True:
+            # データー受信
+            try:
+                net_data = await reader.read(self.RECV_SIZE)
+            except ConnectionError as e:
+                self._log.warning('%s:%s.', type(e), e)
+                break
+            except Exception as e:
+                self._log.warning('%s:%s.', type(e), e)
+                await loop.run_in_executor(self._executor, self._disp.stop)
+                break
+            else:
+                self._log.debug('net_data:%a', net_data)
+
+            # framed mode: 最初の受信データが '{' で始まる場合
+            if frame_buf is None and \
+               net_data.startswith(CmdDispatcher.FRAME_START):
+                self._log.info('framed mode')
+                frame_buf = b''
+
+            if frame_buf is not None:
+                if len(net_data) == 0:
+                    self._log.debug('disconnected')
+                    break
+
+                lines, frame_buf = self._disp.split_frames(frame_buf +
+                                                           net_data)
+                for line in lines:
+                    r = await loop.run_in_executor(self._executor,
+                                                   self._disp.dispatch_frame,
+                                                   line)
+                    ret = json.dumps(r).encode('utf-8') + \
+                        CmdDispatcher.FRAME_SEP
+                    self._log.info('ret=%a', ret)
+                    await self.net_write(writer, ret)
+                if frame_buf is None:
+                    # 長すぎる行: 返信して切断する
+                    ret = json.dumps(self._disp.frame_overflow()).encode(
+                        'utf-8') + CmdDispatcher.FRAME_SEP
+                    await self.net_write(writer, ret)
+                    break
+                continue
+
+            data = self._disp.decode(net_data)
+            if data is None:
+                continue
+
+            await self.net_write(writer, '\r\n'.encode('utf-8'))
 
+            # 文字数が0の場合、コネクションが切断されたと判断し終了
+            if len(data) == 0:
+                msg = 'No data .. disconnect'
+                self._log.warning(msg)
+                await self.net_write(writer, (msg + '\r\n').encode('utf-8'))
+                break
+
+            replies = await loop.run_in_executor(self._executor,
+                                                 self._disp.dispatch, data)
+            for r in replies:
+                ret = json.dumps(r).encode('utf-8')
+                self._log.info('ret=%a', ret)
+                await self.net_write(writer, ret)
+
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError as e:
+            self._log.debug('%s:%s', type(e).__name__, e)
         self._log.debug('done')
 
-    def _del_(self):
-        """ _del_ """
+    async def serve(self):
+        """ serve """
         self._log.debug('')
-        self.end()
+        self._svr = await asyncio.start_server(self.handle, '', self._port)
+        async with self._svr:
+            await self._svr.serve_forever()
+
+    def serve_forever(self):
+        """ serve_forever """
+        self._log.debug('')
+        asyncio.run(self.serve())
+
+    def end(self):
+        """ end """
+        self._log.debug('')
+        self._executor.shutdown(wait=True)
+        self._disp.end()
+        self._log.debug('done')
 
 
 class OttoPiServerApp:
     """ app """
-    def __init__(self, port, debug=False):
+    def __init__(self, port, use_asyncio=False, debug=False):
         """ init """
         self._dbg = debug
         self._log = get_logger(__class__.__name__, debug)
-        self._log.debug('port=%d', port)
+        self._log.debug('port=%d, use_asyncio=%s', port, use_asyncio)
 
         self._port = port
-        self._svr = OttoPiServer(None, self._port, debug=self._dbg)
+        if use_asyncio:
+            self._svr = OttoPiAsyncServer(None, self._port, debug=self._dbg)
+        else:
+            self._svr = OttoPiServer(None, self._port, debug=self._dbg)
 
     def main(self):
         self._log.debug('')
@@ -445,13 +816,15 @@ CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 
 @click.command(context_settings=CONTEXT_SETTINGS)
 @click.argument('port', type=int, default=OttoPiServer.DEF_PORT)
+@click.option('--asyncio', '-a', 'use_asyncio', is_flag=True, default=False,
+              help='asyncio server (single thread)')
 @click.option('--debug', '-d', 'debug', is_flag=True, default=False,
               help='debug flag')
-def main(port, debug):
+def main(port, use_asyncio, debug):
     _log = get_logger(__name__, debug)
-    _log.info('port=%d', port)
+    _log.info('port=%d, use_asyncio=%s', port, use_asyncio)
 
-    obj = OttoPiServerApp(port, debug=debug)
+    obj = OttoPiServerApp(port, use_asyncio, debug=debug)
     try:
         obj.main()
     finally:
@@ -8,8 +8,10 @@ OttoPi WebSocket Server
 __author__ = 'Yoichi Tanibayashi'
 __date__ = '2020'
 
-from OttoPiClient import OttoPiClient
+from OttoPiClient import OttoPiAsyncClient
+from OttoPiServer import CmdDispatcher
 import asyncio
+import json
 import websockets
 import time
 import click
@@ -30,6 +32,7 @@ class OttoPiWebsockServer():
 
         self.svrhost = svrhost
         self.svrport = svrport
+        self.robot = OttoPiAsyncClient(self.svrhost, self.svrport, debug=False)
 
         # websockets
         self.start_server = websockets.serve(self.handle, host, port)
@@ -46,6 +49,22 @@ class OttoPiWebsockServer():
 
     def end(self):
         self._log.debug('')
+        self.loop.run_until_complete(self.robot.close())
+
+    def web_reply(self, msg, ret):
+        """
+        framed mode の返信を、以前の(Web UIが受け取る)形にする
+
+        ID は除き、1-key commandが複数文字の場合は、最後の文字の返信
+        """
+        ret = dict(ret)
+        ret.pop('ID', None)
+
+        if not msg.startswith(CmdDispatcher.CMD_PREFIX) and \
+           isinstance(ret['MSG'], list) and len(ret['MSG']) > 0:
+            ret = ret['MSG'][-1]
+
+        return {k: ret[k] for k in ('CMD', 'ACCEPT', 'MSG')}
 
     async def handle(self, websocket, path):
         self._log.debug('websocket=%s:%s, path=%s',
@@ -55,13 +74,19 @@ class OttoPiWebsockServer():
         msg = await websocket.recv()
         self._log.debug('msg=%s', msg)
 
-        robot_client = OttoPiClient(self.svrhost, self.svrport, debug=False)
-        ret = robot_client.send_cmd(msg)
+        try:
+            ret = await self.robot.send_cmd(msg)
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            # ロボット制御サーバが応答しない場合も、Web UIには返信する
+            err = '%s:%s' % (type(e).__name__, e)
+            self._log.warning(err)
+            await websocket.send(json.dumps({'CMD': msg, 'ACCEPT': False,
+                                             'MSG': err}))
+            return
         self._log.debug('ret=%a', ret)
 
-        await websocket.send(ret)
+        await websocket.send(json.dumps(self.web_reply(msg, ret)))
 
-        robot_client.close()
         self._log.info('done')
 
 class App:
@@ -10,11 +10,26 @@ __date__   = '2019'
 
 import pigpio
 import time
-from MyLogger import MyLogger
+import math
+import threading
+from MyLogger import MyLogger, get_tracer
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # numpy がなければ、軌道は Python のループで計算する
 
 
 my_logger = MyLogger(__file__)
 
+# 補間ステップごとの記録は、logger ではなくトレースで行う
+_trace = get_tracer()
+TR_MOVE  = _trace.event('PiServo.trajectory') # frame_n, total[usec], quick
+TR_PULSE = _trace.event('PiServo.set_pulse')  # pulse[0..3]
+TR_SKIP  = _trace.event('PiServo.skip')       # frame, frame_n
+TR_OVER  = _trace.event('PiServo.overrun')    # frame, overrun[usec]
+TR_DONE  = _trace.event('PiServo.play')       # elapsed[usec], skip, overrun
+
 PULSE_OFF  = 0
 PULSE_MIN  = 500
 PULSE_MAX  = 2500
@@ -23,16 +38,140 @@ PULSE_HOME = 1500
 PULSE_STEP      = 10
 INTERVAL_FACTOR = 0.50
 
+# 出力方式
+#   MODE_SLEEP: Pythonで補間し、ステップごとに time.sleep() する
+#   MODE_WAVE:  補間結果を pigpio の waveform に変換し、DMAで出力する
+MODE_SLEEP = 'sleep'
+MODE_WAVE  = 'wave'
+
+WAVE_FRAME_USEC = 20000  # サーボのパルス周期 (50Hz)
+WAVE_POLL_SEC   = 0.005  # wave出力完了の確認間隔
+
+# 補間の速度プロファイル
+#   PROFILE_LINEAR:    一定速度 (PULSE_STEP 刻み, 速度・加速度の制限なし)
+#   PROFILE_TRAPEZOID: 台形 (最大加速度で加速, 最大速度で移動, 減速)
+#   PROFILE_SCURVE:    S字 (躍度最小の5次曲線, 加速度も連続)
+#   PROFILE_SPLINE:    3次スプライン (キーフレームで止まらずに通過する)
+# LINEAR 以外は、ピンごとの最大速度(v_max)・最大加速度(a_max)を超えない
+# 最短時間で移動し、PROFILE_FRAME_MSEC ごとに出力する。
+PROFILE_LINEAR    = 'linear'
+PROFILE_TRAPEZOID = 'trapezoid'
+PROFILE_SCURVE    = 'scurve'
+PROFILE_SPLINE    = 'spline'
+PROFILES = (PROFILE_LINEAR, PROFILE_TRAPEZOID, PROFILE_SCURVE, PROFILE_SPLINE)
+
+PROFILE_FRAME_MSEC = WAVE_FRAME_USEC / 1000
+
+# (v=INTERVAL_FACTOR の PROFILE_LINEAR は、2000 pulse/sec 一定)
+DEF_V_MAX = 4000   # pulse/sec
+DEF_A_MAX = 50000  # pulse/sec^2
+
+# S字(5次曲線)の、平均に対する最大速度・最大加速度の比
+SCURVE_V = 15 / 8
+SCURVE_A = 10 / math.sqrt(3)
+
+SPLINE_V_CHECK_N = 8  # 区間ごとに速度を確かめる点の数
+
+# 一括出力用 pigpio スクリプト
+#   値が変化した k 本のピンの set_servo_pulsewidth を1回の run_script で実行する
+#   'servo p0 p1 servo p2 p3 ..' (パラメータは ピン, パルス幅 の組)
+#   k ごとに1つ登録する (k <= SCRIPT_PARAM_MAX / 2)
+SCRIPT_PARAM_MAX    = 10   # p0 .. p9
+SCRIPT_INIT_TIMEOUT = 1.0  # sec
+
+STOP_LATENCY_WARN_MSEC = 50  # stop() から動作停止までの目標時間
+
 DEF_PIN = [17, 27, 22, 23]
 DEF_PULSE_HOME = [1500, 1500, 1500, 1500]
 DEF_PULSE_MIN  = [ 500,  500,  500,  500]
 DEF_PULSE_MAX  = [2500, 2500, 2500, 2500]
 
 
+class Clock:
+    """
+    実時間の時計
+
+    PiServo の時刻と待ち時間は、すべてこのインタフェースを通す。
+    シミュレーションでは、同じインタフェースの仮想時計
+    (PiServoSim.VirtualClock など)に置き換える。
+    """
+    def time(self):
+        return time.monotonic()
+
+    def sleep(self, sec):
+        time.sleep(sec)
+
+    def wait(self, ev, sec):
+        """ ev がセットされるか、sec 秒経つまで待つ (ev.wait() と同じ) """
+        return ev.wait(sec)
+
+
+def ease_trapezoid(tau, f):
+    """
+    台形プロファイルの位置
+
+    Parameters
+    ----------
+    tau: float
+        移動時間に対する割合 (0 .. 1)
+    f: float
+        加速(減速)時間の割合 (0 < f <= 0.5)
+
+    Returns
+    -------
+    s: float
+        移動量に対する割合 (0 .. 1)
+    """
+    vp = 1 / (1 - f)
+    if tau < f:
+        return vp * tau * tau / (2 * f)
+    if tau > 1 - f:
+        return 1 - vp * (1 - tau) ** 2 / (2 * f)
+    return vp * (tau - f / 2)
+
+
+def ease_scurve(tau):
+    """ S字プロファイル(躍度最小)の位置 (ease_trapezoid() と同じ) """
+    return tau ** 3 * (10 - 15 * tau + 6 * tau * tau)
+
+
+def hermite(u, h, p0, p1, m0, m1):
+    """
+    3次エルミート曲線
+
+    Parameters
+    ----------
+    u: float
+        区間内の位置 (0 .. 1)
+    h: float
+        区間の時間
+    p0, p1: float
+        両端の位置
+    m0, m1: float
+        両端の速度 (位置/時間)
+
+    Returns
+    -------
+    (p, v, a): (float, float, float)
+        位置, 速度, 加速度
+    """
+    u2 = u * u
+    u3 = u2 * u
+    p = ((2 * u3 - 3 * u2 + 1) * p0 + (u3 - 2 * u2 + u) * h * m0 +
+         (-2 * u3 + 3 * u2) * p1 + (u3 - u2) * h * m1)
+    v = ((6 * u2 - 6 * u) * (p0 - p1) + (3 * u2 - 4 * u + 1) * h * m0 +
+         (3 * u2 - 2 * u) * h * m1) / h
+    a = ((12 * u - 6) * (p0 - p1) + (6 * u - 4) * h * m0 +
+         (6 * u - 2) * h * m1) / (h * h)
+    return (p, v, a)
+
+
 class PiServo:
     """複数のサーボモーターを同期を取りながら同時に動かす"""
     def __init__(self, pi=None, pins=DEF_PIN,
                  pulse_home=None, pulse_min=None, pulse_max=None,
+                 mode=MODE_SLEEP, batch=True, clock=None,
+                 profile=PROFILE_LINEAR, v_max=None, a_max=None,
                  debug=False):
         self.debug = debug
         self.logger = my_logger.get_logger(__class__.__name__, debug)
@@ -41,6 +180,11 @@ class PiServo:
         self.logger.debug('pulse_home = %s', pulse_home)
         self.logger.debug('pulse_min  = %s', pulse_min)
         self.logger.debug('pulse_max  = %s', pulse_max)
+        self.logger.debug('mode       = %s', mode)
+        self.logger.debug('batch      = %s', batch)
+        self.logger.debug('profile    = %s', profile)
+        self.logger.debug('v_max      = %s', v_max)
+        self.logger.debug('a_max      = %s', a_max)
 
         if type(pi) == pigpio.pi:
             self.pi   = pi
@@ -50,9 +194,33 @@ class PiServo:
             self.mypi = True
         self.logger.debug('mypi = %s', self.mypi)
 
+        # 時計: 指定がなければ pi の時計(シミュレーション)、なければ実時間
+        self.clock = clock
+        if self.clock is None:
+            self.clock = getattr(self.pi, 'clock', None)
+        if self.clock is None:
+            self.clock = Clock()
+        self.logger.debug('clock = %s', self.clock)
+
         self.pin   = pins
         self.pin_n = len(self.pin)
 
+        if mode not in (MODE_SLEEP, MODE_WAVE):
+            self.logger.warning('mode=%s: invalid .. use \'%s\'',
+                                mode, MODE_SLEEP)
+            mode = MODE_SLEEP
+        self.mode = mode
+
+        if profile not in PROFILES:
+            self.logger.warning('profile=%s: invalid .. use \'%s\'',
+                                profile, PROFILE_LINEAR)
+            profile = PROFILE_LINEAR
+        self.profile = profile
+
+        # [pulse/sec], [pulse/sec^2]
+        self.v_max = self.check_limit('v_max', v_max, DEF_V_MAX)
+        self.a_max = self.check_limit('a_max', a_max, DEF_A_MAX)
+
         self.pulse_home = pulse_home
         self.pulse_min  = pulse_min
         self.pulse_max  = pulse_max
@@ -73,10 +241,127 @@ class PiServo:
         self.logger.debug('pulse_off  = %s', self.pulse_off)
 
         self.cur_pulse = [0] * self.pin_n
+        self.out_pulse = [None] * self.pin_n  # 最後に出力した値
+
+        # 記録 (start_record() 〜 stop_record())
+        self.rec       = None
+        self.rec_msec  = 0
+        self.rec_pulse = None
+
+        # 中断 (stop() 〜 resume())
+        self.stop_ev   = threading.Event()
+        self.stop_time = None
+        self.stop_stat = {'n': 0, 'last_msec': 0.0, 'max_msec': 0.0}
+
+        self.script_id = {}  # {変化したピンの数: script_id}
+        if batch:
+            self.script_id = self.init_script()
+        self.logger.debug('script_id = %s', self.script_id)
+
+        self.move_stat = self.new_move_stat()
+
+        # play() の各フレームの出力時刻 (ベンチマーク用)
+        #   [(予定時刻, 出力後の時刻), ..]  None: 記録しない
+        self.sched_log = None
 
         self.home()
         self.off()
 
+    def check_limit(self, name, x, default):
+        """
+        ピンごとの v_max, a_max
+
+        数がピンより少ない、または正の数でない場合は、default にする。
+        (profile_time() などで IndexError, ZeroDivisionError にならないように)
+
+        Returns
+        -------
+        x: list of float
+            None: [default] * pin_n
+        """
+        if x is None:
+            return [default] * self.pin_n
+
+        try:
+            x = list(x[:self.pin_n])
+            valid = len(x) == self.pin_n and \
+                all([math.isfinite(x1) and x1 > 0 for x1 in x])
+        except TypeError:
+            valid = False
+
+        if not valid:
+            self.logger.warning('%s=%s: invalid .. use %s',
+                                name, x, default)
+            return [default] * self.pin_n
+
+        return x
+
+    def end(self):
+        self.logger.debug('')
+        for script_id in self.script_id.values():
+            try:
+                self.pi.delete_script(script_id)
+            except pigpio.error as e:
+                self.logger.warning('%s:%s', type(e).__name__, e)
+        self.script_id = {}
+
+    def init_script(self):
+        """
+        変化したピンだけのパルス幅を一度に設定する pigpio スクリプトを、
+        ピンの数(2 .. pin_n)ごとに登録する
+
+        Returns
+        -------
+        script_id: dict
+            {ピンの数: script_id}  {}: 登録できなかった (ピンごとに出力する)
+        """
+        if self.pin_n * 2 > SCRIPT_PARAM_MAX:
+            self.logger.warning('pin_n=%d > %d: batch disabled',
+                                self.pin_n, SCRIPT_PARAM_MAX // 2)
+            return {}
+
+        script_id = {}
+        for k in range(2, self.pin_n + 1):
+            script = ' '.join(['servo p%d p%d' % (i * 2, i * 2 + 1)
+                               for i in range(k)])
+            self.logger.debug('script=%a', script)
+
+            script_id[k] = self.store_script(script)
+            if script_id[k] is None:
+                del script_id[k]
+                for sid in script_id.values():
+                    self.pi.delete_script(sid)
+                return {}
+
+        return script_id
+
+    def store_script(self, script):
+        """
+        Returns
+        -------
+        script_id: int
+            None: 登録できなかった
+        """
+        try:
+            script_id = self.pi.store_script(script.encode('utf-8'))
+
+            t_end = self.clock.time() + SCRIPT_INIT_TIMEOUT
+            while True:
+                status = self.pi.script_status(script_id)[0]
+                if status != pigpio.PI_SCRIPT_INITING:
+                    break
+                if self.clock.time() > t_end:
+                    self.logger.warning('script_id=%d: timeout', script_id)
+                    self.pi.delete_script(script_id)
+                    return None
+                self.clock.sleep(0.01)
+
+        except pigpio.error as e:
+            self.logger.warning('%s:%s: batch disabled', type(e).__name__, e)
+            return None
+
+        return script_id
+
     def off(self):
         self.logger.debug('')
         self.set_pulse(self.pulse_off)
@@ -87,101 +372,697 @@ class PiServo:
         self.logger.debug('cur_pos = %s', cur_pos)
         return cur_pos
 
+    def limit_pulse(self, pulse):
+        """ pulse_min, pulse_max の範囲に収める (0 はそのまま) """
+        for i in range(self.pin_n):
+            if pulse[i] == 0:
+                continue
+
+            if pulse[i] < self.pulse_min[i]:
+                self.logger.warn('[%d]: %d < %d !', i, pulse[i],
+                                 self.pulse_min[i])
+                pulse[i] = self.pulse_min[i]
+
+            if pulse[i] > self.pulse_max[i]:
+                self.logger.warn('[%d]: %d > %d !', i, pulse[i],
+                                 self.pulse_max[i])
+                pulse[i] = self.pulse_max[i]
+
+        return pulse
+
     def set_pulse(self, pulse):
-        self.logger.debug('pulse=%s', pulse)
+        self.limit_pulse(pulse)
 
         for i in range(self.pin_n):
             if pulse[i] != 0:
-                if pulse[i] < self.pulse_min[i]:
-                    self.logger.warn('[%d]: %d < %d !', i, pulse[i],
-                                     self.pulse_min[i])
-                    pulse[i] = self.pulse_min[i]
+                self.cur_pulse[i] = pulse[i]
 
-                if pulse[i] > self.pulse_max[i]:
-                    self.logger.warn('[%d]: %d > %d !', i, pulse[i],
-                                     self.pulse_max[i])
-                    pulse[i] = self.pulse_max[i]
+        if self.rec is not None:
+            self.rec.append((self.rec_msec, list(pulse)))
+            return
 
-                self.cur_pulse[i] = pulse[i]
+        # 値が変化したピンだけを出力する
+        changed = []
+        for i in range(self.pin_n):
+            w = int(pulse[i])
+            if w != self.out_pulse[i]:
+                self.out_pulse[i] = w
+                changed.append(i)
+
+        if len(changed) == 0:
+            return
 
-            self.pi.set_servo_pulsewidth(self.pin[i], pulse[i])
+        if _trace.on:
+            _trace.rec(TR_PULSE, *(self.out_pulse + [0, 0, 0, 0])[:4])
+
+        # 複数ピンは、スクリプトで一括出力 (pigpiod との通信1回)
+        #   変化したピンだけを出力する
+        script_id = self.script_id.get(len(changed))
+        if script_id is not None:
+            params = []
+            for i in changed:
+                params += [self.pin[i], self.out_pulse[i]]
+            try:
+                self.pi.run_script(script_id, params)
+                return
+            except pigpio.error as e:
+                self.logger.debug('%s:%s', type(e).__name__, e)
+
+        for i in changed:
+            self.pi.set_servo_pulsewidth(self.pin[i], self.out_pulse[i])
 
     def home(self):
         self.logger.debug('')
         self.set_pulse(self.pulse_home)
 
+    def sleep(self, sec):
+        """
+        記録中は実際には待たずに、記録上の時刻だけを進める
+
+        stop() されたら、すぐに戻る。
+        """
+        if self.rec is not None:
+            self.rec_msec += sec * 1000
+            return
+
+        if sec > 0:
+            self.clock.wait(self.stop_ev, sec)
+        self.is_stopped()
+
+    def stop(self):
+        """
+        動作を中断する (別スレッドから呼ばれる)
+
+        補間の各ステップや sleep() で中断を確認し、
+        resume() されるまで、以降の移動は行わない。
+        """
+        self.logger.debug('')
+        if not self.stop_ev.is_set():
+            self.stop_time = self.clock.time()
+        self.stop_ev.set()
+
+    def resume(self):
+        self.logger.debug('')
+        self.stop_ev.clear()
+        self.stop_time = None
+
+    def is_stopped(self):
+        """
+        中断されているか
+
+        stop() 後、最初に中断を検出したときに、
+        stop() からの経過時間(停止までの遅延)を stop_stat に記録する。
+        """
+        if not self.stop_ev.is_set() or self.rec is not None:
+            return False
+
+        if self.stop_time is not None:
+            latency_msec = (self.clock.time() - self.stop_time) * 1000
+            self.stop_time = None
+
+            stat = self.stop_stat
+            stat['n'] += 1
+            stat['last_msec'] = latency_msec
+            stat['max_msec'] = max(stat['max_msec'], latency_msec)
+
+            if latency_msec > STOP_LATENCY_WARN_MSEC:
+                self.logger.warning('stop latency: %.1f ms > %d ms',
+                                    latency_msec, STOP_LATENCY_WARN_MSEC)
+            else:
+                self.logger.debug('stop latency: %.1f ms', latency_msec)
+
+        return True
+
+    def get_stop_stat(self):
+        """ 中断の統計情報 (回数, 停止までの遅延の直近値・最大値) """
+        return dict(self.stop_stat)
+
+    def start_record(self):
+        """
+        出力の記録を開始する
+
+        stop_record() までの間、サーボには出力せずに、
+        (時刻[msec], パルス幅のリスト) のフレームとして記録する。
+        """
+        self.logger.debug('')
+        self.rec       = []
+        self.rec_msec  = 0
+        self.rec_pulse = list(self.cur_pulse)
+
+    def stop_record(self):
+        """
+        記録を終了し、現在位置を記録開始時点に戻す
+
+        Returns
+        -------
+        motion: (frames, total_msec)
+            frames: [(t_msec, pulse), ..]
+            total_msec: 全体の時間(最後のフレームの後の待ち時間を含む)
+        """
+        motion = (self.rec, self.rec_msec)
+        self.logger.debug('len(frames)=%d, total_msec=%s',
+                          len(motion[0]), motion[1])
+
+        self.cur_pulse = self.rec_pulse
+        self.rec       = None
+        self.rec_pulse = None
+        return motion
+
     def move(self, pos_list=[], interval_msec=0, v=None, quick=False):
-        self.logger.debug('pos_list=%s, v=%s, quick=%s', pos_list, v, quick)
+        """
+        複数のキーフレームを、続けて移動する
 
+        全体の軌道を trajectory() でまとめて計算し、play() で出力する。
+        MODE_WAVE の場合は、キーフレームごとに move1() で wave を出力する。
+        """
         if type(pos_list[0]) != list:
             self.move1(pos_list, v, quick)
             return
 
-        for p in pos_list:
-            self.move1(p, v, quick)
-            time.sleep(interval_msec/1000)
+        if self.mode == MODE_WAVE and not quick and self.rec is None:
+            for p in pos_list:
+                self.move1(p, v, quick)
+                self.sleep(interval_msec/1000)
+            return
+
+        if self.is_stopped():
+            return
+
+        self.play(self.trajectory(pos_list, v, quick, interval_msec,
+                                  relative=True))
 
     def move1(self, pos, v=None, quick=False):
-        self.logger.debug('pos=%s, v=%s, quick=%s', pos, v, quick)
         p = [pos[i] + self.pulse_home[i] for i in range(self.pin_n)]
         self.move_p(p, v, quick)
 
     def move_p(self, pulse, v=None, quick=False):
-        self.logger.debug('pulse=%s, v=%s, quick=%s', pulse, v, quick)
+        if self.is_stopped():
+            return
+
+        motion = self.trajectory([pulse], v, quick)
+        frames, total_msec = motion
+        step_n = len(frames)
+
+        if self.mode == MODE_WAVE and not quick and step_n > 0 and \
+           self.rec is None:
+            p_list = [p for t, p in frames]
+            interval_msec = total_msec / step_n
+
+            self.move_stat = self.new_move_stat(step_n, total_msec)
+            t0 = self.clock.time()
+            if self.move_wave(p_list, interval_msec):
+                self.move_stat['elapsed_msec'] = \
+                    (self.clock.time() - t0) * 1000
+                return
+            self.logger.warning('wave failed .. fallback to \'%s\'',
+                                MODE_SLEEP)
+
+        self.play(motion)
 
+    def trajectory(self, pulse_list, v=None, quick=False, interval_msec=0,
+                   relative=False):
+        """
+        キーフレームの列を順に移動するフレーム列を、まとめて計算する
+
+        PROFILE_LINEAR では、各キーフレームへの移動は、
+        現在位置(前のキーフレーム)から、PULSE_STEP 以下の刻みで直線補間する。
+        1ステップの時間は、刻みの大きさ × v [msec]。
+        numpy があれば、全キーフレーム・全ピンを2次元配列で一度に計算する。
+
+        それ以外のプロファイルは、trajectory_profile() で計算する。
+
+        quick の場合はプロファイルによらず補間せず、移動量 × v [msec] 待つ。
+        各フレームは pulse_min, pulse_max の範囲に収める。
+
+        Parameters
+        ----------
+        pulse_list: list of list
+            キーフレームのパルス幅
+        interval_msec: int
+            各キーフレームの後の待ち時間
+        relative: bool
+            True: pulse_list はホームポジションからの相対値
+
+        Returns
+        -------
+        motion: (frames, total_msec)
+            play() の引数と同じ形式
+        """
         if v is None:
             v = INTERVAL_FACTOR
 
-        d_list = [abs(pulse[i] - self.cur_pulse[i]) for i in range(self.pin_n)]
-        self.logger.debug('d_list = %s', d_list)
+        if len(pulse_list) == 0:
+            motion = ([], 0)
+        elif self.profile != PROFILE_LINEAR and not quick:
+            motion = self.trajectory_profile(pulse_list, v, interval_msec,
+                                             relative)
+        elif np is not None:
+            motion = self.trajectory_np(pulse_list, v, quick, interval_msec,
+                                        relative)
+        else:
+            motion = self.trajectory_py(pulse_list, v, quick, interval_msec,
+                                        relative)
 
-        d_max = max(d_list)
-        self.logger.debug('d_max=%d', d_max)
+        if _trace.on:
+            _trace.rec(TR_MOVE, len(motion[0]), motion[1] * 1000, quick)
+        return motion
 
-        # d_min = min(d_list)
-        # self.logger.debug('d_min=%d', d_min)
+    def trajectory_py(self, pulse_list, v, quick, interval_msec, relative):
+        """ trajectory() (numpy を使わない) """
+        frames = []
+        t_msec = 0
+        cur = list(self.cur_pulse)
+        for pulse in pulse_list:
+            if relative:
+                pulse = [pulse[i] + self.pulse_home[i]
+                         for i in range(self.pin_n)]
+
+            d_max = max([abs(pulse[i] - cur[i]) for i in range(self.pin_n)])
+
+            if quick:
+                step_n = 1
+                step_msec = d_max * v
+            else:
+                step_n = int(d_max / PULSE_STEP)
+                if d_max > PULSE_STEP * step_n:
+                    step_n += 1
+                step_msec = d_max / step_n * v if step_n > 0 else 0
+
+            if step_n > 0:
+                dp = [(pulse[i] - cur[i]) / step_n for i in range(self.pin_n)]
+                for s in range(step_n):
+                    p = [cur[i] + dp[i] * (s + 1) for i in range(self.pin_n)]
+                    frames.append((t_msec + s * step_msec,
+                                   self.limit_pulse(p)))
+
+            cur = self.limit_pulse(list(pulse))
+            t_msec += step_n * step_msec + interval_msec
+
+        return (frames, t_msec)
+
+    def trajectory_np(self, pulse_list, v, quick, interval_msec, relative):
+        """
+        trajectory() (numpy)
+
+        キーフレーム数 K, ピン数 N, 全フレーム数 F として、
+        (K, N) の配列から、(F, N) のフレーム配列を一度に作る。
+        """
+        target = np.array(pulse_list, dtype=float)
+        if relative:
+            target += self.pulse_home
+
+        # 各キーフレームの開始位置: 現在位置, 前のキーフレーム(範囲内)
+        start = np.empty_like(target)
+        start[0] = self.cur_pulse
+        start[1:] = self.limit_pulse_array(target[:-1])
+
+        diff = target - start
+        d_max = np.abs(diff).max(axis=1)
 
         if quick:
-            # quick mode
-            sleep_msec = d_max * v
-            self.logger.debug('sleep_msec = %d', sleep_msec)
+            step_n = np.ones(len(target), dtype=int)
+            step_msec = d_max * v
+        else:
+            step_n = (d_max / PULSE_STEP).astype(int)
+            step_n += d_max > PULSE_STEP * step_n
+            step_msec = np.where(step_n > 0,
+                                 d_max / np.maximum(step_n, 1) * v, 0)
+
+        key_msec = np.cumsum(step_n * step_msec + interval_msec)
+        key_t0 = np.concatenate(([0.0], key_msec[:-1]))
+
+        # フレームごとの、キーフレーム番号 k と、その中のステップ番号 s
+        k = np.repeat(np.arange(len(target)), step_n)
+        s = np.arange(len(k)) - np.repeat(np.cumsum(step_n) - step_n, step_n)
+
+        dp = diff[k] / step_n[k, None]
+        pulse = self.limit_pulse_array(start[k] + dp * (s[:, None] + 1))
+        t_msec = key_t0[k] + s * step_msec[k]
+
+        return (list(zip(t_msec.tolist(), pulse.tolist())),
+                float(key_msec[-1]))
+
+    def get_limits(self, v):
+        """
+        v に応じた、ピンごとの最大速度と最大加速度
+
+        v_max, a_max は v=INTERVAL_FACTOR の値とし、
+        v が大きいほど(PROFILE_LINEAR と同様に)遅くする。
+
+        Returns
+        -------
+        (v_max, a_max): (list of float, list of float)
+            [pulse/msec], [pulse/msec^2]
+        """
+        k = INTERVAL_FACTOR / v
+        v_max = [x * k / 1000 for x in self.v_max]
+        a_max = [x * k * k / 1000000 for x in self.a_max]
+        return (v_max, a_max)
+
+    def profile_time(self, d, v_max, a_max):
+        """
+        1区間の移動時間と位置の関数 (PROFILE_TRAPEZOID, PROFILE_SCURVE)
+
+        全ピンが同じ位置の関数で同時に動くので、
+        全ピンが最大速度・最大加速度を超えない最短時間とする。
+
+        Parameters
+        ----------
+        d: list of float
+            ピンごとの移動量
+
+        Returns
+        -------
+        (t_msec, ease): (float, function)
+            ease(tau) -> s: 位置の関数 (ease_trapezoid() など)
+        """
+        d = [abs(x) for x in d]
+
+        if self.profile == PROFILE_SCURVE:
+            t_msec = max([max(SCURVE_V * d[i] / v_max[i],
+                              math.sqrt(SCURVE_A * d[i] / a_max[i]))
+                          for i in range(self.pin_n)])
+            return (t_msec, ease_scurve)
+
+        # 台形: 最も時間のかかるピンの、加速時間の割合に揃える
+        t_lead = 0
+        f = 0.5
+        for i in range(self.pin_n):
+            if d[i] >= v_max[i] ** 2 / a_max[i]:
+                t_i = d[i] / v_max[i] + v_max[i] / a_max[i]
+                f_i = v_max[i] / a_max[i] / t_i
+            else:
+                # 最大速度に達しない (三角形)
+                t_i = 2 * math.sqrt(d[i] / a_max[i])
+                f_i = 0.5
+            if t_i > t_lead:
+                t_lead = t_i
+                f = f_i
+
+        t_msec = max([max(d[i] / (v_max[i] * (1 - f)),
+                          math.sqrt(d[i] / (a_max[i] * f * (1 - f))))
+                      for i in range(self.pin_n)])
+        return (t_msec, lambda tau: ease_trapezoid(tau, f))
+
+    def trajectory_profile(self, pulse_list, v, interval_msec, relative):
+        """
+        trajectory() (PROFILE_LINEAR 以外)
+
+        区間の時間を PROFILE_FRAME_MSEC 以下の等間隔に分けて出力する。
+        """
+        if relative:
+            pulse_list = [[p[i] + self.pulse_home[i]
+                           for i in range(self.pin_n)] for p in pulse_list]
+
+        v_max, a_max = self.get_limits(v)
+
+        if self.profile == PROFILE_SPLINE:
+            return self.trajectory_spline(pulse_list, v_max, a_max,
+                                          interval_msec)
+
+        frames = []
+        t_msec = 0
+        cur = list(self.cur_pulse)
+        for pulse in pulse_list:
+            d = [pulse[i] - cur[i] for i in range(self.pin_n)]
+
+            seg_msec = 0
+            if max([abs(x) for x in d]) > 0:
+                seg_msec, ease = self.profile_time(d, v_max, a_max)
+                frame_n = max(math.ceil(seg_msec / PROFILE_FRAME_MSEC), 1)
+                for j in range(frame_n):
+                    s = ease((j + 1) / frame_n)
+                    frames.append((t_msec + j * seg_msec / frame_n,
+                                   self.limit_pulse(
+                                       [cur[i] + d[i] * s
+                                        for i in range(self.pin_n)])))
+
+            cur = self.limit_pulse(list(pulse))
+            t_msec += seg_msec + interval_msec
 
-            self.set_pulse(pulse)
-            time.sleep(sleep_msec/1000)
+        return (frames, t_msec)
+
+    def trajectory_spline(self, pulse_list, v_max, a_max, interval_msec):
+        """
+        trajectory() (PROFILE_SPLINE)
+
+        現在位置と各キーフレームを通る 3次スプライン(Catmull-Rom)。
+        両端では止まり、途中のキーフレームでは止まらない。
+        interval_msec は、最後のキーフレームの後にだけ待つ。
+
+        区間の時間は、まず最大速度で直線移動する時間とし、
+        曲線全体の速度・加速度の最大値が、ちょうど v_max, a_max になるように、
+        時間を一様に伸縮する(曲線の形は変わらない)。
+        """
+        pts = [list(self.cur_pulse)] + [self.limit_pulse(list(p))
+                                        for p in pulse_list]
+        seg_n = len(pts) - 1
+
+        h = [max(max([abs(pts[k + 1][i] - pts[k][i]) / v_max[i]
+                      for i in range(self.pin_n)]), PROFILE_FRAME_MSEC)
+             for k in range(seg_n)]
+
+        m = [[0] * self.pin_n for k in range(seg_n + 1)]
+        for k in range(1, seg_n):
+            m[k] = [(pts[k + 1][i] - pts[k - 1][i]) / (h[k - 1] + h[k])
+                    for i in range(self.pin_n)]
+
+        # 加速度は区間内で直線的に変化するので、両端で最大になる
+        c = 0
+        for k in range(seg_n):
+            for i in range(self.pin_n):
+                for j in range(SPLINE_V_CHECK_N + 1):
+                    p, vel, acc = hermite(j / SPLINE_V_CHECK_N, h[k],
+                                          pts[k][i], pts[k + 1][i],
+                                          m[k][i], m[k + 1][i])
+                    c = max(c, abs(vel) / v_max[i])
+                    if j == 0 or j == SPLINE_V_CHECK_N:
+                        c = max(c, math.sqrt(abs(acc) / a_max[i]))
+
+        if c > 0:
+            h = [x * c for x in h]
+            m = [[x / c for x in m1] for m1 in m]
+
+        frames = []
+        t_msec = 0
+        for k in range(seg_n):
+            frame_n = max(math.ceil(h[k] / PROFILE_FRAME_MSEC), 1)
+            for j in range(frame_n):
+                u = (j + 1) / frame_n
+                p = [hermite(u, h[k], pts[k][i], pts[k + 1][i],
+                             m[k][i], m[k + 1][i])[0]
+                     for i in range(self.pin_n)]
+                frames.append((t_msec + j * h[k] / frame_n,
+                               self.limit_pulse(p)))
+            t_msec += h[k]
+
+        return (frames, t_msec + interval_msec)
+
+    def limit_pulse_array(self, pulse):
+        """ limit_pulse() の numpy 版 (2次元配列をまとめて処理する) """
+        lim = np.clip(pulse, self.pulse_min, self.pulse_max)
+        lim[pulse == 0] = 0
+
+        over_n = np.count_nonzero(lim != pulse)
+        if over_n > 0:
+            self.logger.warning('%d pulses out of range: %s - %s',
+                                over_n, self.pulse_min, self.pulse_max)
+        return lim
+
+    def new_move_stat(self, step_n=0, target_msec=0):
+        """
+        1回の移動(move_p)の統計情報
+
+        step_n: ステップ数
+        target_msec: 予定の移動時間
+        elapsed_msec: 実際の移動時間
+        skip_n: 期限を過ぎたため出力しなかったステップ数
+        overrun_n: 出力が期限に間に合わなかったステップ数
+        overrun_max_msec, overrun_total_msec: 期限超過時間の最大値, 合計
+        """
+        return {'step_n': step_n,
+                'target_msec': target_msec,
+                'elapsed_msec': 0.0,
+                'skip_n': 0,
+                'overrun_n': 0,
+                'overrun_max_msec': 0.0,
+                'overrun_total_msec': 0.0}
+
+    def get_move_stat(self):
+        """ 直前の移動の統計情報 """
+        return dict(self.move_stat)
+
+    def play(self, motion):
+        """
+        フレーム列を、開始時刻を基準とした絶対時刻(期限)に合わせて出力する。
+
+        set_pulse() などの処理時間が sleep に上乗せされないので、
+        移動時間はホストの負荷によらず、ほぼ予定どおりになる。
+        出力する前に次のフレームの時刻を過ぎてしまったフレームは出力せず、
+        次のフレームにまとめる(最後のフレームは必ず出力する)。
+
+        Parameters
+        ----------
+        motion: (frames, total_msec)
+            stop_record() の戻り値と同じ形式
+        """
+        frames, total_msec = motion
+
+        if self.rec is not None:
+            t_rec = self.rec_msec
+            for t, p in frames:
+                self.rec_msec = t_rec + t
+                self.set_pulse(list(p))
+            self.rec_msec = t_rec + total_msec
             return
 
-        step_n = int(d_max / PULSE_STEP)
-        if d_max > PULSE_STEP * step_n:
-            step_n += 1
-        self.logger.debug('step_n = %d', step_n)
+        stat = self.move_stat = self.new_move_stat(len(frames), total_msec)
+        last_k = len(frames) - 1
 
-        if step_n == 0:
-            interval_msec = 0
-        else:
-            interval_msec = d_max / step_n * v
-        self.logger.debug('interval_msec=%d', interval_msec)
+        t0 = self.clock.time()
+        for k, (t, p) in enumerate(frames):
+            if self.is_stopped():
+                self.logger.debug('stopped: %d/%d', k, len(frames))
+                break
+
+            if k < last_k:
+                deadline = t0 + frames[k + 1][0] / 1000
+            else:
+                deadline = t0 + total_msec / 1000
+
+            now = self.clock.time()
+            if k < last_k and now >= deadline:
+                stat['skip_n'] += 1
+                if _trace.on:
+                    _trace.rec(TR_SKIP, k, len(frames))
+                continue
 
-        pulse0 = [0] * self.pin_n
-        dp = [0] * self.pin_n
+            if now < t0 + t / 1000:
+                if self.clock.wait(self.stop_ev, t0 + t / 1000 - now):
+                    continue
+
+            self.set_pulse(list(p))
+
+            now = self.clock.time()
+            if self.sched_log is not None:
+                self.sched_log.append((t0 + t / 1000, now))
+            if now <= deadline:
+                continue
+
+            overrun_msec = (now - deadline) * 1000
+            if _trace.on:
+                _trace.rec(TR_OVER, k, overrun_msec * 1000)
+            stat['overrun_n'] += 1
+            stat['overrun_total_msec'] += overrun_msec
+            stat['overrun_max_msec'] = max(stat['overrun_max_msec'],
+                                           overrun_msec)
+
+        now = self.clock.time()
+        if now < t0 + total_msec / 1000:
+            self.sleep(t0 + total_msec / 1000 - now)
+
+        stat['elapsed_msec'] = (self.clock.time() - t0) * 1000
+        if _trace.on:
+            _trace.rec(TR_DONE, stat['elapsed_msec'] * 1000, stat['skip_n'],
+                       stat['overrun_n'])
+
+    def wave_frame(self, pulse):
+        """
+        1周期(WAVE_FRAME_USEC)分のサーボパルスを pigpio.pulse のリストにする
+
+        全ピンを同時に立ち上げ、パルス幅の短い順に立ち下げる。
+        """
+        on_mask  = 0
+        off_mask = {}
         for i in range(self.pin_n):
-            pulse0[i] = self.cur_pulse[i]
+            w = int(pulse[i])
+            if w <= 0:
+                continue
+            on_mask |= 1 << self.pin[i]
+            off_mask[w] = off_mask.get(w, 0) | (1 << self.pin[i])
+
+        if on_mask == 0:
+            return [pigpio.pulse(0, 0, WAVE_FRAME_USEC)]
 
-            if step_n == 0:
-                dp[i] = pulse[i] - self.cur_pulse[i]
+        w_list = sorted(off_mask)
+        frame = [pigpio.pulse(on_mask, 0, w_list[0])]
+        for j, w in enumerate(w_list):
+            if j + 1 < len(w_list):
+                w_next = w_list[j + 1]
             else:
-                dp[i] = (pulse[i] - self.cur_pulse[i]) / step_n
+                w_next = WAVE_FRAME_USEC
+            frame.append(pigpio.pulse(0, off_mask[w], w_next - w))
 
-        self.logger.debug('pulse0 = %s', pulse0)
-        self.logger.debug('dp = %s', dp)
+        return frame
 
-        p = [0] * self.pin_n
-        for s in range(step_n):
-            for i in range(self.pin_n):
-                p[i] = pulse0[i] + dp[i] * (s + 1)
+    def move_wave(self, p_list, interval_msec):
+        """
+        補間済みの全ステップを一つの waveform にまとめて、DMAで出力する。
+
+        サーボのパルス周期ごとに、その時点に対応するステップのパルス幅を
+        出力する。出力完了後は set_pulse() で目標値を保持する。
+
+        Returns
+        -------
+        result: bool
+            False の場合、waveを出力していないので、
+            呼び出し側で MODE_SLEEP の処理を行う。
+        """
+        self.logger.debug('len(p_list)=%d, interval_msec=%s',
+                          len(p_list), interval_msec)
+
+        step_usec = interval_msec * 1000
+        if step_usec <= 0:
+            return False
 
-            self.logger.debug('p = %s', p)
-            self.set_pulse(p)
-            time.sleep(interval_msec/1000)
+        frame_n = max(int(step_usec * len(p_list) / WAVE_FRAME_USEC), 1)
+        self.logger.debug('frame_n=%d', frame_n)
+
+        pulses = []
+        for f in range(frame_n):
+            s = min(int((f + 1) * WAVE_FRAME_USEC / step_usec),
+                    len(p_list)) - 1
+            pulses += self.wave_frame(self.limit_pulse(list(p_list[s])))
+
+        try:
+            if len(pulses) > self.pi.wave_get_max_pulses():
+                self.logger.warning('too many pulses: %d', len(pulses))
+                return False
+
+            self.pi.wave_add_new()
+            self.pi.wave_add_generic(pulses)
+            wid = self.pi.wave_create()
+        except pigpio.error as e:
+            self.logger.warning('%s:%s', type(e).__name__, e)
+            return False
+        self.logger.debug('wid=%d', wid)
+
+        # サーボパルスを止めて、waveに切り替える
+        for i in range(self.pin_n):
+            self.pi.set_servo_pulsewidth(self.pin[i], 0)
+            self.pi.set_mode(self.pin[i], pigpio.OUTPUT)
+            self.out_pulse[i] = 0
+
+        t0 = self.clock.time()
+        self.pi.wave_send_once(wid)
+
+        s = len(p_list) - 1
+        while self.pi.wave_tx_busy():
+            if self.is_stopped():
+                self.pi.wave_tx_stop()
+                # 中断した時点のステップ
+                s = min(int((self.clock.time() - t0) * 1000000 / step_usec),
+                        s)
+                self.logger.debug('stopped: %d/%d', s, len(p_list))
+                break
+
+            self.clock.sleep(WAVE_POLL_SEC)
+
+        self.pi.wave_delete(wid)
+
+        # 最終位置(中断した場合はその時点の位置)をサーボパルスで保持
+        self.set_pulse(p_list[s])
+        return True
 
     def print_pulse(self):
         self.logger.debug('')
@@ -194,16 +1075,18 @@ class PiServo:
 
 class Sample:
     """ Sample """
-    def __init__(self, pins, debug=False):
+    def __init__(self, pins, mode=MODE_SLEEP, profile=PROFILE_LINEAR,
+                 debug=False):
         self.debug = debug
         self.logger = my_logger.get_logger(__class__.__name__, debug)
-        self.logger.debug('pins = %s', pins)
+        self.logger.debug('pins = %s, mode = %s, profile = %s',
+                          pins, mode, profile)
 
         self.pin = pins
 
         self.pi  = pigpio.pi()
         self.servo = PiServo(self.pi, self.pin, DEF_PULSE_HOME,
-                             debug=self.debug)
+                             mode=mode, profile=profile, debug=self.debug)
 
     def main(self):
         self.logger.debug('')
@@ -228,6 +1111,7 @@ class Sample:
         self.servo.print_pulse()
         time.sleep(1)
         self.servo.off()
+        self.servo.end()
         self.pi.stop()
 
 
@@ -240,13 +1124,20 @@ CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 @click.argument('pin2', type=int, default=DEF_PIN[1])
 @click.argument('pin3', type=int, default=DEF_PIN[2])
 @click.argument('pin4', type=int, default=DEF_PIN[3])
+@click.option('--mode', '-m', 'mode',
+              type=click.Choice([MODE_SLEEP, MODE_WAVE]), default=MODE_SLEEP,
+              help='servo output mode')
+@click.option('--profile', '-p', 'profile',
+              type=click.Choice(PROFILES), default=PROFILE_LINEAR,
+              help='velocity profile')
 @click.option('--debug', '-d', 'debug', is_flag=True, default=False,
               help='debug flag')
-def main(pin1, pin2, pin3, pin4, debug):
+def main(pin1, pin2, pin3, pin4, mode, profile, debug):
     logger = my_logger.get_logger(__name__, debug)
     logger.debug('pins: %d, %d, %d, %d', pin1, pin2, pin3, pin4)
 
-    obj = Sample([pin1, pin2, pin3, pin4], debug=debug)
+    obj = Sample([pin1, pin2, pin3, pin4], mode=mode, profile=profile,
+                 debug=debug)
     try:
         obj.main()
     finally:
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+#
+# (c) 2019 Yoichi Tanibayashi
+#
+'''
+PiServo のマイクロベンチマーク
+
+move1() 1回あたりの pigpiod との通信回数(ラウンドトリップ数)と所要時間を、
+一括出力(batch)の有無で比較する。
+
+pigpio モジュール内部の _pigpio_command(), _pigpio_command_ext() を
+置き換えて、ソケット通信の回数を数える。
+'''
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2019'
+
+import pigpio
+import time
+from PiServo import PiServo, DEF_PIN, MODE_SLEEP, MODE_WAVE
+from MyLogger import get_logger
+
+
+POS_LIST = [[-200, 0, 0, -200],
+            [0, 0, 0, 0],
+            [200, 100, -100, 200],
+            [0, 0, 0, 0]]
+
+
+class RoundTripCounter:
+    """ pigpiod とのソケット通信回数を数える """
+    def __init__(self):
+        self.count = 0
+        self._cmd = pigpio._pigpio_command
+        self._cmd_ext = pigpio._pigpio_command_ext
+
+    def start(self):
+        def cmd(*args, **kwargs):
+            self.count += 1
+            return self._cmd(*args, **kwargs)
+
+        def cmd_ext(*args, **kwargs):
+            self.count += 1
+            return self._cmd_ext(*args, **kwargs)
+
+        pigpio._pigpio_command = cmd
+        pigpio._pigpio_command_ext = cmd_ext
+
+    def stop(self):
+        pigpio._pigpio_command = self._cmd
+        pigpio._pigpio_command_ext = self._cmd_ext
+
+    def reset(self):
+        self.count = 0
+
+
+class PiServoBench:
+    """ PiServoBench """
+    def __init__(self, pins=DEF_PIN, debug=False):
+        self.debug = debug
+        self.logger = get_logger(__class__.__name__, debug)
+        self.logger.debug('pins = %s', pins)
+
+        self.pin = pins
+        self.pi = pigpio.pi()
+        self.counter = RoundTripCounter()
+
+    def run1(self, mode, batch, n):
+        """ move1() を n * len(POS_LIST) 回実行して、結果を返す """
+        self.logger.debug('mode=%s, batch=%s, n=%d', mode, batch, n)
+
+        servo = PiServo(self.pi, self.pin, mode=mode, batch=batch,
+                        debug=False)
+        servo.home()
+
+        self.counter.reset()
+        self.counter.start()
+        try:
+            move_n = 0
+            step_n = 0
+            t0 = time.monotonic()
+            for i in range(n):
+                for pos in POS_LIST:
+                    servo.move1(pos)
+                    move_n += 1
+                    step_n += servo.get_move_stat()['step_n']
+            elapsed = time.monotonic() - t0
+        finally:
+            self.counter.stop()
+
+        servo.off()
+        servo.end()
+
+        return {'mode': mode,
+                'batch': batch,
+                'move_n': move_n,
+                'step_n': step_n,
+                'round_trip': self.counter.count,
+                'round_trip_per_move1': self.counter.count / move_n,
+                'round_trip_per_step': self.counter.count / max(step_n, 1),
+                'elapsed_sec': elapsed}
+
+    def main(self, n=1):
+        self.logger.debug('n=%d', n)
+
+        for mode in (MODE_SLEEP, MODE_WAVE):
+            for batch in (False, True):
+                ret = self.run1(mode, batch, n)
+                print('%-5s batch=%-5s move1=%d step=%d round_trip=%d'
+                      ' (%.1f/move1, %.2f/step) %.3f sec' % (
+                          ret['mode'], ret['batch'], ret['move_n'],
+                          ret['step_n'], ret['round_trip'],
+                          ret['round_trip_per_move1'],
+                          ret['round_trip_per_step'],
+                          ret['elapsed_sec']))
+
+    def end(self):
+        self.logger.debug('')
+        self.pi.stop()
+
+
+import click
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--count', '-n', 'count', type=int, default=3,
+              help='repeat count')
+@click.option('--debug', '-d', 'debug', is_flag=True, default=False,
+              help='debug flag')
+def main(count, debug):
+    logger = get_logger(__name__, debug)
+    logger.debug('count=%d', count)
+
+    obj = PiServoBench(debug=debug)
+    try:
+        obj.main(count)
+    finally:
+        logger.debug('finally')
+        obj.end()
+
+
+if __name__ == '__main__':
+    main()
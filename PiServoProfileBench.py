@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+PiServo の速度プロファイルのベンチマーク
+
+OttoPiCtrl のコマンドを、速度プロファイル(PROFILE_LINEAR, ..)ごとに
+PiServoSim(出力を記録するだけの pigpio, 仮想時計)で実行し、
+次の値を比べる。
+
+  sec     動作時間 (時計の上の時間)
+  v_peak  最大速度 [pulse/sec]
+  a_peak  最大加速度 [pulse/sec^2]
+
+速度と加速度は、サーボへの出力を直線でつないだ軌道を、
+サーボのパルス周期(20msec)ごとに読み取った値の差分から求める(全ピンの最大値)。
+quick の動作(補間しないで跳ぶ)を含むコマンドは、プロファイルによらず大きい。
+
+------------------------------------------------------------
+PiServoProfileBench
+ |
+ +- OttoPiMotionBench -- OttoPiCtrl -- .. -- PiServo -- PiServoSim.pi
+------------------------------------------------------------
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+import json
+import PiServoSim
+
+# pigpiod がなくても動くように、PiServo より先に置き換える
+PiServoSim.install()
+
+from PiServo import PROFILES, PROFILE_FRAME_MSEC, PULSE_OFF
+from PiServo import MODE_SLEEP, MODE_WAVE
+from OttoPiMotionBench import OttoPiMotionBench
+from MyLogger import get_logger
+
+
+class PiServoProfileBench:
+    """
+    Simple usage
+    ------------
+    bench = PiServoProfileBench(['forward', 'happy'])
+    results = bench.run()
+    bench.end()
+    """
+    SAMPLE_SEC = PROFILE_FRAME_MSEC / 1000
+
+    def __init__(self, cmds=(), profiles=(), mode=None, v_max=None,
+                 a_max=None, debug=False):
+        """
+        Parameters
+        ----------
+        cmds: list of str
+            コマンド名 (): 全コマンド
+        profiles: list of str
+            (): 全プロファイル
+        v_max, a_max: int
+            全ピンの最大速度, 最大加速度  None: 設定ファイル, PiServo のまま
+        """
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('cmds=%s, profiles=%s, mode=%s, v_max=%s, a_max=%s',
+                        cmds, profiles, mode, v_max, a_max)
+
+        self.profiles = list(profiles)
+        if len(self.profiles) == 0:
+            self.profiles = list(PROFILES)
+
+        self.bench = OttoPiMotionBench(cmds, speed=0, mode=mode,
+                                       debug=self._dbg)
+        self.servo = self.bench.opm.servo
+
+        if v_max is not None:
+            self.servo.v_max = [v_max] * self.servo.pin_n
+        if a_max is not None:
+            self.servo.a_max = [a_max] * self.servo.pin_n
+
+    def end(self):
+        """ end """
+        self._log.debug('')
+        self.bench.end()
+        self._log.debug('done')
+
+    def info(self):
+        """ 計測条件 """
+        info = self.bench.info()
+        del info['speed'], info['repeat']
+        info['v_max'] = self.servo.v_max
+        info['a_max'] = self.servo.a_max
+        return info
+
+    def peak(self, servo_log):
+        """
+        出力の記録から、最大速度と最大加速度を求める
+
+        Parameters
+        ----------
+        servo_log: list of (t, pin, width)
+            PiServoSim.pi.get_servo_log()  ホームポジションから始まること
+
+        Returns
+        -------
+        (v_peak, a_peak): (float, float)
+            [pulse/sec], [pulse/sec^2]
+        """
+        if len(servo_log) == 0:
+            return (0.0, 0.0)
+
+        dt = self.SAMPLE_SEC
+        t_start = servo_log[0][0] - dt
+        t_end = servo_log[-1][0] + dt
+
+        v_peak = 0.0
+        a_peak = 0.0
+        for i, pin in enumerate(self.servo.pin):
+            events = [(t, w) for t, p, w in servo_log
+                      if p == pin and w != PULSE_OFF]
+
+            events.insert(0, (t_start, self.servo.pulse_home[i]))
+
+            x = []
+            j = 0
+            t = t_start
+            while t <= t_end:
+                while j + 1 < len(events) and events[j + 1][0] <= t:
+                    j += 1
+                t0, w0 = events[j]
+                if j + 1 < len(events):
+                    t1, w1 = events[j + 1]
+                    x.append(w0 + (w1 - w0) * (t - t0) / (t1 - t0))
+                else:
+                    x.append(w0)
+                t += dt
+
+            for k in range(1, len(x)):
+                v_peak = max(v_peak, abs(x[k] - x[k - 1]) / dt)
+            for k in range(1, len(x) - 1):
+                a_peak = max(a_peak,
+                             abs(x[k + 1] - 2 * x[k] + x[k - 1]) / (dt * dt))
+
+        return (v_peak, a_peak)
+
+    def run1(self, cmd):
+        """
+        Returns
+        -------
+        result: dict
+            {'sec':, 'v_peak':, 'a_peak':}
+        """
+        r = self.bench.run1(cmd)
+        v_peak, a_peak = self.peak(self.bench.pi.get_servo_log())
+        return {'sec': r['sim_sec'], 'v_peak': v_peak, 'a_peak': a_peak}
+
+    def run(self):
+        """
+        Returns
+        -------
+        results: dict
+            {'info': info(), 'profiles': {profile: {cmd: result, ..}, ..}}
+        """
+        self._log.debug('')
+
+        results = {}
+        for profile in self.profiles:
+            self.servo.profile = profile
+            results[profile] = {cmd: self.run1(cmd)
+                                for cmd in self.bench.cmds}
+            self._log.debug('%s: %s', profile, results[profile])
+
+        return {'info': self.info(), 'profiles': results}
+
+
+def print_results(results):
+    print('# %s' % (json.dumps(results['info'])))
+
+    profiles = list(results['profiles'])
+    print('%-16s' % ('cmd'), end='')
+    for profile in profiles:
+        print(' %9s %7s' % (profile[:9], 'a_peak'), end='')
+    print()
+
+    for cmd in results['profiles'][profiles[0]]:
+        print('%-16s' % (cmd), end='')
+        for profile in profiles:
+            r = results['profiles'][profile][cmd]
+            print(' %8.3fs %7.0f' % (r['sec'], r['a_peak']), end='')
+        print()
+
+    print()
+    print('%-10s %9s %9s %9s %9s' % (
+        'profile', 'total', 'v_peak', 'a_peak', 'a_median'))
+    for profile in profiles:
+        r_list = list(results['profiles'][profile].values())
+        a_list = sorted([r['a_peak'] for r in r_list])
+        print('%-10s %8.3fs %9.0f %9.0f %9.0f' % (
+            profile, sum([r['sec'] for r in r_list]),
+            max([r['v_peak'] for r in r_list]), a_list[-1],
+            a_list[len(a_list) // 2]))
+
+
+import click
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.argument('cmds', type=str, nargs=-1)
+@click.option('--profile', '-p', 'profile', multiple=True,
+              type=click.Choice(PROFILES),
+              help='velocity profile (default: all)')
+@click.option('--mode', '-m', 'mode',
+              type=click.Choice([MODE_SLEEP, MODE_WAVE]), default=None,
+              help='servo output mode')
+@click.option('--v_max', '-v', 'v_max', type=int, default=None,
+              help='max velocity [pulse/sec]')
+@click.option('--a_max', '-a', 'a_max', type=int, default=None,
+              help='max acceleration [pulse/sec^2]')
+@click.option('--json', '-j', 'json_file', type=click.Path(), default=None,
+              help='write results to JSON file')
+@click.option('--debug', '-d', 'debug', is_flag=True, default=False,
+              help='debug flag')
+def main(cmds, profile, mode, v_max, a_max, json_file, debug):
+    logger = get_logger(__name__, debug)
+    logger.debug('cmds=%s, profile=%s, mode=%s, v_max=%s, a_max=%s',
+                 cmds, profile, mode, v_max, a_max)
+
+    bench = PiServoProfileBench(cmds, profile, mode, v_max, a_max,
+                                debug=debug)
+    try:
+        results = bench.run()
+    finally:
+        logger.debug('finally')
+        bench.end()
+
+    if json_file is not None:
+        with open(json_file, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    print_results(results)
+
+
+if __name__ == '__main__':
+    main()
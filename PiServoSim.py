@@ -0,0 +1,514 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+pigpio のシミュレーション
+
+pigpiod やロボットがなくても、PiServo, OttoPiMotion, OttoPiCtrl,
+OttoPiServer を動かせるようにする、pigpio モジュールの代わり。
+
+install() すると、以降の `import pigpio` でこのモジュールが使われる。
+サーボへの出力(set_servo_pulsewidth, run_script, wave)は、
+すべて時刻付きで servo_log に記録される。
+
+時計
+----
+VirtualClock -- 仮想時刻。sleep()は待たずに時刻を進めるだけなので、
+                ダンスや歩行を数ミリ秒で実行できる。
+ScaledClock  -- 実時間を speed 倍に速めた時計。
+                スレッド間のやりとり(中断など)も含めて試すときに使う。
+
+Simple usage
+------------
+import PiServoSim
+PiServoSim.install()
+
+from OttoPiMotion import OttoPiMotion    # install() の後で import する
+
+opm = OttoPiMotion()                     # pigpio.pi() は PiServoSim.pi
+opm.forward(2)
+for t, pin, width in opm.pi.servo_log:
+    ...
+
+------------------------------------------------------------
+PiServo
+ |
+ +- pigpio (PiServoSim)
+     |
+     +- VirtualClock / ScaledClock
+------------------------------------------------------------
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+import sys
+import time
+import threading
+from MyLogger import get_logger
+
+# pigpio と同じ定数
+INPUT  = 0
+OUTPUT = 1
+
+PI_SCRIPT_INITING = 0
+PI_SCRIPT_HALTED  = 1
+PI_SCRIPT_RUNNING = 2
+PI_SCRIPT_WAITING = 3
+PI_SCRIPT_FAILED  = 4
+
+PI_WAVE_MAX_PULSES = 12000
+
+PI_SERVO_MIN = 500
+PI_SERVO_MAX = 2500
+PI_GPIO_MAX  = 31
+
+SCRIPT_PARAM_MAX = 10
+
+
+class error(Exception):
+    """ pigpio.error """
+    pass
+
+
+class pulse:
+    """ pigpio.pulse """
+    def __init__(self, gpio_on, gpio_off, delay):
+        self.gpio_on = gpio_on
+        self.gpio_off = gpio_off
+        self.delay = delay
+
+
+def _pigpio_command(sl, cmd, p1, p2):
+    """
+    pigpiod とのやりとり1回
+
+    何もしないが、PiServoBench の RoundTripCounter が
+    置き換えて数えられるように、pi の各メソッドから呼ぶ。
+    """
+    return 0
+
+
+def _pigpio_command_ext(sl, cmd, p1, p2, p3, extents):
+    """ _pigpio_command() と同じ (拡張パラメータ付き) """
+    return 0
+
+
+class VirtualClock:
+    """
+    仮想時刻
+
+    PiServo.Clock と同じインタフェース。
+    sleep(), wait() は待たずに、時刻を進めるだけ。
+    複数のスレッドから sleep() した場合は、それぞれの時間が足される。
+    """
+    def __init__(self, t=0.0):
+        self.t = t
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        """ time() と同じ (time.monotonic の代わりに渡せる) """
+        return self.t
+
+    def time(self):
+        return self.t
+
+    def advance(self, sec):
+        with self._lock:
+            self.t += sec
+            return self.t
+
+    def sleep(self, sec):
+        if sec > 0:
+            self.advance(sec)
+
+    def wait(self, ev, sec):
+        """ ev がセットされていれば、時刻を進めずに戻る """
+        if ev.is_set():
+            return True
+
+        self.sleep(sec)
+        return ev.is_set()
+
+
+class ScaledClock:
+    """
+    実時間を speed 倍に速めた時計
+
+    PiServo.Clock と同じインタフェース。
+    """
+    def __init__(self, speed=10.0, t=0.0):
+        self.speed = speed
+        self.t0 = t
+        self.m0 = time.monotonic()
+
+    def __call__(self):
+        return self.time()
+
+    def time(self):
+        return self.t0 + (time.monotonic() - self.m0) * self.speed
+
+    def sleep(self, sec):
+        if sec > 0:
+            time.sleep(sec / self.speed)
+
+    def wait(self, ev, sec):
+        return ev.wait(sec / self.speed)
+
+
+_clock = VirtualClock()
+
+
+def get_clock():
+    """ pi() で時計を指定しなかった場合の時計 """
+    return _clock
+
+
+def set_clock(clock):
+    global _clock
+    _clock = clock
+
+
+def install(clock=None):
+    """
+    以降の `import pigpio` で、このモジュールが使われるようにする
+
+    PiServo などを import する前に呼ぶこと。
+
+    Parameters
+    ----------
+    clock: VirtualClock, ScaledClock
+        None: 今の時計 (get_clock()) のまま
+    """
+    if clock is not None:
+        set_clock(clock)
+
+    mod = sys.modules[__name__]
+    sys.modules['pigpio'] = mod
+    return mod
+
+
+class pi:
+    """
+    pigpio.pi のシミュレーション
+
+    OttoPi で使っているメソッドだけを実装する。
+
+    servo_log: [(時刻[sec], pin, パルス幅[usec]), ..]
+        サーボへの出力。値が変わらない出力も記録する。
+    cmd_n: pigpiod とのやりとりの回数
+    """
+    def __init__(self, host='localhost', port=8888, clock=None,
+                 show_errors=True):
+        """
+        Parameters
+        ----------
+        clock: VirtualClock, ScaledClock
+            None: get_clock()
+        """
+        self.clock = clock
+        if self.clock is None:
+            self.clock = get_clock()
+
+        self.connected = True
+        self.servo_log = []
+        self.width = {}   # {pin: 最後に出力したパルス幅}
+        self.mode = {}    # {pin: INPUT/OUTPUT}
+        self.cmd_n = 0
+
+        self._script = {}  # {script_id: [(ピン, パルス幅), ..]} (param の番号)
+        self._script_id = 0
+
+        self._wave_new = []
+        self._wave = {}    # {wave_id: [pulse, ..]}
+        self._wave_id = 0
+        self._wave_ev = []  # 出力予定 [(時刻, pin, width), ..]
+        self._wave_end = 0.0
+
+    def __repr__(self):
+        return '<%s.pi (sim)>' % (__name__)
+
+    def _cmd(self):
+        if not self.connected:
+            raise error('not connected')
+        self.cmd_n += 1
+        _pigpio_command(None, 0, 0, 0)
+
+    def _write(self, t, pin, width):
+        self.servo_log.append((t, pin, width))
+        self.width[pin] = width
+
+    def _flush_wave(self, now):
+        """ 出力予定のうち、now までの分を servo_log に移す """
+        i = 0
+        while i < len(self._wave_ev) and self._wave_ev[i][0] <= now:
+            self._write(*self._wave_ev[i])
+            i += 1
+        if i > 0:
+            del self._wave_ev[:i]
+
+    def stop(self):
+        self._flush_wave(self.clock.time())
+        self.connected = False
+
+    def get_servo_log(self, pin=None):
+        """
+        Parameters
+        ----------
+        pin: int
+            None: 全ピン
+        """
+        self._flush_wave(self.clock.time())
+        if pin is None:
+            return list(self.servo_log)
+        return [r for r in self.servo_log if r[1] == pin]
+
+    def clear_servo_log(self):
+        self._flush_wave(self.clock.time())
+        self.servo_log = []
+        self.cmd_n = 0
+
+    def set_mode(self, gpio, mode):
+        self._cmd()
+        self.mode[gpio] = mode
+        return 0
+
+    def get_mode(self, gpio):
+        self._cmd()
+        return self.mode.get(gpio, INPUT)
+
+    def set_servo_pulsewidth(self, user_gpio, pulsewidth):
+        self._cmd()
+        self._set_servo(user_gpio, pulsewidth)
+        return 0
+
+    def _set_servo(self, user_gpio, pulsewidth):
+        if user_gpio < 0 or user_gpio > PI_GPIO_MAX:
+            raise error('GPIO not 0-%d: %s' % (PI_GPIO_MAX, user_gpio))
+        if pulsewidth != 0 and not (PI_SERVO_MIN <= pulsewidth
+                                    <= PI_SERVO_MAX):
+            raise error('pulsewidth not 0 or %d-%d: %s' % (
+                PI_SERVO_MIN, PI_SERVO_MAX, pulsewidth))
+
+        now = self.clock.time()
+        self._flush_wave(now)
+        self.mode[user_gpio] = OUTPUT
+        self._write(now, user_gpio, int(pulsewidth))
+
+    def get_servo_pulsewidth(self, user_gpio):
+        self._cmd()
+        self._flush_wave(self.clock.time())
+        return self.width.get(user_gpio, 0)
+
+    def store_script(self, script):
+        """
+        'servo p<n> p<m>' の並びだけに対応する
+        (PiServo.init_script() が登録するスクリプト: ピンもパラメータ)
+        """
+        self._cmd()
+        if isinstance(script, bytes):
+            script = script.decode('utf-8')
+
+        tokens = script.split()
+        if len(tokens) == 0 or len(tokens) % 3 != 0:
+            raise error('bad script: %a' % (script))
+
+        prog = []
+        for i in range(0, len(tokens), 3):
+            cmd, pin, param = tokens[i:i + 3]
+            if cmd != 'servo' or \
+               not all([p[0] == 'p' and p[1:].isdigit() and
+                        int(p[1:]) < SCRIPT_PARAM_MAX for p in (pin, param)]):
+                raise error('unsupported script: %a' % (script))
+            prog.append((int(pin[1:]), int(param[1:])))
+
+        self._script_id += 1
+        self._script[self._script_id] = prog
+        return self._script_id
+
+    def script_status(self, script_id):
+        self._cmd()
+        if script_id not in self._script:
+            raise error('unknown script id: %s' % (script_id))
+        return (PI_SCRIPT_HALTED, [0] * SCRIPT_PARAM_MAX)
+
+    def run_script(self, script_id, params=None):
+        self._cmd()
+        if script_id not in self._script:
+            raise error('unknown script id: %s' % (script_id))
+
+        params = list(params or [])
+        params += [0] * (SCRIPT_PARAM_MAX - len(params))
+        for i_pin, i in self._script[script_id]:
+            self._set_servo(int(params[i_pin]), int(params[i]))
+        return 0
+
+    def delete_script(self, script_id):
+        self._cmd()
+        if script_id not in self._script:
+            raise error('unknown script id: %s' % (script_id))
+        del self._script[script_id]
+        return 0
+
+    def wave_get_max_pulses(self):
+        self._cmd()
+        return PI_WAVE_MAX_PULSES
+
+    def wave_add_new(self):
+        self._cmd()
+        self._wave_new = []
+        return 0
+
+    def wave_add_generic(self, pulses):
+        self._cmd()
+        self._wave_new += list(pulses)
+        if len(self._wave_new) > PI_WAVE_MAX_PULSES:
+            raise error('too many pulses: %d' % len(self._wave_new))
+        return len(self._wave_new)
+
+    def wave_create(self):
+        self._cmd()
+        self._wave_id += 1
+        self._wave[self._wave_id] = self._wave_new
+        self._wave_new = []
+        return self._wave_id
+
+    def wave_delete(self, wave_id):
+        self._cmd()
+        if wave_id not in self._wave:
+            raise error('unknown wave id: %s' % (wave_id))
+        del self._wave[wave_id]
+        return 0
+
+    def wave_send_once(self, wave_id):
+        """
+        各ピンの立ち上がりから立ち下がりまでを1回のパルスとして、
+        立ち上がりの時刻に出力予定に入れる
+        """
+        self._cmd()
+        if wave_id not in self._wave:
+            raise error('unknown wave id: %s' % (wave_id))
+
+        t0 = self.clock.time()
+        self._flush_wave(t0)
+
+        ev = []
+        rise = {}
+        t_usec = 0
+        for p in self._wave[wave_id]:
+            for pin in range(PI_GPIO_MAX + 1):
+                bit = 1 << pin
+                if p.gpio_on & bit:
+                    rise[pin] = t_usec
+                if p.gpio_off & bit and pin in rise:
+                    t_rise = rise.pop(pin)
+                    ev.append((t0 + t_rise / 1000000, pin, t_usec - t_rise))
+            t_usec += p.delay
+
+        ev.sort(key=lambda e: e[0])
+        self._wave_ev = ev
+        self._wave_end = t0 + t_usec / 1000000
+        return len(self._wave[wave_id])
+
+    def wave_tx_busy(self):
+        self._cmd()
+        now = self.clock.time()
+        self._flush_wave(now)
+        return 1 if now < self._wave_end else 0
+
+    def wave_tx_stop(self):
+        self._cmd()
+        now = self.clock.time()
+        self._flush_wave(now)
+        self._wave_ev = []
+        self._wave_end = now
+        return 0
+
+
+class PiServoSimApp:
+    """
+    コマンドをシミュレーションで実行し、動作時間を表示する
+
+    OttoPiCtrl のコマンド('forward 2' など)を、スレッドを使わずに
+    exec_cmd() で順に実行する。
+    """
+    def __init__(self, cmds, speed=0, debug=False):
+        """
+        Parameters
+        ----------
+        speed: float
+            0: VirtualClock, それ以外: ScaledClock(speed)
+        """
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('cmds=%s, speed=%s', cmds, speed)
+
+        self.cmds = cmds
+
+        if speed > 0:
+            self.clock = ScaledClock(speed)
+        else:
+            self.clock = VirtualClock()
+        install(self.clock)
+
+        # install() した後で import する
+        from OttoPiCtrl import OttoPiCtrl
+
+        self.pi = pi(clock=self.clock)
+        self.robot_ctrl = OttoPiCtrl(self.pi, debug=self._dbg)
+
+    def main(self):
+        """ main """
+        self._log.debug('')
+
+        for cmd in self.cmds:
+            # 回数を指定しないと、連続動作が終わらない
+            if len(cmd.split()) == 1:
+                cmd += ' 1'
+
+            self.pi.clear_servo_log()
+            t0 = self.clock.time()
+            wall0 = time.perf_counter()
+            self.robot_ctrl.exec_cmd(cmd)
+            wall_sec = time.perf_counter() - wall0
+            sim_sec = self.clock.time() - t0
+
+            print('%-16s sim=%7.3fs wall=%7.2fms x%-7.0f write=%d cmd=%d' % (
+                cmd, sim_sec, wall_sec * 1000, sim_sec / max(wall_sec, 1e-9),
+                len(self.pi.get_servo_log()), self.pi.cmd_n))
+
+    def end(self):
+        """ end """
+        self._log.debug('')
+        self.robot_ctrl.opm.end()
+        self.pi.stop()
+        self._log.debug('done')
+
+
+import click
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.argument('cmds', type=str, nargs=-1)
+@click.option('--speed', '-s', 'speed', type=float, default=0,
+              help='clock speed (0: virtual clock)')
+@click.option('--debug', '-d', 'debug', is_flag=True, default=False,
+              help='debug flag')
+def main(cmds, speed, debug):
+    logger = get_logger(__name__, debug)
+    logger.debug('cmds=%s, speed=%s', cmds, speed)
+
+    if len(cmds) == 0:
+        cmds = ('home', 'forward 4', 'turn_right 2', 'happy', 'home')
+
+    app = PiServoSimApp(cmds, speed, debug=debug)
+    try:
+        app.main()
+    finally:
+        logger.debug('finally')
+        app.end()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+トレースファイル(MyLogger.Tracer.save())を表示する
+
+  $ OTTOPI_TRACE=trace.bin python3 OttoPiMotion.py ..
+  $ python3 TraceView.py trace.bin
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+from MyLogger import Tracer
+import click
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.argument('trace_file', type=click.Path(exists=True))
+def main(trace_file):
+    """ トレースファイルを表示する """
+    records = Tracer.load(trace_file)
+    if len(records) == 0:
+        return
+
+    t0 = records[0][0]
+    for t, name, a, b, c, d in records:
+        print('%10.3f ms  %-24s %6d %6d %6d %6d' % (
+            (t - t0) * 1000, name, a, b, c, d))
+
+
+if __name__ == '__main__':
+    main()
@@ -59,18 +59,28 @@ class Dance(threading.Thread):
             cmd_i = int(random.random() * len(self.CMD))
             cmd = self.CMD[cmd_i] + ' 1'
             self._log.debug('cmd=%a', cmd)
-            self._robot_ctrl.send(cmd, doInterrupt=False)
+            self._robot_ctrl.send(cmd, doInterrupt=False,
+                                 pri=OttoPiCtrl.PRI_DANCE)
 
             sleep_sec = random.random() * self._max_sleep_sec
             self._log.debug('sleep_sec=%s', sleep_sec)
             time.sleep(sleep_sec)
 
-    def end(self):
-        """ end """
-        self._log.debug('')
-        self._robot_ctrl.send('home 1', doInterrupt=True)
+    def end(self, wait=True):
+        """
+        end
+
+        Parameters
+        ----------
+        wait: bool
+            False: スレッドの終了(最大 max_sleep_sec 秒)を待たない
+        """
+        self._log.debug('wait=%s', wait)
         self.active = False
-        self.join()
+        self._robot_ctrl.send('home 1', doInterrupt=True,
+                             pri=OttoPiCtrl.PRI_DANCE)
+        if wait:
+            self.join()
         self._log.debug('done')
 
 